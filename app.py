@@ -308,6 +308,8 @@ def parse_command_line():
     """
     Handle command line arguments.
     """
+    import invesalius.constants as const
+
     # Parse command line arguments
     parser = argparse.ArgumentParser()
 
@@ -323,6 +325,22 @@ def parse_command_line():
 
     parser.add_argument("--import-all", action="store")
 
+    parser.add_argument(
+        "--import-workers",
+        action="store",
+        dest="import_workers",
+        type=int,
+        help="Number of processes used to read the DICOM headers on import (0 uses all CPUs)."
+        " It's kept as the default of the Preferences.",
+    )
+
+    parser.add_argument(
+        "--out-of-core",
+        action="store_true",
+        dest="out_of_core",
+        help="Import large DICOM series at full resolution, reading the image from disk.",
+    )
+
     parser.add_argument("--import-folder", action="store", dest="import_folder")
 
     parser.add_argument(
@@ -333,6 +351,22 @@ def parse_command_line():
 
     parser.add_argument("-s", "--save", help="Save the project after an import.")
 
+    parser.add_argument(
+        "--project-storage",
+        choices=[const.PROJECT_STORAGE_RAW, const.PROJECT_STORAGE_CHUNKED],
+        dest="project_storage",
+        help="How the image and masks are stored in the saved project files (raw or chunked"
+        " and compressed). It's kept as the default of the Preferences.",
+    )
+
+    parser.add_argument(
+        "--project-container",
+        choices=[const.PROJECT_CONTAINER_TAR, const.PROJECT_CONTAINER_INCREMENTAL],
+        dest="project_container",
+        help="Format of the saved project files (tar or incremental, which only writes what"
+        " was changed since the last save). It's kept as the default of the Preferences.",
+    )
+
     parser.add_argument(
         "-t", "--threshold", help="Define the threshold for the export (e.g. 100-780)."
     )
@@ -341,6 +375,11 @@ def parse_command_line():
 
     parser.add_argument("-a", "--export-to-all", help="Export to STL for all mask presets.")
 
+    parser.add_argument(
+        "--export-masks",
+        help="Export to STL one surface per mask, all of them created in a single pass.",
+    )
+
     parser.add_argument("--export-project", help="Export slices and mask to HDF5 or Nifti file.")
 
     parser.add_argument(
@@ -366,11 +405,22 @@ def parse_command_line():
     return args
 
 
+def import_workers():
+    import invesalius.constants as const
+
+    return ses.Session().GetConfig("import_workers", const.DEFAULT_IMPORT_WORKERS)
+
+
 def use_cmd_optargs(args):
     # If import DICOM argument...
     if args.dicom_dir:
         import_dir = args.dicom_dir
-        Publisher.sendMessage("Import directory", directory=import_dir, use_gui=not args.no_gui)
+        Publisher.sendMessage(
+            "Import directory",
+            directory=import_dir,
+            use_gui=not args.no_gui,
+            n_workers=import_workers(),
+        )
 
         if args.save:
             Publisher.sendMessage("Save project", filepath=os.path.abspath(args.save))
@@ -397,7 +447,7 @@ def use_cmd_optargs(args):
     elif args.import_all:
         import invesalius.reader.dicom_reader as dcm
 
-        for patient in dcm.GetDicomGroups(args.import_all):
+        for patient in dcm.GetDicomGroups(args.import_all, n_workers=import_workers()):
             for group in patient.GetGroups():
                 Publisher.sendMessage("Import group", group=group, use_gui=not args.no_gui)
                 check_for_export(args, suffix=group.title, remove_surfaces=False)
@@ -462,6 +512,15 @@ def check_for_export(args, suffix="", remove_surfaces=False):
         finally:
             exit(0)
 
+    elif args.export_masks:
+        # noinspection PyBroadException
+        try:
+            export_masks(args.export_masks, suffix)
+        except:
+            traceback.print_exc()
+        finally:
+            exit(0)
+
     if args.export_project:
         from invesalius.project import Project
 
@@ -500,6 +559,50 @@ def export(path_, threshold_range, remove_surface=False):
         Publisher.sendMessage("Remove surfaces", surface_indexes=(0,))
 
 
+def export_masks(path_, suffix=""):
+    import invesalius.constants as const
+    from invesalius.project import Project
+
+    if path_.endswith(".stl"):
+        path_ = path_[:-4]
+
+    proj = Project()
+    old_surfaces = set(proj.surface_dict)
+    surface_options = {
+        "method": {
+            "algorithm": "Default",
+            "options": {},
+        },
+        "options": {
+            "index": 0,
+            "name": "",
+            "quality": _("Optimal *"),
+            "fill": False,
+            "keep_largest": False,
+            "overwrite": False,
+        },
+    }
+    Publisher.sendMessage(
+        "Create surfaces from masks",
+        mask_indexes=sorted(proj.mask_dict),
+        surface_parameters=surface_options,
+    )
+
+    # Only the shown surfaces are exported, so each one is exported alone.
+    new_surfaces = [index for index in sorted(proj.surface_dict) if index not in old_surfaces]
+    for index in proj.surface_dict:
+        proj.surface_dict[index].is_shown = False
+    for index in new_surfaces:
+        surface = proj.surface_dict[index]
+        surface.is_shown = True
+        names = [n for n in (suffix, sanitize(surface.name)) if n]
+        filename = "{}-{}.stl".format(path_, "-".join(names))
+        Publisher.sendMessage(
+            "Export surface to file", filename=filename, filetype=const.FILETYPE_STL
+        )
+        surface.is_shown = False
+
+
 def print_events(topic=Publisher.AUTO_TOPIC, **msg_data):
     """
     Print pubsub messages
@@ -564,6 +667,13 @@ def main(connection=None, remote_host=None):
     session = ses.Session()
     session.SetConfig("debug", args.debug)
     session.SetConfig("debug_efield", args.debug_efield)
+    session.SetConfig("out_of_core_import", args.out_of_core)
+    if args.project_storage:
+        session.SetConfig("project_storage", args.project_storage)
+    if args.project_container:
+        session.SetConfig("project_container", args.project_container)
+    if args.import_workers is not None:
+        session.SetConfig("import_workers", args.import_workers)
 
     if args.debug:
         Publisher.subscribe(print_events, Publisher.ALL_TOPICS)
@@ -32,6 +32,23 @@ INVESALIUS_VERSION = "3.1.99998"
 
 INVESALIUS_ACTUAL_FORMAT_VERSION = 1.1
 
+# How the image matrix and masks are stored inside the project file: raw
+# (memmap dump) or chunked (compressed chunks, see data/chunked_array.py).
+# It's only the format of the saved file, the chunked arrays are
+# decompressed to memmaps when the project is opened.
+PROJECT_STORAGE_RAW = "raw"
+PROJECT_STORAGE_CHUNKED = "chunked"
+
+# Format of the project file (.inv3): tar (compatible with all the
+# InVesalius versions) or incremental (append-only container, only the
+# changed data is written when saving, see data/project_container.py)
+PROJECT_CONTAINER_TAR = "tar"
+PROJECT_CONTAINER_INCREMENTAL = "incremental"
+
+# Number of processes that read the DICOM headers on import (0 uses one per
+# CPU, 1 reads them in the InVesalius process).
+DEFAULT_IMPORT_WORKERS = 0
+
 # ---------------
 
 # Measurements
@@ -743,6 +760,13 @@ APPEND_LOG_FILE = 6
 LOGFILE = 7
 CONSOLE_LOGGING = 8
 CONSOLE_LOGGING_LEVEL = 9
+
+# ------------ Project file options key------------
+PROJECT_STORAGE = 10
+PROJECT_CONTAINER = 11
+
+# ------------ DICOM import options key------------
+IMPORT_WORKERS = 12
 LOGGING_LEVEL_TYPES = ["NOTSET", "DEBUG", "INFO", "WARN", "ERROR", "CRITICAL"]
 
 # Correlaction extracted from pyDicom
@@ -778,6 +802,17 @@ PROJECTION_CONTOUR_MIDA = 8
 PROJECTION_BORDER_SIZE = 1.0
 PROJECTION_MIP_SIZE = 2
 
+# ------------- Slice cache ------------------
+# Number of slices kept in memory per orientation and number of slices
+# computed ahead in the scroll direction.
+SLICE_CACHE_SIZE = 16
+SLICE_PREFETCH_DEPTH = 4
+
+# ------------- Mask edition history ------------------
+# Bytes of compressed undo/redo steps kept in memory per mask, the oldest
+# ones are written to disk when it's exceeded.
+MASK_HISTORY_MEMORY_BUDGET = 256 * 1024**2
+
 # ------------- Boolean operations ------------------
 BOOLEAN_UNION = 1
 BOOLEAN_DIFF = 2
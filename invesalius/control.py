@@ -349,7 +349,7 @@ class Controller:
         proj.SetAcquisitionModality(proj.modality)
         self.Slice = sl.Slice()
         self.Slice._open_image_matrix(
-            proj.matrix_filename, tuple(proj.matrix_shape), proj.matrix_dtype
+            proj.matrix_filename, tuple(proj.matrix_shape), proj.matrix_dtype, proj.matrix_offset
         )
 
         self.Slice.window_level = proj.level
@@ -519,20 +519,22 @@ class Controller:
 
     # ----------- to import by command line ---------------------------------------------------
 
-    def OnImportMedicalImages(self, directory: str, use_gui: bool) -> None:
-        self.ImportMedicalImages(directory, use_gui)
+    def OnImportMedicalImages(self, directory: str, use_gui: bool, n_workers: int = 1) -> None:
+        self.ImportMedicalImages(directory, use_gui, n_workers)
 
-    def ImportMedicalImages(self, directory: str, gui: bool = True) -> None:
-        patients_groups = dcm.GetDicomGroups(directory)
+    def ImportMedicalImages(self, directory: str, gui: bool = True, n_workers: int = 1) -> None:
+        patients_groups = dcm.GetDicomGroups(directory, n_workers=n_workers)
         name = directory.rpartition("\\")[-1].split(".")
 
         if len(patients_groups):
             # OPTION 1: DICOM
             group = dcm.SelectLargerDicomGroup(patients_groups)
-            matrix, matrix_filename, dicom = self.OpenDicomGroup(group, 0, [0, 0], gui=gui)
+            matrix, matrix_filename, dicom, scalar_range = self.OpenDicomGroup(
+                group, 0, [0, 0], gui=gui
+            )
             if matrix is None:
                 return
-            self.CreateDicomProject(dicom, matrix, matrix_filename)
+            self.CreateDicomProject(dicom, matrix, matrix_filename, scalar_range)
         else:
             # OPTION 2: NIfTI, Analyze or PAR/REC
             if name[-1] == "gz":
@@ -559,10 +561,12 @@ class Controller:
         self.ImportGroup(group, use_gui)
 
     def ImportGroup(self, group: "DicomGroup", gui: bool = True):
-        matrix, matrix_filename, dicom = self.OpenDicomGroup(group, 0, [0, 0], gui=gui)
+        matrix, matrix_filename, dicom, scalar_range = self.OpenDicomGroup(
+            group, 0, [0, 0], gui=gui
+        )
         if matrix is None:
             return
-        self.CreateDicomProject(dicom, matrix, matrix_filename)
+        self.CreateDicomProject(dicom, matrix, matrix_filename, scalar_range)
 
         self.LoadProject()
         Publisher.sendMessage("Enable state project", state=True)
@@ -576,7 +580,7 @@ class Controller:
 
         self.Slice = sl.Slice()
         self.Slice._open_image_matrix(
-            proj.matrix_filename, tuple(proj.matrix_shape), proj.matrix_dtype
+            proj.matrix_filename, tuple(proj.matrix_shape), proj.matrix_dtype, proj.matrix_offset
         )
 
         self.Slice.window_level = proj.level
@@ -671,7 +675,7 @@ class Controller:
         Publisher.sendMessage("End busy cursor")
         Publisher.sendMessage("Project loaded successfully")
 
-    def CreateDicomProject(self, dicom, matrix, matrix_filename):
+    def CreateDicomProject(self, dicom, matrix, matrix_filename, scalar_range=None):
         name_to_const = {"AXIAL": const.AXIAL, "CORONAL": const.CORONAL, "SAGITTAL": const.SAGITAL}
 
         proj = prj.Project()
@@ -688,7 +692,10 @@ class Controller:
         #  proj.original_orientation = const.AXIAL
         proj.window = float(dicom.image.window)
         proj.level = float(dicom.image.level)
-        proj.threshold_range = int(matrix.min()), int(matrix.max())
+        # The range computed by OpenDicomGroup while reading the slices.
+        if scalar_range is None:
+            scalar_range = image_utils.chunked_min_max(matrix)
+        proj.threshold_range = int(scalar_range[0]), int(scalar_range[1])
         proj.spacing = self.Slice.spacing
 
         filename = proj.name + ".inv3"
@@ -943,10 +950,12 @@ class Controller:
             )
             if dlg.ShowModal() != wx.ID_YES:
                 return
-        matrix, matrix_filename, dicom = self.OpenDicomGroup(group, interval, file_range, gui=True)
+        matrix, matrix_filename, dicom, scalar_range = self.OpenDicomGroup(
+            group, interval, file_range, gui=True
+        )
         if matrix is None:
             return
-        self.CreateDicomProject(dicom, matrix, matrix_filename)
+        self.CreateDicomProject(dicom, matrix, matrix_filename, scalar_range)
         self.LoadProject()
         Publisher.sendMessage("Enable state project", state=True)
 
@@ -1010,6 +1019,13 @@ class Controller:
                 int(sx), int(sy), n_slices, bits / 8
             )
 
+            # In the out-of-core mode (the --out-of-core option or the resize
+            # dialog) the slices are streamed into the memmap at their
+            # original resolution, the image is never fully in RAM.
+            session = ses.Session()
+            if resolution_percentage < 1.0 and session.GetConfig("out_of_core_import", False):
+                resolution_percentage = 1.0
+
             if resolution_percentage < 1.0 and gui:
                 re_dialog = dialog.ResizeImageDialog()
                 re_dialog.SetValue(int(resolution_percentage * 100))
@@ -1017,8 +1033,11 @@ class Controller:
                 re_dialog.Close()
 
                 if re_dialog_value == wx.ID_OK:
-                    percentage = re_dialog.GetValue()
-                    resolution_percentage = percentage / 100.0
+                    if re_dialog.GetOutOfCore():
+                        resolution_percentage = 1.0
+                    else:
+                        percentage = re_dialog.GetValue()
+                        resolution_percentage = percentage / 100.0
                 else:
                     return
 
@@ -1049,7 +1068,7 @@ class Controller:
             if dlg.ShowModal() == wx.ID_OK:
                 spacing = dlg.spacing_new_x, dlg.spacing_new_y, dlg.spacing_new_z
             else:
-                return None, None, None
+                return None, None, None, None
 
         self.Slice.spacing = spacing
 
@@ -1060,19 +1079,24 @@ class Controller:
             message = _("Fix gantry tilt applying the degrees below")
             value = -1 * tilt_value
             tilt_value = dialog.ShowNumberDialog(message, value)
-            image_utils.FixGantryTilt(self.matrix, self.Slice.spacing, tilt_value)
+            image_utils.FixGantryTilt(self.matrix, self.Slice.spacing, tilt_value, scalar_range[0])
         elif (tilt_value) and not (gui):
             tilt_value = -1 * tilt_value
-            image_utils.FixGantryTilt(self.matrix, self.Slice.spacing, tilt_value)
+            image_utils.FixGantryTilt(self.matrix, self.Slice.spacing, tilt_value, scalar_range[0])
 
         self.Slice.window_level = wl
         self.Slice.window_width = ww
 
-        scalar_range = int(self.matrix.min()), int(self.matrix.max())
+        # The gantry tilt correction interpolates the slices, so the range
+        # computed while reading them is not valid anymore.
+        if tilt_value:
+            scalar_range = image_utils.chunked_min_max(self.matrix)
+        else:
+            scalar_range = int(scalar_range[0]), int(scalar_range[1])
 
         Publisher.sendMessage("Update threshold limits list", threshold_range=scalar_range)
 
-        return self.matrix, self.filename, dicom
+        return self.matrix, self.filename, dicom, scalar_range
 
     def OpenOtherFiles(self, group):
         # Retreaving matrix from image data
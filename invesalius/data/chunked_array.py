@@ -0,0 +1,426 @@
+# --------------------------------------------------------------------------
+# Software:     InVesalius - Software de Reconstrucao 3D de Imagens Medicas
+# Copyright:    (C) 2001  Centro de Pesquisas Renato Archer
+# Homepage:     http://www.softwarepublico.gov.br
+# Contact:      invesalius@cti.gov.br
+# License:      GNU - GPL 2 (LICENSE.txt/LICENCA.txt)
+# --------------------------------------------------------------------------
+#    Este programa e software livre; voce pode redistribui-lo e/ou
+#    modifica-lo sob os termos da Licenca Publica Geral GNU, conforme
+#    publicada pela Free Software Foundation; de acordo com a versao 2
+#    da Licenca.
+#
+#    Este programa eh distribuido na expectativa de ser util, mas SEM
+#    QUALQUER GARANTIA; sem mesmo a garantia implicita de
+#    COMERCIALIZACAO ou de ADEQUACAO A QUALQUER PROPOSITO EM
+#    PARTICULAR. Consulte a Licenca Publica Geral GNU para obter mais
+#    detalhes.
+# --------------------------------------------------------------------------
+"""
+Chunked and compressed storage for 3D volumes.
+
+A ChunkedArray keeps the volume split in chunks (64x64x64 by default), each
+one compressed with a codec from invesalius.data.compression, in a single
+file. It offers the basic NumPy indexing (integers, slices and Ellipsis),
+only the chunks touched by the requested region are decompressed and the
+most recently used ones are kept in a LRU cache.
+
+InVesalius uses it only as the storage format of the image matrix and masks
+inside the project file (the "project_storage" option): the slices are not
+read from it during the session. The Cython kernels and the surface and
+segmentation processes need np.memmap files, so the arrays are converted
+from and to memmaps when the project is opened and saved, compressing and
+decompressing the chunks in parallel.
+
+File layout: a magic string, the compressed chunks appended one after the
+other, a JSON index and the offset of that index (uint64) at the end. Chunks
+equal to the fill value are not stored.
+"""
+
+import collections
+import concurrent.futures
+import itertools
+import json
+import math
+import os
+import struct
+import threading
+
+import numpy as np
+
+from invesalius.data import compression
+
+MAGIC = b"INVCHNK1"
+FOOTER = struct.Struct("<Q")
+DEFAULT_CHUNKS = (64, 64, 64)
+DEFAULT_CACHE_SIZE = 64
+
+
+class ChunkedArray:
+    def __init__(self, filename, mode="r", cache_size=DEFAULT_CACHE_SIZE):
+        """
+        Opens an existing chunked array file. mode is "r" (read only) or "r+"
+        (read and write). Use ChunkedArray.create or ChunkedArray.from_array
+        to create a new one.
+        """
+        self.filename = str(filename)
+        self.mode = mode
+        self.cache_size = cache_size
+
+        self._lock = threading.RLock()
+        self._cache = collections.OrderedDict()
+        self._dirty = set()
+
+        self._file = open(self.filename, "rb" if mode == "r" else "r+b")
+        if self._file.read(len(MAGIC)) != MAGIC:
+            self._file.close()
+            raise ValueError("{} is not a chunked array file".format(self.filename))
+        self._read_index()
+
+    @classmethod
+    def create(
+        cls,
+        filename,
+        shape,
+        dtype,
+        chunks=DEFAULT_CHUNKS,
+        codec=None,
+        level=None,
+        fill_value=0,
+        cache_size=DEFAULT_CACHE_SIZE,
+    ):
+        """
+        Creates a new chunked array file filled with fill_value.
+        """
+        codec = compression.get_codec(codec, level)
+        index = {
+            "shape": [int(i) for i in shape],
+            "dtype": np.dtype(dtype).str,
+            "chunks": [int(i) for i in chunks],
+            "codec": codec.name,
+            "level": codec.level,
+            "fill_value": fill_value,
+            "blobs": {},
+        }
+        with open(filename, "wb") as f:
+            f.write(MAGIC)
+            data = json.dumps(index).encode("utf8")
+            f.write(data)
+            f.write(FOOTER.pack(len(MAGIC)))
+        return cls(filename, "r+", cache_size)
+
+    @classmethod
+    def from_array(
+        cls, array, filename, chunks=DEFAULT_CHUNKS, codec=None, level=None, n_threads=None
+    ):
+        """
+        Creates a new chunked array file with the content of array (e.g. a
+        np.memmap), which is read one slab of chunks at a time. The chunks of
+        each slab are compressed in parallel (n_threads, None uses all the
+        CPUs).
+        """
+        carray = cls.create(filename, array.shape, array.dtype, chunks, codec, level)
+        cz = carray.chunks[0]
+
+        def compress_chunk(chunk):
+            if not np.any(chunk != carray.fill_value):
+                return None
+            return carray._codec.compress(chunk.tobytes(), carray.dtype.itemsize)
+
+        n_threads = compression._get_n_threads(n_threads)
+        with concurrent.futures.ThreadPoolExecutor(n_threads) as executor:
+            for z in range(0, carray.shape[0], cz):
+                slab = np.asarray(array[z : z + cz])
+                keys = list(carray._chunk_keys(axis0=z // cz))
+                blocks = executor.map(
+                    lambda key: compress_chunk(
+                        np.ascontiguousarray(slab[(slice(None),) + carray._chunk_region(key)[1:]])
+                    ),
+                    keys,
+                )
+                for key, data in zip(keys, blocks):
+                    if data is not None:
+                        carray._write_blob(key, data)
+        carray.flush()
+        return carray
+
+    def _read_index(self):
+        self._file.seek(-FOOTER.size, os.SEEK_END)
+        (index_offset,) = FOOTER.unpack(self._file.read(FOOTER.size))
+        self._file.seek(index_offset)
+        index = json.loads(self._file.read()[: -FOOTER.size].decode("utf8"))
+
+        self._data_end = index_offset
+        self.shape = tuple(index["shape"])
+        self.dtype = np.dtype(index["dtype"])
+        self.chunks = tuple(index["chunks"])
+        self.fill_value = index["fill_value"]
+        self._codec = compression.get_codec(index["codec"], index["level"])
+        self._blobs = {tuple(int(i) for i in k.split(",")): v for k, v in index["blobs"].items()}
+
+    def _write_index(self):
+        index = {
+            "shape": list(self.shape),
+            "dtype": self.dtype.str,
+            "chunks": list(self.chunks),
+            "codec": self._codec.name,
+            "level": self._codec.level,
+            "fill_value": self.fill_value,
+            "blobs": {",".join(str(i) for i in k): v for k, v in self._blobs.items()},
+        }
+        self._file.seek(self._data_end)
+        self._file.write(json.dumps(index).encode("utf8"))
+        self._file.write(FOOTER.pack(self._data_end))
+        self._file.truncate()
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return math.prod(self.shape)
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __iter__(self):
+        for i in range(self.shape[0]):
+            yield self[i]
+
+    def _chunk_grid(self):
+        return tuple(math.ceil(s / c) for s, c in zip(self.shape, self.chunks))
+
+    def _chunk_keys(self, axis0=None):
+        grid = self._chunk_grid()
+        if axis0 is None:
+            return itertools.product(*(range(g) for g in grid))
+        return itertools.product((axis0,), *(range(g) for g in grid[1:]))
+
+    def _chunk_region(self, key):
+        return tuple(
+            slice(k * c, min((k + 1) * c, s)) for k, c, s in zip(key, self.chunks, self.shape)
+        )
+
+    def _chunk_shape(self, key):
+        return tuple(r.stop - r.start for r in self._chunk_region(key))
+
+    def _load_chunk(self, key):
+        try:
+            offset, length = self._blobs[key]
+        except KeyError:
+            return np.full(self._chunk_shape(key), self.fill_value, dtype=self.dtype)
+        self._file.seek(offset)
+        data = self._codec.decompress(self._file.read(length))
+        return np.frombuffer(data, dtype=self.dtype).reshape(self._chunk_shape(key)).copy()
+
+    def _store_chunk(self, key, chunk):
+        if not np.any(chunk != self.fill_value):
+            self._blobs.pop(key, None)
+            return
+        self._write_blob(key, self._codec.compress(chunk.tobytes(), self.dtype.itemsize))
+
+    def _write_blob(self, key, data):
+        self._file.seek(self._data_end)
+        self._file.write(data)
+        self._blobs[key] = [self._data_end, len(data)]
+        self._data_end += len(data)
+
+    def _get_chunk(self, key):
+        with self._lock:
+            try:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+            except KeyError:
+                pass
+
+            chunk = self._load_chunk(key)
+            self._cache[key] = chunk
+            while len(self._cache) > self.cache_size:
+                old_key, old_chunk = self._cache.popitem(last=False)
+                if old_key in self._dirty:
+                    self._store_chunk(old_key, old_chunk)
+                    self._dirty.discard(old_key)
+            return chunk
+
+    def _peek_chunk(self, key):
+        """
+        Returns the chunk without adding it to the cache, used when going
+        through the whole array.
+        """
+        with self._lock:
+            try:
+                return self._cache[key]
+            except KeyError:
+                return self._load_chunk(key)
+
+    def _ranges(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        n_ellipsis = sum(1 for k in key if k is Ellipsis)
+        if n_ellipsis > 1:
+            raise IndexError("an index can only have a single ellipsis ('...')")
+        elif n_ellipsis:
+            i = next(i for i, k in enumerate(key) if k is Ellipsis)
+            key = key[:i] + (slice(None),) * (self.ndim - len(key) + 1) + key[i + 1 :]
+
+        if len(key) > self.ndim:
+            raise IndexError("too many indices for array")
+        key = key + (slice(None),) * (self.ndim - len(key))
+
+        ranges = []
+        drop = []
+        for k, dim in zip(key, self.shape):
+            if isinstance(k, (int, np.integer)):
+                i = int(k)
+                if i < 0:
+                    i += dim
+                if not 0 <= i < dim:
+                    raise IndexError("index {} is out of bounds for size {}".format(k, dim))
+                ranges.append(range(i, i + 1))
+                drop.append(True)
+            elif isinstance(k, slice):
+                ranges.append(range(*k.indices(dim)))
+                drop.append(False)
+            else:
+                raise TypeError("ChunkedArray only supports integers, slices and Ellipsis")
+        return ranges, drop
+
+    def _chunk_selections(self, ranges):
+        """
+        For each chunk touched by ranges yields its key, the region of the
+        selection and the region of the chunk that correspond to each other.
+        """
+        per_axis = []
+        for r, c in zip(ranges, self.chunks):
+            groups = []
+            for n, x in enumerate(r):
+                k = x // c
+                if groups and groups[-1][0] == k:
+                    groups[-1][2] = n + 1
+                else:
+                    groups.append([k, n, n + 1])
+
+            axis = []
+            for k, n_start, n_stop in groups:
+                first = r[n_start] - k * c
+                last = r[n_stop - 1] - k * c
+                stop = last + (1 if r.step > 0 else -1)
+                if stop < 0:
+                    stop = None
+                axis.append((k, slice(n_start, n_stop), slice(first, stop, r.step)))
+            per_axis.append(axis)
+
+        for items in itertools.product(*per_axis):
+            key = tuple(i[0] for i in items)
+            sel = tuple(i[1] for i in items)
+            chunk_sel = tuple(i[2] for i in items)
+            yield key, sel, chunk_sel
+
+    def __getitem__(self, key):
+        ranges, drop = self._ranges(key)
+        full_shape = tuple(len(r) for r in ranges)
+        shape = tuple(n for n, d in zip(full_shape, drop) if not d)
+
+        out = np.empty(full_shape, dtype=self.dtype)
+        if out.size:
+            with self._lock:
+                for ckey, sel, chunk_sel in self._chunk_selections(ranges):
+                    out[sel] = self._get_chunk(ckey)[chunk_sel]
+        return out.reshape(shape)[()]
+
+    def __setitem__(self, key, value):
+        if self.mode == "r":
+            raise ValueError("ChunkedArray opened as read only")
+        ranges, drop = self._ranges(key)
+        full_shape = tuple(len(r) for r in ranges)
+        shape = tuple(n for n, d in zip(full_shape, drop) if not d)
+        if not math.prod(full_shape):
+            return
+
+        value = np.broadcast_to(np.asarray(value).astype(self.dtype, copy=False), shape)
+        value = value.reshape(full_shape)
+        with self._lock:
+            for ckey, sel, chunk_sel in self._chunk_selections(ranges):
+                self._get_chunk(ckey)[chunk_sel] = value[sel]
+                self._dirty.add(ckey)
+
+    def __array__(self, dtype=None, copy=None):
+        array = self[...]
+        if dtype is not None:
+            array = array.astype(dtype, copy=False)
+        return array
+
+    def copy(self):
+        return self[...]
+
+    def _reduce(self, func):
+        with self._lock:
+            values = [func(self._peek_chunk(key)) for key in self._chunk_keys()]
+        return func(np.array(values, dtype=self.dtype))
+
+    def min(self):
+        return self._reduce(np.min)
+
+    def max(self):
+        return self._reduce(np.max)
+
+    def to_memmap(self, filename, n_threads=None):
+        """
+        Decompresses the whole array into a np.memmap, one slab of chunks at
+        a time. The chunks of each slab are read in order and decompressed
+        in parallel (n_threads, None uses all the CPUs), chunks not stored
+        are left as the fill value.
+        """
+        matrix = np.memmap(filename, mode="w+", dtype=self.dtype, shape=self.shape)
+        if self.fill_value != 0:
+            matrix[:] = self.fill_value
+
+        def decompress_chunk(item):
+            key, data = item
+            chunk = np.frombuffer(self._codec.decompress(data), dtype=self.dtype)
+            matrix[self._chunk_region(key)] = chunk.reshape(self._chunk_shape(key))
+
+        cz = self.chunks[0]
+        n_threads = compression._get_n_threads(n_threads)
+        with self._lock, concurrent.futures.ThreadPoolExecutor(n_threads) as executor:
+            self.flush()
+            for z in range(0, self.shape[0], cz):
+                items = []
+                for key in self._chunk_keys(axis0=z // cz):
+                    if key in self._cache:
+                        matrix[self._chunk_region(key)] = self._cache[key]
+                    elif key in self._blobs:
+                        offset, length = self._blobs[key]
+                        self._file.seek(offset)
+                        items.append((key, self._file.read(length)))
+                list(executor.map(decompress_chunk, items))
+        matrix.flush()
+        return matrix
+
+    def flush(self):
+        if self.mode == "r":
+            return
+        with self._lock:
+            for key in self._dirty:
+                self._store_chunk(key, self._cache[key])
+            self._dirty.clear()
+            self._write_index()
+            self._file.flush()
+
+    def close(self):
+        if self._file.closed:
+            return
+        self.flush()
+        self._file.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except (AttributeError, ValueError):
+            pass
@@ -0,0 +1,307 @@
+# --------------------------------------------------------------------------
+# Software:     InVesalius - Software de Reconstrucao 3D de Imagens Medicas
+# Copyright:    (C) 2001  Centro de Pesquisas Renato Archer
+# Homepage:     http://www.softwarepublico.gov.br
+# Contact:      invesalius@cti.gov.br
+# License:      GNU - GPL 2 (LICENSE.txt/LICENCA.txt)
+# --------------------------------------------------------------------------
+#    Este programa e software livre; voce pode redistribui-lo e/ou
+#    modifica-lo sob os termos da Licenca Publica Geral GNU, conforme
+#    publicada pela Free Software Foundation; de acordo com a versao 2
+#    da Licenca.
+#
+#    Este programa eh distribuido na expectativa de ser util, mas SEM
+#    QUALQUER GARANTIA; sem mesmo a garantia implicita de
+#    COMERCIALIZACAO ou de ADEQUACAO A QUALQUER PROPOSITO EM
+#    PARTICULAR. Consulte a Licenca Publica Geral GNU para obter mais
+#    detalhes.
+# --------------------------------------------------------------------------
+"""
+Lossless codecs used to store volumes (image matrix and masks) compressed.
+
+zstd and blosc are optional dependencies, zlib is always available. Besides
+the codecs, used for independent chunks, there are stream writers (gzip and
+zstd) used to compress the tar project files and a function to write
+chunked and compressed HDF5 datasets, all of them compressing in parallel.
+"""
+
+import collections
+import concurrent.futures
+import itertools
+import os
+import zlib
+
+import numpy as np
+
+try:
+    import zstandard
+
+    _has_zstd = True
+except ImportError:
+    _has_zstd = False
+
+try:
+    import blosc
+
+    _has_blosc = True
+except ImportError:
+    _has_blosc = False
+
+try:
+    import hdf5plugin
+
+    _has_hdf5plugin = True
+except ImportError:
+    _has_hdf5plugin = False
+
+GZIP_STREAM = "gzip"
+ZSTD_STREAM = "zstd"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+# Size of the blocks compressed in parallel by ParallelGzipWriter.
+GZIP_BLOCK_SIZE = 4 * 1024**2
+GZIP_DEFAULT_LEVEL = 6
+HDF5_CHUNKS = (64, 64, 64)
+
+
+class ZlibCodec:
+    name = "zlib"
+    default_level = 1
+
+    def __init__(self, level=None):
+        self.level = self.default_level if level is None else level
+
+    def compress(self, data, typesize=1):
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class ZstdCodec:
+    name = "zstd"
+    default_level = 3
+
+    def __init__(self, level=None):
+        self.level = self.default_level if level is None else level
+
+    def compress(self, data, typesize=1):
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def decompress(self, data):
+        return zstandard.ZstdDecompressor().decompress(data)
+
+
+class BloscCodec:
+    name = "blosc"
+    default_level = 5
+
+    def __init__(self, level=None):
+        self.level = self.default_level if level is None else level
+
+    def compress(self, data, typesize=1):
+        return blosc.compress(data, typesize=typesize, clevel=self.level, cname="zstd")
+
+    def decompress(self, data):
+        return blosc.decompress(data)
+
+
+CODECS = {
+    ZlibCodec.name: ZlibCodec,
+    ZstdCodec.name: ZstdCodec,
+    BloscCodec.name: BloscCodec,
+}
+
+
+def available_codecs():
+    """
+    Return the names of the codecs that can be used, the fastest first.
+    """
+    codecs = []
+    if _has_zstd:
+        codecs.append(ZstdCodec.name)
+    if _has_blosc:
+        codecs.append(BloscCodec.name)
+    codecs.append(ZlibCodec.name)
+    return codecs
+
+
+def get_codec(name=None, level=None):
+    """
+    Return a codec instance. If name is None the fastest available codec is
+    used. Raises ValueError if the codec is unknown or its module is not
+    installed.
+    """
+    if name is None:
+        name = available_codecs()[0]
+    if name not in CODECS:
+        raise ValueError("Unknown codec {}".format(name))
+    if name not in available_codecs():
+        raise ValueError("Codec {} is not available, install its python module".format(name))
+    return CODECS[name](level)
+
+
+def _get_n_threads(n_threads):
+    if n_threads is None or n_threads <= 0:
+        return os.cpu_count() or 1
+    return n_threads
+
+
+def _gzip_member(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+class ParallelGzipWriter:
+    """
+    File-like object that writes gzip data to fileobj. The data is split in
+    blocks compressed in parallel, each one as a gzip member. The result is
+    a multi-member gzip file, readable by any gzip reader (including the
+    tarfile module of the older InVesalius versions).
+    """
+
+    def __init__(self, fileobj, level=None, n_threads=None, block_size=GZIP_BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.level = GZIP_DEFAULT_LEVEL if level is None else level
+        self.n_threads = _get_n_threads(n_threads)
+        self.block_size = block_size
+        self._buffer = bytearray()
+        self._pending = collections.deque()
+        self._executor = concurrent.futures.ThreadPoolExecutor(self.n_threads)
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            self._submit(bytes(self._buffer[: self.block_size]))
+            del self._buffer[: self.block_size]
+        return len(data)
+
+    def _submit(self, block):
+        self._pending.append(self._executor.submit(_gzip_member, block, self.level))
+        # Bounds the memory used by the blocks waiting to be written.
+        while len(self._pending) > 2 * self.n_threads:
+            self.fileobj.write(self._pending.popleft().result())
+
+    def close(self):
+        if self._executor is None:
+            return
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        while self._pending:
+            self.fileobj.write(self._pending.popleft().result())
+        self._executor.shutdown()
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def stream_codecs():
+    """
+    Return the names of the available stream codecs, gzip (the one readable
+    by all the InVesalius versions) first.
+    """
+    codecs = [GZIP_STREAM]
+    if _has_zstd:
+        codecs.append(ZSTD_STREAM)
+    return codecs
+
+
+def stream_writer(fileobj, name=None, level=None, n_threads=None):
+    """
+    Returns a file-like object (also a context manager) that compresses
+    the data written to it into fileobj using n_threads (None uses all the
+    CPUs). Closing it doesn't close fileobj. name is gzip (default) or zstd.
+    """
+    n_threads = _get_n_threads(n_threads)
+    if name is None or name == GZIP_STREAM:
+        return ParallelGzipWriter(fileobj, level, n_threads)
+    if name == ZSTD_STREAM:
+        if not _has_zstd:
+            raise ValueError("Codec {} is not available, install its python module".format(name))
+        level = ZstdCodec.default_level if level is None else level
+        compressor = zstandard.ZstdCompressor(level=level, threads=n_threads)
+        return compressor.stream_writer(fileobj, closefd=False)
+    raise ValueError("Unknown stream codec {}".format(name))
+
+
+def is_zstd_stream(filename):
+    with open(filename, "rb") as f:
+        return f.read(len(ZSTD_MAGIC)) == ZSTD_MAGIC
+
+
+def stream_reader(fileobj):
+    """
+    Returns a file-like object with the decompressed data of the zstd stream
+    fileobj.
+    """
+    if not _has_zstd:
+        raise ValueError("Codec zstd is not available, install its python module")
+    return zstandard.ZstdDecompressor().stream_reader(fileobj)
+
+
+def _hdf5_filter(codec):
+    """
+    Returns the arguments of h5py create_dataset to use the HDF5 filter
+    equivalent to codec.
+    """
+    if codec.name == ZlibCodec.name:
+        return {"compression": "gzip", "compression_opts": codec.level}
+    if not _has_hdf5plugin:
+        raise ValueError("The HDF5 filter of {} needs the hdf5plugin module".format(codec.name))
+    if codec.name == ZstdCodec.name:
+        return dict(hdf5plugin.Zstd(clevel=codec.level))
+    if codec.name == BloscCodec.name:
+        return dict(
+            hdf5plugin.Blosc(cname="zstd", clevel=codec.level, shuffle=hdf5plugin.Blosc.SHUFFLE)
+        )
+    raise ValueError("Codec {} has no HDF5 filter".format(codec.name))
+
+
+def _compress_hdf5_chunk(codec, block, chunks):
+    # HDF5 stores the chunks in the border of the dataset with the full chunk
+    # size.
+    if block.shape != chunks:
+        full = np.zeros(chunks, dtype=block.dtype)
+        full[tuple(slice(0, i) for i in block.shape)] = block
+        block = full
+    return codec.compress(np.ascontiguousarray(block).tobytes(), block.dtype.itemsize)
+
+
+def write_hdf5_dataset(
+    group, name, array, codec=None, level=None, n_threads=None, chunks=HDF5_CHUNKS
+):
+    """
+    Creates the dataset name in the h5py group with the 3D array (e.g. a
+    np.memmap), chunked and compressed with codec. zlib uses the standard
+    gzip filter of HDF5, zstd and blosc need hdf5plugin to be read.
+
+    The HDF5 filters run in a single thread, so the chunks are compressed
+    here in parallel (n_threads, None uses all the CPUs) and written
+    directly. The array is read one slab of chunks at a time.
+    """
+    codec = get_codec(codec, level)
+    chunks = tuple(min(c, s) for c, s in zip(chunks, array.shape))
+    dataset = group.create_dataset(
+        name, shape=array.shape, dtype=array.dtype, chunks=chunks, **_hdf5_filter(codec)
+    )
+    dz, dy, dx = array.shape
+    cz, cy, cx = chunks
+    offsets = list(itertools.product(range(0, dy, cy), range(0, dx, cx)))
+    with concurrent.futures.ThreadPoolExecutor(_get_n_threads(n_threads)) as executor:
+        for z in range(0, dz, cz):
+            slab = np.asarray(array[z : z + cz])
+            blocks = executor.map(
+                lambda offset: _compress_hdf5_chunk(
+                    codec,
+                    slab[:, offset[0] : offset[0] + cy, offset[1] : offset[1] + cx],
+                    chunks,
+                ),
+                offsets,
+            )
+            for (y, x), data in zip(offsets, blocks):
+                dataset.id.write_direct_chunk((z, y, x), data)
+    return dataset
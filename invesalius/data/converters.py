@@ -238,3 +238,73 @@ def convert_custom_bin_to_vtk(filename: "str | bytes | os.PathLike[str]") -> Opt
     else:
         print("File does not exists")
         return None
+
+
+def _data_arrays_to_numpy(data) -> list:
+    arrays = []
+    for i in range(data.GetNumberOfArrays()):
+        vtk_array = data.GetArray(i)
+        if vtk_array is None:
+            continue
+        arrays.append(
+            (
+                vtk_array.GetName(),
+                numpy_support.vtk_to_numpy(vtk_array).copy(),
+                data.IsArrayAnAttribute(i),
+            )
+        )
+    return arrays
+
+
+def _numpy_to_data_arrays(arrays: list, data) -> None:
+    for name, n_array, attribute in arrays:
+        vtk_array = numpy_support.numpy_to_vtk(n_array, deep=1)
+        if name:
+            vtk_array.SetName(name)
+        if attribute >= 0:
+            data.SetAttribute(vtk_array, attribute)
+        else:
+            data.AddArray(vtk_array)
+
+
+def polydata_to_arrays(polydata: vtkPolyData) -> dict:
+    """
+    Returns the points, the polygons (legacy vtkCellArray layout) and the
+    point and cell data of the polydata as numpy arrays. Used to send
+    surfaces between processes (pickled) instead of writing them to disk.
+    """
+    points = polydata.GetPoints()
+    if points is None:
+        n_points = np.empty((0, 3), dtype=np.float32)
+    else:
+        n_points = numpy_support.vtk_to_numpy(points.GetData()).copy()
+
+    polys = polydata.GetPolys()
+    return {
+        "points": n_points,
+        "polys": numpy_support.vtk_to_numpy(polys.GetData()).copy(),
+        "number_of_polys": polys.GetNumberOfCells(),
+        "point_data": _data_arrays_to_numpy(polydata.GetPointData()),
+        "cell_data": _data_arrays_to_numpy(polydata.GetCellData()),
+    }
+
+
+def arrays_to_polydata(arrays: dict) -> vtkPolyData:
+    """
+    Inverse of polydata_to_arrays.
+    """
+    points = vtkPoints()
+    points.SetData(numpy_support.numpy_to_vtk(arrays["points"], deep=1))
+
+    polys = vtkCellArray()
+    polys.SetCells(
+        arrays["number_of_polys"],
+        numpy_support.numpy_to_vtkIdTypeArray(arrays["polys"], deep=1),
+    )
+
+    polydata = vtkPolyData()
+    polydata.SetPoints(points)
+    polydata.SetPolys(polys)
+    _numpy_to_data_arrays(arrays["point_data"], polydata.GetPointData())
+    _numpy_to_data_arrays(arrays["cell_data"], polydata.GetCellData())
+    return polydata
@@ -17,10 +17,13 @@
 #    detalhes.
 # --------------------------------------------------------------------------
 
+import collections
 import math
+import multiprocessing
 import os
 import sys
 import tempfile
+from concurrent import futures
 
 import gdcm
 import imageio
@@ -127,8 +130,8 @@ def resize_slice(im_array, resolution_percentage):
     return out
 
 
-def resize_image_array(image, resolution_percentage, as_mmap=False):
-    out = zoom(image, resolution_percentage, image.dtype, order=2)
+def resize_image_array(image, resolution_percentage, as_mmap=False, order=2):
+    out = zoom(image, resolution_percentage, image.dtype, order=order)
     if as_mmap:
         fd, fname = tempfile.mkstemp(suffix="_resized")
         out_mmap = np.memmap(fname, shape=out.shape, dtype=out.dtype, mode="w+")
@@ -149,18 +152,64 @@ def read_dcm_slice_as_np2(filename, resolution_percentage=1.0):
     return output
 
 
-def FixGantryTilt(matrix, spacing, tilt):
+def FixGantryTilt(matrix, spacing, tilt, min_value=None):
     """
     Fix gantry tilt given a vtkImageData and the tilt value. Return new
     vtkImageData.
+
+    min_value is the value used to fill the shifted region, if not given it's
+    the matrix minimum.
     """
     angle = np.radians(tilt)
     spacing = spacing[0], spacing[1], spacing[2]
     gntan = math.tan(angle)
 
+    if min_value is None:
+        min_value = chunked_min_max(matrix)[0]
+
     for n, slice_ in enumerate(matrix):
         offset = gntan * n * spacing[2]
-        matrix[n] = shift(slice_, (-offset / spacing[1], 0), cval=matrix.min())
+        matrix[n] = shift(slice_, (-offset / spacing[1], 0), cval=min_value)
+
+
+def iter_slabs(matrix, max_bytes=64 * 1024**2):
+    """
+    Iterate over the matrix in slabs along the first axis, each one with at
+    most max_bytes (but at least one slice). Yields (first_slice, slab).
+
+    Used to process memmaps larger than the RAM, only one slab is read at a
+    time.
+    """
+    slice_bytes = max(1, matrix[0].nbytes)
+    n_slices = max(1, max_bytes // slice_bytes)
+    for z in range(0, matrix.shape[0], n_slices):
+        yield z, matrix[z : z + n_slices]
+
+
+def chunked_min_max(matrix, max_bytes=64 * 1024**2):
+    """
+    Return the (min, max) of the matrix as python ints reading it by slabs.
+    """
+    min_value = None
+    max_value = None
+    for z, slab in iter_slabs(matrix, max_bytes):
+        slab_min, slab_max = int(slab.min()), int(slab.max())
+        if min_value is None or slab_min < min_value:
+            min_value = slab_min
+        if max_value is None or slab_max > max_value:
+            max_value = slab_max
+    return min_value, max_value
+
+
+def chunked_histogram(matrix, bins, range_, max_bytes=64 * 1024**2):
+    """
+    Return the histogram of the matrix, as np.histogram(matrix, bins,
+    range_)[0], reading it by slabs.
+    """
+    histogram = np.zeros(bins, dtype=np.int64)
+    for z, slab in iter_slabs(matrix, max_bytes):
+        histogram += np.histogram(slab, bins, range_)[0]
+    return histogram
 
 
 def BuildEditedImage(imagedata, points):
@@ -426,10 +475,15 @@ def bitmap2memmap(files, slice_size, orientation, spacing, resolution_percentage
     return matrix, scalar_range, temp_file
 
 
-def dcm2memmap(files, slice_size, orientation, resolution_percentage):
+def dcm2memmap(files, slice_size, orientation, resolution_percentage, n_threads=None):
     """
     From a list of dicom files it creates memmap file in the temp folder and
     returns it and its related filename.
+
+    The slices are decoded by n_threads threads (default: one per CPU), GDCM
+    releases the GIL while decoding. Each thread writes its slice directly
+    into its own plane of the memmap and returns the slice min and max, so
+    the scalar range is known without another pass over the matrix.
     """
     if len(files) > 1:
         message = _("Generating multiplanar visualization...")
@@ -448,8 +502,13 @@ def dcm2memmap(files, slice_size, orientation, resolution_percentage):
         shape = len(files), slice_size[1], slice_size[0]
 
     matrix = np.memmap(temp_file, mode="w+", dtype="int16", shape=shape)
-    for n, f in enumerate(files):
-        im_array = read_dcm_slice_as_np2(f, resolution_percentage)[::-1]
+
+    def _read_slice(n):
+        if n == 0:
+            im_array = first_slice[::-1]
+        else:
+            im_array = read_dcm_slice_as_np2(files[n], resolution_percentage)[::-1]
+        im_array = im_array.astype(matrix.dtype, copy=False)
 
         if orientation == "CORONAL":
             matrix[:, shape[1] - n - 1, :] = im_array
@@ -460,11 +519,36 @@ def dcm2memmap(files, slice_size, orientation, resolution_percentage):
             matrix[:, :, n] = im_array
         else:
             matrix[n] = im_array
-        if len(files) > 1:
-            update_progress(n, message)
+        return im_array.min(), im_array.max()
+
+    if n_threads is None:
+        n_threads = multiprocessing.cpu_count()
+    n_threads = max(1, min(n_threads, len(files)))
+
+    min_scalar = None
+    max_scalar = None
+    # Results are consumed in slice order, so the progress is reported from
+    # this thread, and at most max_pending slices are in memory at once.
+    max_pending = 2 * n_threads
+    pending = collections.deque()
+    submitted = 0
+    with futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
+        for n in range(len(files)):
+            while submitted < len(files) and submitted < n + max_pending:
+                pending.append(executor.submit(_read_slice, submitted))
+                submitted += 1
+
+            min_aux, max_aux = pending.popleft().result()
+            if min_scalar is None or min_aux < min_scalar:
+                min_scalar = min_aux
+            if max_scalar is None or max_aux > max_scalar:
+                max_scalar = max_aux
+
+            if len(files) > 1:
+                update_progress(n, message)
 
     matrix.flush()
-    scalar_range = matrix.min(), matrix.max()
+    scalar_range = min_scalar, max_scalar
     os.close(temp_fd)
 
     return matrix, scalar_range, temp_file
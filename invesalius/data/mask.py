@@ -17,6 +17,7 @@
 #    detalhes.
 # --------------------------------------------------------------------------
 
+import itertools
 import os
 import plistlib
 import random
@@ -30,68 +31,198 @@ from scipy import ndimage
 from vtkmodules.util import numpy_support
 
 import invesalius.constants as const
+import invesalius.data.compression as compression
 import invesalius.data.converters as converters
 import invesalius.session as ses
+from invesalius.data.chunked_array import ChunkedArray
 from invesalius.data.volume import VolumeMask
 from invesalius.pubsub import pub as Publisher
 from invesalius_cy import floodfill
 
 
+# Versions of the content of the masks, unique among all the masks, see
+# Mask.version.
+_versions = itertools.count(1)
+
+
+def _diff_region(array, other, max_bytes=64 * 1024**2):
+    """
+    Returns the bounding box (tuple of slices) of the voxels that differ
+    between array and other, or None if they are equal. 3D arrays are
+    compared by slabs.
+    """
+    if array.ndim < 3:
+        slabs = [(0, array, other)]
+    else:
+        n_slices = max(1, max_bytes // max(1, array[0].nbytes))
+        slabs = (
+            (z, array[z : z + n_slices], other[z : z + n_slices])
+            for z in range(0, array.shape[0], n_slices)
+        )
+
+    bounds = None
+    for z, a, b in slabs:
+        diff = a != b
+        if not diff.any():
+            continue
+        slab_bounds = []
+        for axis in range(diff.ndim):
+            axes = tuple(i for i in range(diff.ndim) if i != axis)
+            ids = np.flatnonzero(diff.any(axis=axes))
+            slab_bounds.append([ids[0], ids[-1] + 1])
+        slab_bounds[0] = [slab_bounds[0][0] + z, slab_bounds[0][1] + z]
+        if bounds is None:
+            bounds = slab_bounds
+        else:
+            bounds = [[min(i[0], j[0]), max(i[1], j[1])] for i, j in zip(bounds, slab_bounds)]
+
+    if bounds is None:
+        return None
+    return tuple(slice(int(i), int(e)) for i, e in bounds)
+
+
+def _as_slice(array):
+    """
+    Returns the 2D view of a slice given as (1, h, w).
+    """
+    if array.ndim == 3 and array.shape[0] == 1:
+        return array.reshape(array.shape[1:])
+    return array
+
+
 class EditionHistoryNode(object):
-    def __init__(self, index, orientation, array, clean=False):
+    """
+    An undo/redo step: the content of a slice (or of the whole mask, in the
+    "VOLUME" orientation) restricted to region, the bounding box of what
+    was changed by the edition. The content is kept compressed in memory
+    until spill is called, then it's moved to a temp file.
+    """
+
+    def __init__(self, index, orientation, array, clean=False, region=None, codec=None):
         self.index = index
         self.orientation = orientation
-        self.fd, self.filename = tempfile.mkstemp(suffix=".npy")
         self.clean = clean
+        self.region = region
+        self.filename = None
 
-        self._save_array(array)
+        if codec is None:
+            codec = compression.get_codec()
+        self._codec = codec
+        self._data = None
+        self.nbytes = 0
+        if region is not None:
+            self._save_array(array[region])
 
     def _save_array(self, array):
-        np.save(self.filename, array)
-        print("Saving history", self.index, self.orientation, self.filename, self.clean)
+        array = np.ascontiguousarray(array)
+        self.shape = array.shape
+        self.dtype = array.dtype
+        self._data = self._codec.compress(array.tobytes(), array.dtype.itemsize)
+        self.nbytes = len(self._data)
+
+    def _load_array(self):
+        if self._data is None:
+            with open(self.filename, "rb") as f:
+                data = f.read()
+        else:
+            data = self._data
+        return np.frombuffer(self._codec.decompress(data), dtype=self.dtype).reshape(self.shape)
+
+    @property
+    def in_memory(self):
+        return self._data is not None
+
+    def spill(self):
+        """
+        Moves the compressed content to a temp file.
+        """
+        if self._data is None:
+            return
+        fd, self.filename = tempfile.mkstemp(suffix=".hist")
+        with os.fdopen(fd, "wb") as f:
+            f.write(self._data)
+        self._data = None
+        self.nbytes = 0
 
     def commit_history(self, mvolume):
-        array = np.load(self.filename)
         if self.orientation == "AXIAL":
-            mvolume[self.index + 1, 1:, 1:] = array
+            target = mvolume[self.index + 1, 1:, 1:]
             if self.clean:
                 mvolume[self.index + 1, 0, 0] = 1
         elif self.orientation == "CORONAL":
-            mvolume[1:, self.index + 1, 1:] = array
+            target = mvolume[1:, self.index + 1, 1:]
             if self.clean:
                 mvolume[0, self.index + 1, 0] = 1
         elif self.orientation == "SAGITAL":
-            mvolume[1:, 1:, self.index + 1] = array
+            target = mvolume[1:, 1:, self.index + 1]
             if self.clean:
                 mvolume[0, 0, self.index + 1] = 1
         elif self.orientation == "VOLUME":
-            mvolume[:] = array
+            target = mvolume
+
+        # Outside the region the states before and after the edition are
+        # the same.
+        if self.region is not None:
+            target[self.region] = self._load_array()
 
         print("applying to", self.orientation, "at slice", self.index)
 
     def __del__(self):
-        print("Removing", self.filename)
-        os.close(self.fd)
-        os.remove(self.filename)
+        if self.filename is not None:
+            try:
+                os.remove(self.filename)
+            except OSError:
+                pass
 
 
 class EditionHistory(object):
-    def __init__(self, size=50):
+    def __init__(self, size=50, memory_budget=None):
         self.history = []
         self.index = -1
         self.size = size * 2
+        if memory_budget is None:
+            memory_budget = ses.Session().GetConfig(
+                "mask_history_memory_budget", const.MASK_HISTORY_MEMORY_BUDGET
+            )
+        self.memory_budget = memory_budget
 
         Publisher.sendMessage("Enable undo", value=False)
         Publisher.sendMessage("Enable redo", value=False)
 
     def new_node(self, index, orientation, array, p_array, clean):
+        # Some 2D tools (e.g. fill holes and region growing) give the edited
+        # slice as (1, h, w) and its previous state as (h, w). Both are
+        # compared and saved with the shape of the slice they are committed
+        # to.
+        if orientation != "VOLUME":
+            array = _as_slice(array)
+            p_array = _as_slice(p_array)
+
+        # Only the region changed by the edition is saved, in both nodes.
+        region = _diff_region(array, p_array)
+
         # Saving the previous state, used to undo/redo correctly.
-        p_node = EditionHistoryNode(index, orientation, p_array, clean)
+        p_node = EditionHistoryNode(index, orientation, p_array, clean, region)
         self.add(p_node)
 
-        node = EditionHistoryNode(index, orientation, array, clean)
+        node = EditionHistoryNode(index, orientation, array, clean, region)
         self.add(node)
 
+        self._check_memory_budget()
+
+    def _check_memory_budget(self):
+        """
+        Moves the oldest nodes to disk while the nodes in memory exceed the
+        memory budget, the newest (the most likely to be undone) are kept.
+        """
+        in_memory = sum(node.nbytes for node in self.history)
+        for node in self.history[:-2]:
+            if in_memory <= self.memory_budget:
+                break
+            if node.in_memory:
+                in_memory -= node.nbytes
+                node.spill()
+
     def add(self, node):
         if self.index == self.size:
             self.history.pop(0)
@@ -138,7 +269,7 @@ class EditionHistory(object):
 
         if self.index == 0:
             Publisher.sendMessage("Enable undo", value=False)
-        print("AT", self.index, len(self.history), self.history[self.index].filename)
+        print("AT", self.index, len(self.history))
 
     def redo(self, mvolume, actual_slices=None):
         h = self.history
@@ -173,7 +304,7 @@ class EditionHistory(object):
 
         if self.index == len(h) - 1:
             Publisher.sendMessage("Enable redo", value=False)
-        print("AT", self.index, len(h), h[self.index].filename)
+        print("AT", self.index, len(h))
 
     def _reload_slice(self, index):
         Publisher.sendMessage(
@@ -226,6 +357,17 @@ class Mask:
         self.__bind_events()
         self._modified_callbacks = []
 
+        # Bounding box (y0, y1, x0, x1, end exclusive) of the selected voxels
+        # of each axial slice and which ones have to be recomputed, see
+        # get_region.
+        self._bboxes = None
+        self._dirty_slices = None
+
+        # Changes each time the mask is written (see mark_dirty and
+        # update_region), the project doesn't save the mask file again if
+        # its version is the same of the last save.
+        self.version = next(_versions)
+
         self.history = EditionHistory()
 
     def __bind_events(self):
@@ -292,12 +434,27 @@ class Mask:
             if update_volume_viewer:
                 Publisher.sendMessage("Render volume viewer")
 
-    def SavePlist(self, dir_temp, filelist):
+    def SavePlist(self, dir_temp, filelist, chunked=False, unchanged=()):
+        """
+        Adds the mask files to filelist. The mask file is not added (nor
+        written to dir_temp) if its name is in unchanged, the names of the
+        files kept as they are in the project file.
+        """
         mask = {}
         filename = "mask_%d" % self.index
-        mask_filename = "%s.dat" % filename
-        mask_filepath = os.path.join(dir_temp, mask_filename)
-        filelist[self.temp_file] = mask_filename
+        self.detach_project_file()
+        if chunked:
+            mask_filename = "%s.chk" % filename
+            mask["mask_format"] = const.PROJECT_STORAGE_CHUNKED
+            if mask_filename not in unchanged:
+                mask_filepath = os.path.join(dir_temp, mask_filename)
+                self.matrix.flush()
+                ChunkedArray.from_array(self.matrix, mask_filepath).close()
+                filelist[mask_filepath] = mask_filename
+        else:
+            mask_filename = "%s.dat" % filename
+            if mask_filename not in unchanged:
+                filelist[self.temp_file] = mask_filename
         # self._save_mask(mask_filepath)
 
         mask["index"] = self.index
@@ -323,7 +480,14 @@ class Mask:
 
         return plist_filename
 
-    def OpenPList(self, filename):
+    def OpenPList(self, filename, mapped_files=None):
+        """
+        Opens the mask from its plist file. mapped_files maps the names of
+        the files inside an uncompressed project file to (project file path,
+        offset), the mask found there is mapped from the project file
+        instead of read from the folder of the plist. Returns the name of
+        the mask file in the project.
+        """
         with open(filename, "r+b") as f:
             mask = plistlib.load(f, fmt=plistlib.FMT_XML)
 
@@ -340,9 +504,22 @@ class Mask:
 
         dirpath = os.path.abspath(os.path.split(filename)[0])
         path = os.path.join(dirpath, mask_file)
+        if mask.get("mask_format", const.PROJECT_STORAGE_RAW) == const.PROJECT_STORAGE_CHUNKED:
+            chunked_path = path
+            path = os.path.splitext(chunked_path)[0] + ".dat"
+            carray = ChunkedArray(chunked_path)
+            carray.to_memmap(path)
+            carray.close()
+            os.remove(chunked_path)
+        elif mapped_files and mask_file in mapped_files:
+            path, offset = mapped_files[mask_file]
+            self._open_mask(path, tuple(shape), offset=offset)
+            return mask_file
         self._open_mask(path, tuple(shape))
+        return mask_file
 
     def OnFlipVolume(self, axis):
+        self.detach_project_file()
         submatrix = self.matrix[1:, 1:, 1:]
         if axis == 0:
             submatrix[:] = submatrix[::-1]
@@ -358,6 +535,7 @@ class Mask:
     def OnSwapVolumeAxes(self, axes):
         axis0, axis1 = axes
         self.matrix = self.matrix.swapaxes(axis0, axis1)
+        self._init_region()
         if self.volume:
             self.imagedata = self.as_vtkimagedata()
             self.volume.change_imagedata()
@@ -366,9 +544,39 @@ class Mask:
     def _save_mask(self, filename):
         shutil.copyfile(self.temp_file, filename)
 
-    def _open_mask(self, filename, shape, dtype="uint8"):
+    def _open_mask(self, filename, shape, dtype="uint8", offset=0):
         self.temp_file = filename
-        self.matrix = np.memmap(filename, shape=shape, dtype=dtype, mode="r+")
+        if offset:
+            # The mask is inside the project file, the changes are kept only
+            # in memory (copy-on-write) until detach_project_file is called.
+            # The edits of a few slices are cheap, but everything that writes
+            # the whole mask detaches it first, or the whole mask would end
+            # up in memory.
+            self.matrix = np.memmap(filename, shape=shape, dtype=dtype, mode="c", offset=offset)
+        else:
+            self.matrix = np.memmap(filename, shape=shape, dtype=dtype, mode="r+")
+        self._init_region()
+
+    def is_mapped_from_project(self):
+        return isinstance(self.matrix, np.memmap) and self.matrix.mode == "c"
+
+    def detach_project_file(self):
+        """
+        Copies a mask mapped from the project file (see OpenPList), with its
+        changes, to a temp file. It's necessary before other processes read
+        the mask file and before the project file is overwritten.
+        """
+        if not self.is_mapped_from_project():
+            return
+        self.temp_fd, temp_file = tempfile.mkstemp()
+        matrix = np.memmap(temp_file, mode="w+", dtype=self.matrix.dtype, shape=self.matrix.shape)
+        matrix[:] = self.matrix
+        matrix.flush()
+        self.temp_file = temp_file
+        self.matrix = matrix
+        if self.volume:
+            self.imagedata = self.as_vtkimagedata()
+            self.volume.change_imagedata()
 
     def _set_class_index(self, index):
         Mask.general_index = index
@@ -399,13 +607,125 @@ class Mask:
         self.temp_fd, self.temp_file = tempfile.mkstemp()
         shape = shape[0] + 1, shape[1] + 1, shape[2] + 1
         self.matrix = np.memmap(self.temp_file, mode="w+", dtype="uint8", shape=shape)
+        self._init_region()
+
+    def _init_region(self):
+        dz, dy, dx = (i - 1 for i in self.matrix.shape)
+        self._bboxes = np.empty((dz, 4), dtype=np.int32)
+        self._bboxes[:] = (dy, 0, dx, 0)
+        self._dirty_slices = np.ones(dz, dtype=bool)
 
-    def modified(self, all_volume=False):
+    def mark_dirty(self, slices=None):
+        """
+        Marks the bounding box of the given axial slices (all if None) to be
+        recomputed.
+        """
+        self.version = next(_versions)
+        if self._bboxes is None or len(self._bboxes) != self.matrix.shape[0] - 1:
+            self._init_region()
+        elif slices is None:
+            self._dirty_slices[:] = True
+        else:
+            self._dirty_slices[slices] = True
+
+    def update_region(self, index, orientation):
+        """
+        Updates the bounding boxes after the slice index of the given
+        orientation was written. An axial slice is just marked dirty, a
+        coronal or sagittal slice touches all axial slices, so their bounding
+        boxes are only enlarged to contain the new selected voxels (it's
+        cheaper than recomputing all of them and the boxes keep containing
+        all the selected voxels).
+        """
+        self.version = next(_versions)
+        if self._bboxes is None or len(self._bboxes) != self.matrix.shape[0] - 1:
+            self._init_region()
+            return
+
+        if orientation == "AXIAL":
+            self._dirty_slices[index] = True
+            return
+        elif orientation == "CORONAL":
+            selected = self.matrix[1:, index + 1, 1:] > 127
+        elif orientation == "SAGITAL":
+            selected = self.matrix[1:, 1:, index + 1] > 127
+        else:
+            self.mark_dirty()
+            return
+
+        zs = np.flatnonzero(selected.any(1))
+        if not zs.size:
+            return
+        selected = selected[zs]
+        first = selected.argmax(1)
+        last = selected.shape[1] - selected[:, ::-1].argmax(1)
+        bboxes = self._bboxes[zs]
+        if orientation == "CORONAL":
+            bboxes[:, 0] = np.minimum(bboxes[:, 0], index)
+            bboxes[:, 1] = np.maximum(bboxes[:, 1], index + 1)
+            bboxes[:, 2] = np.minimum(bboxes[:, 2], first)
+            bboxes[:, 3] = np.maximum(bboxes[:, 3], last)
+        else:
+            bboxes[:, 0] = np.minimum(bboxes[:, 0], first)
+            bboxes[:, 1] = np.maximum(bboxes[:, 1], last)
+            bboxes[:, 2] = np.minimum(bboxes[:, 2], index)
+            bboxes[:, 3] = np.maximum(bboxes[:, 3], index + 1)
+        self._bboxes[zs] = bboxes
+
+    def _update_bboxes(self):
+        if self._bboxes is None or len(self._bboxes) != self.matrix.shape[0] - 1:
+            self._init_region()
+        dy, dx = self.matrix.shape[1] - 1, self.matrix.shape[2] - 1
+        for z in np.flatnonzero(self._dirty_slices):
+            selected = self.matrix[z + 1, 1:, 1:] > 127
+            rows = np.flatnonzero(selected.any(1))
+            if rows.size:
+                cols = np.flatnonzero(selected.any(0))
+                self._bboxes[z] = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+            else:
+                self._bboxes[z] = dy, 0, dx, 0
+        self._dirty_slices[:] = False
+
+    def get_region(self, margin=0):
+        """
+        Returns the region of the mask (without the flag borders) with
+        selected voxels as a tuple of slices (z, y, x), enlarged by margin
+        voxels inside the volume, or None if the mask is empty. Only the
+        axial slices modified since the last call are read.
+
+        The not generated slices are not thresholded here, see
+        Slice.do_threshold_to_all_slices.
+        """
+        self._update_bboxes()
+        bboxes = self._bboxes
+        occupied = np.flatnonzero(bboxes[:, 0] < bboxes[:, 1])
+        if not occupied.size:
+            return None
+        bboxes = bboxes[occupied]
+        shape = [i - 1 for i in self.matrix.shape]
+        starts = (occupied[0], bboxes[:, 0].min(), bboxes[:, 2].min())
+        ends = (occupied[-1] + 1, bboxes[:, 1].max(), bboxes[:, 3].max())
+        return tuple(
+            slice(max(0, int(i) - margin), min(size, int(e) + margin))
+            for i, e, size in zip(starts, ends, shape)
+        )
+
+    def modified(self, all_volume=False, index=None, orientation=None):
+        """
+        Notifies that the mask was modified. If index and orientation are
+        given only that slice was changed, otherwise all the volume may have
+        been changed.
+        """
         if all_volume:
             self.matrix[0] = 1
             self.matrix[:, 0, :] = 1
             self.matrix[:, :, 0] = 1
 
+        if index is not None and orientation is not None:
+            self.update_region(index, orientation)
+        else:
+            self.mark_dirty()
+
         session = ses.Session()
         if session.GetConfig("auto_reload_preview"):
             self._update_imagedata()
@@ -419,6 +739,7 @@ class Mask:
         self._modified_callbacks = callbacks
 
     def clean(self):
+        self.detach_project_file()
         self.matrix[1:, 1:, 1:] = 0
         self.modified(all_volume=True)
 
@@ -501,12 +822,22 @@ class Mask:
                 self.save_history(index, orientation, matrix.copy(), cp_mask)
 
     def __del__(self):
+        # The file of a mask mapped from the project file is the project
+        # file itself.
+        try:
+            mapped = self.is_mapped_from_project()
+        except AttributeError:
+            mapped = False
+
         # On Linux self.matrix is already removed so it gives an error
         try:
             del self.matrix
         except AttributeError:
             pass
 
+        if mapped:
+            return
+
         # Used for masks not loaded from plist project.
         try:
             os.close(self.temp_fd)
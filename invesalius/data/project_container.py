@@ -0,0 +1,330 @@
+# --------------------------------------------------------------------------
+# Software:     InVesalius - Software de Reconstrucao 3D de Imagens Medicas
+# Copyright:    (C) 2001  Centro de Pesquisas Renato Archer
+# Homepage:     http://www.softwarepublico.gov.br
+# Contact:      invesalius@cti.gov.br
+# License:      GNU - GPL 2 (LICENSE.txt/LICENCA.txt)
+# --------------------------------------------------------------------------
+#    Este programa e software livre; voce pode redistribui-lo e/ou
+#    modifica-lo sob os termos da Licenca Publica Geral GNU, conforme
+#    publicada pela Free Software Foundation; de acordo com a versao 2
+#    da Licenca.
+#
+#    Este programa eh distribuido na expectativa de ser util, mas SEM
+#    QUALQUER GARANTIA; sem mesmo a garantia implicita de
+#    COMERCIALIZACAO ou de ADEQUACAO A QUALQUER PROPOSITO EM
+#    PARTICULAR. Consulte a Licenca Publica Geral GNU para obter mais
+#    detalhes.
+# --------------------------------------------------------------------------
+"""
+Incremental (append-only) container used to save the project files (.inv3).
+
+The files of the project (main.plist, matrix, masks, surfaces, ...) are split
+in chunks of CHUNK_SIZE bytes and each chunk is stored once, compressed,
+identified by the hash (blake2b) of its content. When a project is saved
+again over a container, only the chunks not stored yet are appended to the
+end of the file, followed by a new manifest. The files the project knows
+that weren't changed (see Project.SavePlistProject) are not even read, so
+the time to save is proportional to what was changed since the last save
+and not to the size of the project. The chunks are hashed and compressed in
+parallel.
+
+File layout: a magic string, the compressed chunks, a JSON manifest (the
+files with the hashes of their chunks and where each chunk is) and a footer
+with the offset of the manifest and an end magic string. A save interrupted
+in the middle leaves the last complete manifest valid, it's found by
+searching the footer from the end of the file. When the chunks not used by
+the last manifest take more than half of the file, the container is
+compacted.
+"""
+
+import concurrent.futures
+import hashlib
+import json
+import os
+import shutil
+import struct
+import tempfile
+
+from invesalius.data import compression
+
+MAGIC = b"INV3CTNR"
+FOOTER_MAGIC = b"INV3MNFT"
+FOOTER = struct.Struct("<Q8s")
+VERSION = 1
+CHUNK_SIZE = 4 * 1024**2
+RAW_CODEC = "raw"
+# Files already compressed, they're stored without compressing again.
+RAW_EXTENSIONS = (".chk",)
+
+
+def is_container(filename):
+    """
+    Returns True if filename is a project container (and not an old .inv3
+    tar file).
+    """
+    try:
+        with open(filename, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+def _read_footer(f, footer_end):
+    footer_start = footer_end - FOOTER.size
+    if footer_start < len(MAGIC):
+        return None
+    f.seek(footer_start)
+    offset, _magic = FOOTER.unpack(f.read(FOOTER.size))
+    if not len(MAGIC) <= offset < footer_start:
+        return None
+    f.seek(offset)
+    try:
+        manifest = json.loads(f.read(footer_start - offset).decode("utf8"))
+    except ValueError:
+        return None
+    if not isinstance(manifest, dict) or manifest.get("version") != VERSION:
+        return None
+    return manifest
+
+
+def _find_manifest(f):
+    """
+    Returns the last complete manifest of the opened container f and the
+    position of the end of its footer. The footer is searched backwards, so
+    an incomplete save at the end of the file is ignored.
+    """
+    f.seek(0, os.SEEK_END)
+    pos = f.tell()
+    block_size = 1024**2
+    while pos > len(MAGIC):
+        start = max(len(MAGIC), pos - block_size)
+        f.seek(start)
+        block = f.read(pos - start + len(FOOTER_MAGIC) - 1)
+        i = block.rfind(FOOTER_MAGIC)
+        while i != -1:
+            footer_end = start + i + len(FOOTER_MAGIC)
+            manifest = _read_footer(f, footer_end)
+            if manifest is not None:
+                return manifest, footer_end
+            i = block.rfind(FOOTER_MAGIC, 0, i + len(FOOTER_MAGIC) - 1)
+        pos = start
+    raise ValueError("{} has no valid manifest".format(f.name))
+
+
+def read_manifest(filename):
+    with open(filename, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a project container".format(filename))
+        manifest, _end = _find_manifest(f)
+    return manifest
+
+
+def _read_chunks(filename, chunk_size):
+    with open(filename, "rb") as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            yield data
+
+
+def _process_chunk(data, codec, known):
+    digest = hashlib.blake2b(data, digest_size=20).hexdigest()
+    if digest in known:
+        return digest, len(data), None
+    if codec is None:
+        return digest, len(data), data
+    return digest, len(data), codec.compress(data)
+
+
+def _ordered_results(executor, func, args_list, max_pending):
+    """
+    Like executor.map, but with at most max_pending tasks submitted and not
+    consumed, so the memory used is bounded.
+    """
+    pending = []
+    for args in args_list:
+        pending.append(executor.submit(func, *args))
+        if len(pending) >= max_pending:
+            yield pending.pop(0).result()
+    for future in pending:
+        yield future.result()
+
+
+def _write_manifest(f, manifest):
+    offset = f.tell()
+    f.write(json.dumps(manifest).encode("utf8"))
+    f.write(FOOTER.pack(offset, FOOTER_MAGIC))
+
+
+def save(
+    filename,
+    filelist,
+    codec=None,
+    level=None,
+    n_threads=None,
+    chunk_size=CHUNK_SIZE,
+    unchanged=None,
+):
+    """
+    Saves the files in filelist (path -> name inside the container) to the
+    container filename. If filename is already a container the chunks
+    already stored in it are reused and only the new ones are appended,
+    otherwise a new container is created. codec is the name of a codec from
+    invesalius.data.compression ("raw" stores the chunks without
+    compression, None uses the fastest available).
+
+    unchanged maps names of files not in filelist to the name of a file
+    with the same content already in the container, their chunks are kept
+    without reading nor hashing them again.
+    """
+    unchanged = unchanged or {}
+    codec = None if codec == RAW_CODEC else compression.get_codec(codec, level)
+    if n_threads is None or n_threads <= 0:
+        n_threads = os.cpu_count() or 1
+
+    chunks = {}
+    previous_files = {}
+    temp_filename = None
+    if is_container(filename):
+        f = open(filename, "r+b")
+        try:
+            previous, end = _find_manifest(f)
+            chunks = previous["chunks"]
+            previous_files = previous["files"]
+        except ValueError:
+            end = len(MAGIC)
+        f.seek(end)
+    else:
+        # A new container (or an old tar .inv3 being replaced) is written to
+        # a temp file and moved to filename when complete.
+        fd, temp_filename = tempfile.mkstemp(
+            suffix=".inv3", dir=os.path.dirname(os.path.abspath(filename))
+        )
+        os.close(fd)
+        f = open(temp_filename, "w+b")
+        f.write(MAGIC)
+
+    missing = [name for name in unchanged.values() if name not in previous_files]
+    if missing:
+        f.close()
+        if temp_filename is not None:
+            os.remove(temp_filename)
+        raise ValueError("{} not found in {}".format(", ".join(missing), filename))
+
+    files = {}
+    used = {}
+    for name, previous_name in unchanged.items():
+        entry = previous_files[previous_name]
+        for digest in entry["chunks"]:
+            used[digest] = chunks[digest]
+        files[str(name)] = entry
+    try:
+        with concurrent.futures.ThreadPoolExecutor(n_threads) as executor:
+            for path, name in filelist.items():
+                name = str(name)
+                file_codec = None if name.endswith(RAW_EXTENSIONS) else codec
+                codec_name = RAW_CODEC if file_codec is None else file_codec.name
+                hashes = []
+                size = 0
+                results = _ordered_results(
+                    executor,
+                    _process_chunk,
+                    ((data, file_codec, chunks) for data in _read_chunks(path, chunk_size)),
+                    2 * n_threads,
+                )
+                for digest, usize, data in results:
+                    hashes.append(digest)
+                    size += usize
+                    if digest in chunks:
+                        used[digest] = chunks[digest]
+                    elif digest not in used:
+                        used[digest] = [f.tell(), len(data), usize, codec_name]
+                        f.write(data)
+                files[name] = {"size": size, "chunks": hashes}
+
+        _write_manifest(f, {"version": VERSION, "files": files, "chunks": used})
+        f.truncate()
+        f.flush()
+        os.fsync(f.fileno())
+        total_size = f.tell()
+    except BaseException:
+        f.close()
+        if temp_filename is not None:
+            os.remove(temp_filename)
+        raise
+    f.close()
+
+    if temp_filename is not None:
+        shutil.move(temp_filename, filename)
+    else:
+        live_size = sum(chunk[1] for chunk in used.values())
+        if total_size > 2 * live_size + len(MAGIC) + chunk_size:
+            compact(filename)
+
+
+def compact(filename):
+    """
+    Rewrites the container only with the chunks used by its last manifest.
+    The chunks are copied without decompressing.
+    """
+    manifest = read_manifest(filename)
+    fd, temp_filename = tempfile.mkstemp(
+        suffix=".inv3", dir=os.path.dirname(os.path.abspath(filename))
+    )
+    os.close(fd)
+    chunks = {}
+    with open(filename, "rb") as src, open(temp_filename, "wb") as dst:
+        dst.write(MAGIC)
+        for digest, (offset, csize, usize, codec_name) in manifest["chunks"].items():
+            src.seek(offset)
+            chunks[digest] = [dst.tell(), csize, usize, codec_name]
+            dst.write(src.read(csize))
+        manifest["chunks"] = chunks
+        _write_manifest(dst, manifest)
+    shutil.move(temp_filename, filename)
+
+
+def _load_chunk(filename, entry, codecs):
+    offset, csize, usize, codec_name = entry
+    with open(filename, "rb") as f:
+        f.seek(offset)
+        data = f.read(csize)
+    if codec_name != RAW_CODEC:
+        data = codecs[codec_name].decompress(data)
+    if len(data) != usize:
+        raise ValueError("Corrupted chunk in {}".format(filename))
+    return data
+
+
+def extract(filename, folder, n_threads=None):
+    """
+    Extracts the files of the container filename to folder. Returns the list
+    of extracted files.
+    """
+    manifest = read_manifest(filename)
+    chunks = manifest["chunks"]
+    codecs = {
+        name: compression.get_codec(name)
+        for name in {chunk[3] for chunk in chunks.values()}
+        if name != RAW_CODEC
+    }
+    if n_threads is None or n_threads <= 0:
+        n_threads = os.cpu_count() or 1
+
+    filelist = []
+    with concurrent.futures.ThreadPoolExecutor(n_threads) as executor:
+        for name, entry in manifest["files"].items():
+            fname = os.path.join(folder, name)
+            results = _ordered_results(
+                executor,
+                _load_chunk,
+                ((filename, chunks[digest], codecs) for digest in entry["chunks"]),
+                2 * n_threads,
+            )
+            with open(fname, "wb") as f:
+                for data in results:
+                    f.write(data)
+            filelist.append(fname)
+    return filelist
@@ -0,0 +1,141 @@
+# --------------------------------------------------------------------------
+# Software:     InVesalius - Software de Reconstrucao 3D de Imagens Medicas
+# Copyright:    (C) 2001  Centro de Pesquisas Renato Archer
+# Homepage:     http://www.softwarepublico.gov.br
+# Contact:      invesalius@cti.gov.br
+# License:      GNU - GPL 2 (LICENSE.txt/LICENCA.txt)
+# --------------------------------------------------------------------------
+#    Este programa e software livre; voce pode redistribui-lo e/ou
+#    modifica-lo sob os termos da Licenca Publica Geral GNU, conforme
+#    publicada pela Free Software Foundation; de acordo com a versao 2
+#    da Licenca.
+#
+#    Este programa eh distribuido na expectativa de ser util, mas SEM
+#    QUALQUER GARANTIA; sem mesmo a garantia implicita de
+#    COMERCIALIZACAO ou de ADEQUACAO A QUALQUER PROPOSITO EM
+#    PARTICULAR. Consulte a Licenca Publica Geral GNU para obter mais
+#    detalhes.
+# --------------------------------------------------------------------------
+"""
+Incremental MaxIP, MinIP and MeanIP of a slab of slices.
+
+When the user scrolls with a projection enabled the slab moves one slice at
+a time, so only one slice enters and one leaves it. SlabProjection keeps the
+slices of the last slab and the per pixel projection and only reads the
+slices that entered the slab:
+
+* MeanIP keeps the running sum of the slab;
+* MaxIP and MinIP update the projection with the slices that entered and
+  recompute, from the kept slices, only the pixels whose maximum (minimum)
+  came from a slice that left the slab.
+"""
+
+import threading
+
+import numpy as np
+
+import invesalius.constants as const
+
+INCREMENTAL_PROJECTIONS = (
+    const.PROJECTION_MaxIP,
+    const.PROJECTION_MinIP,
+    const.PROJECTION_MeanIP,
+)
+
+
+def get_plane(matrix, axis, n):
+    index = [slice(None)] * 3
+    index[axis] = n
+    return matrix[tuple(index)]
+
+
+class SlabProjection:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._key = None
+        self._planes = None
+        self._value = None
+        self._start = 0
+        self._stop = 0
+
+    def reset(self):
+        with self._lock:
+            self._reset()
+
+    def project(self, matrix, axis, start, number_slices, projection):
+        """
+        Returns the projection of the slices start to start + number_slices
+        of matrix along axis.
+        """
+        stop = min(start + number_slices, matrix.shape[axis])
+        if stop <= start:
+            raise IndexError("slice {} is out of the image".format(start))
+
+        key = (id(matrix), matrix.shape, axis, number_slices, projection)
+        with self._lock:
+            added = [n for n in range(start, stop) if not self._start <= n < self._stop]
+            removed = [n for n in range(self._start, self._stop) if not start <= n < stop]
+            if self._key != key or len(added) >= stop - start:
+                self._project_slab(matrix, axis, start, stop, number_slices, projection)
+                self._key = key
+            else:
+                self._update_slab(matrix, axis, start, stop, added, removed, projection)
+            self._start = start
+            self._stop = stop
+
+            if projection == const.PROJECTION_MeanIP:
+                return self._value / (stop - start)
+            return self._value.copy()
+
+    def _project_slab(self, matrix, axis, start, stop, number_slices, projection):
+        plane_shape = matrix.shape[:axis] + matrix.shape[axis + 1 :]
+        # The slices are kept in a ring buffer indexed by slice number modulo
+        # number_slices.
+        self._planes = np.empty((number_slices,) + plane_shape, dtype=matrix.dtype)
+        for n in range(start, stop):
+            self._planes[n % number_slices] = get_plane(matrix, axis, n)
+        slab = self._planes[[n % number_slices for n in range(start, stop)]]
+
+        if projection == const.PROJECTION_MaxIP:
+            self._value = slab.max(0)
+        elif projection == const.PROJECTION_MinIP:
+            self._value = slab.min(0)
+        else:
+            self._value = slab.sum(0, dtype=np.float64)
+
+    def _update_slab(self, matrix, axis, start, stop, added, removed, projection):
+        number_slices = self._planes.shape[0]
+
+        if projection == const.PROJECTION_MeanIP:
+            for n in removed:
+                self._value -= self._planes[n % number_slices]
+            for n in added:
+                plane = get_plane(matrix, axis, n)
+                self._planes[n % number_slices] = plane
+                self._value += plane
+            return
+
+        if projection == const.PROJECTION_MaxIP:
+            func = np.maximum
+        else:
+            func = np.minimum
+
+        # Pixels whose projected value came from a slice that left the slab.
+        affected = np.zeros(self._value.shape, dtype=bool)
+        for n in removed:
+            affected |= self._planes[n % number_slices] == self._value
+
+        for n in added:
+            plane = get_plane(matrix, axis, n)
+            self._planes[n % number_slices] = plane
+            func(self._value, plane, out=self._value)
+
+        if affected.any():
+            values = self._planes[:, affected][[n % number_slices for n in range(start, stop)]]
+            if projection == const.PROJECTION_MaxIP:
+                self._value[affected] = values.max(0)
+            else:
+                self._value[affected] = values.min(0)
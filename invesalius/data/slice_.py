@@ -16,8 +16,11 @@
 #    PARTICULAR. Consulte a Licenca Publica Geral GNU para obter mais
 #    detalhes.
 # --------------------------------------------------------------------------
+import collections
 import os
 import tempfile
+import threading
+from concurrent import futures
 from typing import TYPE_CHECKING, Optional, Tuple, Union
 
 import numpy as np
@@ -40,11 +43,11 @@ import invesalius.data.imagedata_utils as iu
 import invesalius.session as ses
 import invesalius.style as st
 import invesalius.utils as utils
-from invesalius.data import transformations
+from invesalius.data import slab_projection, transformations
 from invesalius.data.mask import Mask
 from invesalius.project import Project
 from invesalius.pubsub import pub as Publisher
-from invesalius_cy import mips, transforms
+from invesalius_cy import mips, threshold, transforms
 
 if TYPE_CHECKING:
     from vtkmodules.vtkCommonDataModel import vtkImageData
@@ -53,31 +56,110 @@ OTHER = 0
 PLIST = 1
 WIDGET = 2
 
+ORIENTATION_AXES = {"AXIAL": 0, "CORONAL": 1, "SAGITAL": 2}
+
+# tmip parameter of mips.fast_countour_mip for each contour projection
+CONTOUR_PROJECTION_MODES = {
+    const.PROJECTION_CONTOUR_MIP: 0,
+    const.PROJECTION_CONTOUR_LMIP: 1,
+    const.PROJECTION_CONTOUR_MIDA: 2,
+}
+
+# Projections computed without the window and level. The others (LMIP,
+# MIDA and the contour ones) use the window level to pick the voxels.
+WINDOW_LEVEL_FREE_PROJECTIONS = (
+    const.PROJECTION_NORMAL,
+    const.PROJECTION_MaxIP,
+    const.PROJECTION_MinIP,
+    const.PROJECTION_MeanIP,
+)
+
+# Image types accepted by threshold.threshold_volume (image_t)
+THRESHOLD_KERNEL_DTYPES = (np.dtype(np.int16), np.dtype(np.uint8), np.dtype(np.float64))
+
 
 class SliceBuffer:
     """
     This class is used as buffer that mantains the vtkImageData and numpy array
     from actual slices from each orientation.
+
+    Besides the actual slice it keeps a LRU cache of the last image slices
+    (numpy and window/levelled vtkImageData) seen or prefetched in this
+    orientation. Every discard increments the generation, so slices being
+    prefetched when the buffer is discarded are not stored.
     """
 
-    def __init__(self):
+    def __init__(self, cache_size: int = const.SLICE_CACHE_SIZE):
         self.index: int = -1
         self.image: Optional[np.ndarray] = None
         self.mask: Optional[np.ndarray] = None
         self.vtk_image: Optional[vtkImageData] = None
         self.vtk_mask: Optional[vtkImageData] = None
 
+        self.cache_size = cache_size
+        self.generation: int = 0
+        self.direction: int = 1
+        self._lock = threading.Lock()
+        self._images: collections.OrderedDict = collections.OrderedDict()
+        self._vtk_images: collections.OrderedDict = collections.OrderedDict()
+        self.slab = slab_projection.SlabProjection()
+
+    def _get_cached(self, cache, key):
+        with self._lock:
+            try:
+                cache.move_to_end(key)
+            except KeyError:
+                return None
+            return cache[key]
+
+    def _set_cached(self, cache, key, value, generation):
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            cache[key] = value
+            cache.move_to_end(key)
+            while len(cache) > self.cache_size:
+                cache.popitem(last=False)
+
+    def get_cached_image(self, key) -> Optional[np.ndarray]:
+        return self._get_cached(self._images, key)
+
+    def get_cached_vtk_image(self, key) -> Optional["vtkImageData"]:
+        return self._get_cached(self._vtk_images, key)
+
+    def cache_image(self, key, image: np.ndarray, generation: Optional[int] = None) -> None:
+        self._set_cached(self._images, key, image, generation)
+
+    def cache_vtk_image(
+        self, key, vtk_image: "vtkImageData", generation: Optional[int] = None
+    ) -> None:
+        self._set_cached(self._vtk_images, key, vtk_image, generation)
+
+    def is_cached(self, key) -> bool:
+        with self._lock:
+            return key in self._vtk_images
+
+    def _clear_cache(self, images=True):
+        with self._lock:
+            self.generation += 1
+            if images:
+                self._images.clear()
+                self.slab.reset()
+            self._vtk_images.clear()
+
     def discard_vtk_mask(self) -> None:
         self.vtk_mask = None
 
     def discard_vtk_image(self) -> None:
         self.vtk_image = None
+        self._clear_cache(images=False)
 
     def discard_mask(self) -> None:
         self.mask = None
 
     def discard_image(self) -> None:
         self.image = None
+        self._clear_cache()
 
     def discard_buffer(self) -> None:
         self.index = -1
@@ -85,6 +167,7 @@ class SliceBuffer:
         self.mask = None
         self.vtk_image = None
         self.vtk_mask = None
+        self._clear_cache()
 
 
 # Only one slice will be initialized per time (despite several viewers
@@ -95,6 +178,8 @@ class Slice(metaclass=utils.Singleton):
         self.current_mask: Optional[Mask] = None
         self.blend_filter = None
         self.histogram: Optional[np.ndarray] = None
+        # Minimum and maximum of the matrix, computed once when it's set.
+        self.scalar_range: Optional[Tuple[int, int]] = None
         self._matrix: Optional[np.ndarray] = None
         self._affine: np.ndarray = np.identity(4)
         self._n_tracts: int = 0
@@ -128,6 +213,15 @@ class Slice(metaclass=utils.Singleton):
             "SAGITAL": SliceBuffer(),
         }
 
+        self._prefetch_executor = futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="slice_prefetch"
+        )
+        self._prefetch_futures: dict[str, list[futures.Future]] = {
+            "AXIAL": [],
+            "CORONAL": [],
+            "SAGITAL": [],
+        }
+
         self.num_gradient = 0
         self.interaction_style = st.StyleStateManager()
 
@@ -144,10 +238,16 @@ class Slice(metaclass=utils.Singleton):
 
     @matrix.setter
     def matrix(self, value: np.ndarray) -> None:
+        self.cancel_prefetch(wait=True)
+        for buffer_ in self.buffer_slices.values():
+            buffer_.discard_buffer()
         self._matrix = value
-        i, e = value.min(), value.max()
-        r = int(e) - int(i)
-        self.histogram = np.histogram(self._matrix, r, (i, e))[0]
+        # By slabs, the matrix may be a memmap larger than the RAM (see the
+        # out-of-core DICOM import).
+        i, e = iu.chunked_min_max(value)
+        self.scalar_range = i, e
+        r = e - i
+        self.histogram = iu.chunked_histogram(self._matrix, r, (i, e))
         self.center = [(s * d / 2.0) for (d, s) in zip(self.matrix.shape[::-1], self.spacing)]
 
     @property
@@ -186,6 +286,7 @@ class Slice(metaclass=utils.Singleton):
     def __bind_events(self) -> None:
         # General slice control
         Publisher.subscribe(self.CreateSurfaceFromIndex, "Create surface from index")
+        Publisher.subscribe(self.CreateSurfacesFromMasks, "Create surfaces from masks")
         # Mask control
         Publisher.subscribe(self.__add_mask_thresh, "Create new mask")
         Publisher.subscribe(self.__select_current_mask, "Change mask selected")
@@ -330,10 +431,17 @@ class Slice(metaclass=utils.Singleton):
         self.CloseProject()
 
     def CloseProject(self):
+        self.cancel_prefetch(wait=True)
+        for buffer_ in self.buffer_slices.values():
+            buffer_.discard_buffer()
+
         f = self._matrix.filename
+        # A matrix mapped from the project file must not be removed.
+        mapped = self._matrix.mode == "c"
         self._matrix._mmap.close()
         self._matrix = None
-        os.remove(f)
+        if not mapped:
+            os.remove(f)
         self.current_mask = None
 
         for name in self.aux_matrices:
@@ -393,6 +501,7 @@ class Slice(metaclass=utils.Singleton):
         proj = Project()
         index = proj.mask_dict.get_key(self.current_mask)
         self.num_gradient += 1
+        self.current_mask.detach_project_file()
         self.current_mask.matrix[:] = 0
         self.current_mask.clear_history()
 
@@ -421,18 +530,21 @@ class Slice(metaclass=utils.Singleton):
             n = self.buffer_slices["AXIAL"].index + 1
             self.current_mask.matrix[n, 1:, 1:] = b_mask
             self.current_mask.matrix[n, 0, 0] = 1
+            self.current_mask.update_region(n - 1, "AXIAL")
 
         b_mask = self.buffer_slices["CORONAL"].mask
         if b_mask is not None:
             n = self.buffer_slices["CORONAL"].index + 1
             self.current_mask.matrix[1:, n, 1:] = b_mask
             self.current_mask.matrix[0, n, 0] = 1
+            self.current_mask.update_region(n - 1, "CORONAL")
 
         b_mask = self.buffer_slices["SAGITAL"].mask
         if b_mask is not None:
             n = self.buffer_slices["SAGITAL"].index + 1
             self.current_mask.matrix[1:, 1:, n] = b_mask
             self.current_mask.matrix[0, 0, n] = 1
+            self.current_mask.update_region(n - 1, "SAGITAL")
 
         if to_reload:
             Publisher.sendMessage("Reload actual slice")
@@ -626,12 +738,9 @@ class Slice(metaclass=utils.Singleton):
             if self.buffer_slices[orientation].vtk_image:
                 image = self.buffer_slices[orientation].vtk_image
             else:
-                n_image = self.get_image_slice(
+                image = self._get_vtk_image_slice(
                     orientation, slice_number, number_slices, inverted, border_size
                 )
-                image = converters.to_vtk(n_image, self.spacing, slice_number, orientation)
-                ww_wl_image = self.do_ww_wl(image)
-                image = self.do_colour_image(ww_wl_image)
             if self.current_mask and self.current_mask.is_shown:
                 if self.buffer_slices[orientation].vtk_mask:
                     # Prints that during navigation causes delay in update
@@ -650,12 +759,14 @@ class Slice(metaclass=utils.Singleton):
                 final_image = image
             self.buffer_slices[orientation].vtk_image = image
         else:
-            n_image = self.get_image_slice(
+            previous_index = self.buffer_slices[orientation].index
+            if previous_index != -1 and previous_index != slice_number:
+                self.buffer_slices[orientation].direction = (
+                    1 if slice_number > previous_index else -1
+                )
+            image = self._get_vtk_image_slice(
                 orientation, slice_number, number_slices, inverted, border_size
             )
-            image = converters.to_vtk(n_image, self.spacing, slice_number, orientation)
-            ww_wl_image = self.do_ww_wl(image)
-            image = self.do_colour_image(ww_wl_image)
 
             if self.current_mask and self.current_mask.is_shown:
                 n_mask = self.get_mask_slice(orientation, slice_number)
@@ -672,6 +783,8 @@ class Slice(metaclass=utils.Singleton):
             self.buffer_slices[orientation].vtk_image = image
             self.buffer_slices[orientation].vtk_mask = mask
 
+            self.prefetch_slices(orientation, slice_number, number_slices, inverted, border_size)
+
         if (
             self.to_show_aux == "watershed"
             and self.current_mask is not None
@@ -712,281 +825,196 @@ class Slice(metaclass=utils.Singleton):
         inverted=False,
         border_size=1.0,
     ):
-        dz, dy, dx = self.matrix.shape
-        if (
-            self.buffer_slices[orientation].index == slice_number
-            and self.buffer_slices[orientation].image is not None
-        ):
-            n_image = self.buffer_slices[orientation].image
-        else:
-            if self._type_projection == const.PROJECTION_NORMAL:
-                number_slices = 1
-
-            if np.any(self.q_orientation[1::]):
-                cx, cy, cz = self.center
-                T0 = transformations.translation_matrix((-cz, -cy, -cx))
-                #  Rx = transformations.rotation_matrix(rx, (0, 0, 1))
-                #  Ry = transformations.rotation_matrix(ry, (0, 1, 0))
-                #  Rz = transformations.rotation_matrix(rz, (1, 0, 0))
-                #  #  R = transformations.euler_matrix(rz, ry, rx, 'rzyx')
-                #  R = transformations.concatenate_matrices(Rx, Ry, Rz)
-                R = transformations.quaternion_matrix(self.q_orientation)
-                T1 = transformations.translation_matrix((cz, cy, cx))
-                M = transformations.concatenate_matrices(T1, R.T, T0)
+        buffer_ = self.buffer_slices[orientation]
+        if buffer_.index == slice_number and buffer_.image is not None:
+            return buffer_.image
+
+        key = self._get_slice_cache_key(slice_number, number_slices, inverted, border_size)
+        n_image = buffer_.get_cached_image(key)
+        if n_image is None:
+            n_image = self._compute_image_slice(
+                orientation, slice_number, number_slices, inverted, border_size
+            )
+            buffer_.cache_image(key, n_image)
+        buffer_.image = n_image
+        return n_image
 
-            if orientation == "AXIAL":
-                tmp_array = np.array(self.matrix[slice_number : slice_number + number_slices])
-                if np.any(self.q_orientation[1::]):
-                    transforms.apply_view_matrix_transform(
-                        self.matrix,
-                        self.spacing,
-                        M,
-                        slice_number,
-                        orientation,
-                        self.interp_method,
-                        self.matrix.min(),
-                        tmp_array,
-                    )
-                if self._type_projection == const.PROJECTION_NORMAL:
-                    n_image = tmp_array.reshape(dy, dx)
-                else:
-                    if inverted:
-                        tmp_array = tmp_array[::-1]
-
-                    if self._type_projection == const.PROJECTION_MaxIP:
-                        n_image = np.array(tmp_array).max(0)
-                    elif self._type_projection == const.PROJECTION_MinIP:
-                        n_image = np.array(tmp_array).min(0)
-                    elif self._type_projection == const.PROJECTION_MeanIP:
-                        n_image = np.array(tmp_array).mean(0)
-                    elif self._type_projection == const.PROJECTION_LMIP:
-                        n_image = np.empty(
-                            shape=(tmp_array.shape[1], tmp_array.shape[2]),
-                            dtype=tmp_array.dtype,
-                        )
-                        mips.lmip(tmp_array, 0, self.window_level, self.window_level, n_image)
-                    elif self._type_projection == const.PROJECTION_MIDA:
-                        n_image = np.empty(
-                            shape=(tmp_array.shape[1], tmp_array.shape[2]),
-                            dtype=tmp_array.dtype,
-                        )
-                        mips.mida(tmp_array, 0, self.window_level, self.window_level, n_image)
-                    elif self._type_projection == const.PROJECTION_CONTOUR_MIP:
-                        n_image = np.empty(
-                            shape=(tmp_array.shape[1], tmp_array.shape[2]),
-                            dtype=tmp_array.dtype,
-                        )
-                        mips.fast_countour_mip(
-                            tmp_array,
-                            border_size,
-                            0,
-                            self.window_level,
-                            self.window_level,
-                            0,
-                            n_image,
-                        )
-                    elif self._type_projection == const.PROJECTION_CONTOUR_LMIP:
-                        n_image = np.empty(
-                            shape=(tmp_array.shape[1], tmp_array.shape[2]),
-                            dtype=tmp_array.dtype,
-                        )
-                        mips.fast_countour_mip(
-                            tmp_array,
-                            border_size,
-                            0,
-                            self.window_level,
-                            self.window_level,
-                            1,
-                            n_image,
-                        )
-                    elif self._type_projection == const.PROJECTION_CONTOUR_MIDA:
-                        n_image = np.empty(
-                            shape=(tmp_array.shape[1], tmp_array.shape[2]),
-                            dtype=tmp_array.dtype,
-                        )
-                        mips.fast_countour_mip(
-                            tmp_array,
-                            border_size,
-                            0,
-                            self.window_level,
-                            self.window_level,
-                            2,
-                            n_image,
-                        )
-                    else:
-                        n_image = np.array(self.matrix[slice_number])
+    def _compute_image_slice(self, orientation, slice_number, number_slices, inverted, border_size):
+        axis = ORIENTATION_AXES[orientation]
+        projection = self._type_projection
+        if projection == const.PROJECTION_NORMAL:
+            number_slices = 1
 
-            elif orientation == "CORONAL":
-                tmp_array = np.array(self.matrix[:, slice_number : slice_number + number_slices, :])
-                if np.any(self.q_orientation[1::]):
-                    transforms.apply_view_matrix_transform(
-                        self.matrix,
-                        self.spacing,
-                        M,
-                        slice_number,
-                        orientation,
-                        self.interp_method,
-                        self.matrix.min(),
-                        tmp_array,
-                    )
-
-                if self._type_projection == const.PROJECTION_NORMAL:
-                    n_image = tmp_array.reshape(dz, dx)
-                else:
-                    # if slice_number == 0:
-                    # slice_number = 1
-                    # if slice_number - number_slices < 0:
-                    # number_slices = slice_number
-                    if inverted:
-                        tmp_array = tmp_array[:, ::-1, :]
-                    if self._type_projection == const.PROJECTION_MaxIP:
-                        n_image = np.array(tmp_array).max(1)
-                    elif self._type_projection == const.PROJECTION_MinIP:
-                        n_image = np.array(tmp_array).min(1)
-                    elif self._type_projection == const.PROJECTION_MeanIP:
-                        n_image = np.array(tmp_array).mean(1)
-                    elif self._type_projection == const.PROJECTION_LMIP:
-                        n_image = np.empty(
-                            shape=(tmp_array.shape[0], tmp_array.shape[2]),
-                            dtype=tmp_array.dtype,
-                        )
-                        mips.lmip(tmp_array, 1, self.window_level, self.window_level, n_image)
-                    elif self._type_projection == const.PROJECTION_MIDA:
-                        n_image = np.empty(
-                            shape=(tmp_array.shape[0], tmp_array.shape[2]),
-                            dtype=tmp_array.dtype,
-                        )
-                        mips.mida(tmp_array, 1, self.window_level, self.window_level, n_image)
-                    elif self._type_projection == const.PROJECTION_CONTOUR_MIP:
-                        n_image = np.empty(
-                            shape=(tmp_array.shape[0], tmp_array.shape[2]),
-                            dtype=tmp_array.dtype,
-                        )
-                        mips.fast_countour_mip(
-                            tmp_array,
-                            border_size,
-                            1,
-                            self.window_level,
-                            self.window_level,
-                            0,
-                            n_image,
-                        )
-                    elif self._type_projection == const.PROJECTION_CONTOUR_LMIP:
-                        n_image = np.empty(
-                            shape=(tmp_array.shape[0], tmp_array.shape[2]),
-                            dtype=tmp_array.dtype,
-                        )
-                        mips.fast_countour_mip(
-                            tmp_array,
-                            border_size,
-                            1,
-                            self.window_level,
-                            self.window_level,
-                            1,
-                            n_image,
-                        )
-                    elif self._type_projection == const.PROJECTION_CONTOUR_MIDA:
-                        n_image = np.empty(
-                            shape=(tmp_array.shape[0], tmp_array.shape[2]),
-                            dtype=tmp_array.dtype,
-                        )
-                        mips.fast_countour_mip(
-                            tmp_array,
-                            border_size,
-                            1,
-                            self.window_level,
-                            self.window_level,
-                            2,
-                            n_image,
-                        )
-                    else:
-                        n_image = np.array(self.matrix[:, slice_number, :])
-            elif orientation == "SAGITAL":
-                tmp_array = np.array(self.matrix[:, :, slice_number : slice_number + number_slices])
-                if np.any(self.q_orientation[1::]):
-                    transforms.apply_view_matrix_transform(
-                        self.matrix,
-                        self.spacing,
-                        M,
-                        slice_number,
-                        orientation,
-                        self.interp_method,
-                        self.matrix.min(),
-                        tmp_array,
-                    )
-
-                if self._type_projection == const.PROJECTION_NORMAL:
-                    n_image = tmp_array.reshape(dz, dy)
-                else:
-                    if inverted:
-                        tmp_array = tmp_array[:, :, ::-1]
-                    if self._type_projection == const.PROJECTION_MaxIP:
-                        n_image = np.array(tmp_array).max(2)
-                    elif self._type_projection == const.PROJECTION_MinIP:
-                        n_image = np.array(tmp_array).min(2)
-                    elif self._type_projection == const.PROJECTION_MeanIP:
-                        n_image = np.array(tmp_array).mean(2)
-                    elif self._type_projection == const.PROJECTION_LMIP:
-                        n_image = np.empty(
-                            shape=(tmp_array.shape[0], tmp_array.shape[1]),
-                            dtype=tmp_array.dtype,
-                        )
-                        mips.lmip(tmp_array, 2, self.window_level, self.window_level, n_image)
-                    elif self._type_projection == const.PROJECTION_MIDA:
-                        n_image = np.empty(
-                            shape=(tmp_array.shape[0], tmp_array.shape[1]),
-                            dtype=tmp_array.dtype,
-                        )
-                        mips.mida(tmp_array, 2, self.window_level, self.window_level, n_image)
-
-                    elif self._type_projection == const.PROJECTION_CONTOUR_MIP:
-                        n_image = np.empty(
-                            shape=(tmp_array.shape[0], tmp_array.shape[1]),
-                            dtype=tmp_array.dtype,
-                        )
-                        mips.fast_countour_mip(
-                            tmp_array,
-                            border_size,
-                            2,
-                            self.window_level,
-                            self.window_level,
-                            0,
-                            n_image,
-                        )
-                    elif self._type_projection == const.PROJECTION_CONTOUR_LMIP:
-                        n_image = np.empty(
-                            shape=(tmp_array.shape[0], tmp_array.shape[1]),
-                            dtype=tmp_array.dtype,
-                        )
-                        mips.fast_countour_mip(
-                            tmp_array,
-                            border_size,
-                            2,
-                            self.window_level,
-                            self.window_level,
-                            1,
-                            n_image,
-                        )
-                    elif self._type_projection == const.PROJECTION_CONTOUR_MIDA:
-                        n_image = np.empty(
-                            shape=(tmp_array.shape[0], tmp_array.shape[1]),
-                            dtype=tmp_array.dtype,
-                        )
-                        mips.fast_countour_mip(
-                            tmp_array,
-                            border_size,
-                            2,
-                            self.window_level,
-                            self.window_level,
-                            2,
-                            n_image,
-                        )
-                    else:
-                        n_image = np.array(self.matrix[:, :, slice_number])
-
-            self.buffer_slices[orientation].image = n_image
+        is_oblique = np.any(self.q_orientation[1::])
+
+        if not is_oblique and projection in slab_projection.INCREMENTAL_PROJECTIONS:
+            # MaxIP, MinIP and MeanIP don't depend on the slices order, so
+            # inverted is not used.
+            return self.buffer_slices[orientation].slab.project(
+                self.matrix, axis, slice_number, number_slices, projection
+            )
+
+        index = [slice(None)] * 3
+        index[axis] = slice(slice_number, slice_number + number_slices)
+        tmp_array = np.array(self.matrix[tuple(index)])
+
+        if is_oblique:
+            cx, cy, cz = self.center
+            T0 = transformations.translation_matrix((-cz, -cy, -cx))
+            R = transformations.quaternion_matrix(self.q_orientation)
+            T1 = transformations.translation_matrix((cz, cy, cx))
+            M = transformations.concatenate_matrices(T1, R.T, T0)
+            transforms.apply_view_matrix_transform(
+                self.matrix,
+                self.spacing,
+                M,
+                slice_number,
+                orientation,
+                self.interp_method,
+                self.scalar_range[0],
+                tmp_array,
+            )
+
+        plane_shape = tmp_array.shape[:axis] + tmp_array.shape[axis + 1 :]
+        if projection == const.PROJECTION_NORMAL:
+            return tmp_array.reshape(plane_shape)
+
+        if inverted:
+            tmp_array = np.flip(tmp_array, axis)
+
+        # Threads used by the mips kernels, 0 uses all of them.
+        num_threads = ses.Session().GetConfig("projection_threads", 0)
+
+        if projection == const.PROJECTION_MaxIP:
+            n_image = tmp_array.max(axis)
+        elif projection == const.PROJECTION_MinIP:
+            n_image = tmp_array.min(axis)
+        elif projection == const.PROJECTION_MeanIP:
+            n_image = tmp_array.mean(axis)
+        elif projection == const.PROJECTION_LMIP:
+            n_image = np.empty(shape=plane_shape, dtype=tmp_array.dtype)
+            mips.lmip(tmp_array, axis, self.window_level, self.window_level, n_image, num_threads)
+        elif projection == const.PROJECTION_MIDA:
+            n_image = np.empty(shape=plane_shape, dtype=tmp_array.dtype)
+            mips.mida(tmp_array, axis, self.window_level, self.window_level, n_image, num_threads)
+        elif projection in CONTOUR_PROJECTION_MODES:
+            n_image = np.empty(shape=plane_shape, dtype=tmp_array.dtype)
+            mips.fast_countour_mip(
+                tmp_array,
+                border_size,
+                axis,
+                self.window_level,
+                self.window_level,
+                CONTOUR_PROJECTION_MODES[projection],
+                n_image,
+                num_threads,
+            )
+        else:
+            n_image = np.array(slab_projection.get_plane(self.matrix, axis, slice_number))
         return n_image
 
+    def _get_slice_cache_key(self, slice_number, number_slices, inverted, border_size):
+        """
+        Everything the image slice depends on besides the image matrix and
+        the colour table (those discard the cache). The window and level are
+        part of the key of the projections that depend on them.
+        """
+        if self._type_projection == const.PROJECTION_NORMAL:
+            number_slices = 1
+            inverted = False
+            border_size = 0
+        if self._type_projection in WINDOW_LEVEL_FREE_PROJECTIONS:
+            window_level = None
+        else:
+            window_level = (self.window_width, self.window_level)
+        return (
+            slice_number,
+            number_slices,
+            inverted,
+            border_size,
+            self._type_projection,
+            self.interp_method,
+            tuple(self.q_orientation),
+            tuple(self.center),
+            window_level,
+        )
+
+    def _image_slice_to_vtk(self, n_image, orientation, slice_number):
+        image = converters.to_vtk(n_image, self.spacing, slice_number, orientation)
+        ww_wl_image = self.do_ww_wl(image)
+        return self.do_colour_image(ww_wl_image)
+
+    def _get_vtk_image_slice(self, orientation, slice_number, number_slices, inverted, border_size):
+        buffer_ = self.buffer_slices[orientation]
+        # The numpy slice is always taken because the buffer image is used
+        # by the edition tools.
+        n_image = self.get_image_slice(
+            orientation, slice_number, number_slices, inverted, border_size
+        )
+        key = self._get_slice_cache_key(slice_number, number_slices, inverted, border_size)
+        image = buffer_.get_cached_vtk_image(key)
+        if image is None:
+            image = self._image_slice_to_vtk(n_image, orientation, slice_number)
+            buffer_.cache_vtk_image(key, image)
+        return image
+
+    def _prefetch_slice(
+        self, buffer_, generation, orientation, slice_number, number_slices, inverted, border_size
+    ):
+        key = self._get_slice_cache_key(slice_number, number_slices, inverted, border_size)
+        if buffer_.generation != generation or buffer_.is_cached(key):
+            return
+        n_image = buffer_.get_cached_image(key)
+        if n_image is None:
+            n_image = self._compute_image_slice(
+                orientation, slice_number, number_slices, inverted, border_size
+            )
+            buffer_.cache_image(key, n_image, generation)
+        image = self._image_slice_to_vtk(n_image, orientation, slice_number)
+        buffer_.cache_vtk_image(key, image, generation)
+
+    def prefetch_slices(self, orientation, slice_number, number_slices, inverted, border_size):
+        """
+        Computes in background the next slices in the scroll direction, so
+        they are already in the buffer cache when the user gets there.
+        """
+        self.cancel_prefetch(orientation)
+        buffer_ = self.buffer_slices[orientation]
+        max_slice_number = self.GetMaxSliceNumber(orientation)
+        for i in range(1, const.SLICE_PREFETCH_DEPTH + 1):
+            n = slice_number + i * buffer_.direction
+            if not 0 <= n <= max_slice_number:
+                break
+            future = self._prefetch_executor.submit(
+                self._prefetch_slice,
+                buffer_,
+                buffer_.generation,
+                orientation,
+                n,
+                number_slices,
+                inverted,
+                border_size,
+            )
+            self._prefetch_futures[orientation].append(future)
+
+    def cancel_prefetch(self, orientation=None, wait=False):
+        """
+        Cancels the pending prefetches. With wait=True it also waits the one
+        being computed, needed before closing or replacing the image matrix.
+        """
+        if orientation is None:
+            orientations = list(self._prefetch_futures)
+        else:
+            orientations = [orientation]
+        running = []
+        for o in orientations:
+            for future in self._prefetch_futures[o]:
+                if not future.cancel():
+                    running.append(future)
+            self._prefetch_futures[o] = []
+        if wait and running:
+            futures.wait(running)
+
     def get_mask_slice(self, orientation, slice_number):
         """
         It gets the from actual mask the given slice from given orientation
@@ -1007,6 +1035,7 @@ class Slice(metaclass=utils.Singleton):
                     self.get_image_slice(orientation, slice_number), mask
                 )
                 self.current_mask.matrix[n, 0, 0] = 1
+                self.current_mask.update_region(slice_number, orientation)
             n_mask = np.array(
                 self.current_mask.matrix[n, 1:, 1:],
                 dtype=self.current_mask.matrix.dtype,
@@ -1019,6 +1048,7 @@ class Slice(metaclass=utils.Singleton):
                     self.get_image_slice(orientation, slice_number), mask
                 )
                 self.current_mask.matrix[0, n, 0] = 1
+                self.current_mask.update_region(slice_number, orientation)
             n_mask = np.array(
                 self.current_mask.matrix[1:, n, 1:],
                 dtype=self.current_mask.matrix.dtype,
@@ -1031,6 +1061,7 @@ class Slice(metaclass=utils.Singleton):
                     self.get_image_slice(orientation, slice_number), mask
                 )
                 self.current_mask.matrix[0, 0, n] = 1
+                self.current_mask.update_region(slice_number, orientation)
             n_mask = np.array(
                 self.current_mask.matrix[1:, 1:, n],
                 dtype=self.current_mask.matrix.dtype,
@@ -1101,6 +1132,7 @@ class Slice(metaclass=utils.Singleton):
             self.current_mask.was_edited = False
             # TODO: find out a better way to do threshold
             if slice_number is None:
+                self.current_mask.detach_project_file()
                 for n, slice_ in enumerate(self.matrix):
                     print(n)
                     m = np.ones(slice_.shape, self.current_mask.matrix.dtype)
@@ -1108,6 +1140,7 @@ class Slice(metaclass=utils.Singleton):
                     m[slice_ > thresh_max] = 0
                     m[m == 1] = 255
                     self.current_mask.matrix[n + 1, 1:, 1:] = m
+                self.current_mask.mark_dirty()
             else:
                 slice_ = self.buffer_slices[orientation].image
                 if slice_ is not None:
@@ -1201,6 +1234,22 @@ class Slice(metaclass=utils.Singleton):
             surface_parameters=surface_parameters,
         )
 
+    def CreateSurfacesFromMasks(self, mask_indexes, surface_parameters):
+        """
+        Creates one surface per mask in a single pass, see
+        SurfaceManager.AddNewActors.
+        """
+        proj = Project()
+        masks = [proj.mask_dict[index] for index in mask_indexes]
+        for mask in masks:
+            self.do_threshold_to_all_slices(mask)
+        Publisher.sendMessage(
+            "Create surfaces",
+            slice_=self,
+            masks=masks,
+            surface_parameters=surface_parameters,
+        )
+
     def GetOutput(self):
         return self.blend_filter.GetOutput()
 
@@ -1238,13 +1287,7 @@ class Slice(metaclass=utils.Singleton):
         self.window_level = level
 
         for buffer_ in self.buffer_slices.values():
-            if self._type_projection in (
-                const.PROJECTION_NORMAL,
-                const.PROJECTION_MaxIP,
-                const.PROJECTION_MinIP,
-                const.PROJECTION_MeanIP,
-                const.PROJECTION_LMIP,
-            ):
+            if self._type_projection in WINDOW_LEVEL_FREE_PROJECTIONS:
                 buffer_.discard_vtk_image()
             else:
                 buffer_.discard_buffer()
@@ -1273,13 +1316,7 @@ class Slice(metaclass=utils.Singleton):
         self.nodes = nodes
         self.from_ = WIDGET
         for buffer_ in self.buffer_slices.values():
-            if self._type_projection in (
-                const.PROJECTION_NORMAL,
-                const.PROJECTION_MaxIP,
-                const.PROJECTION_MinIP,
-                const.PROJECTION_MeanIP,
-                const.PROJECTION_LMIP,
-            ):
+            if self._type_projection in WINDOW_LEVEL_FREE_PROJECTIONS:
                 buffer_.discard_vtk_image()
             else:
                 buffer_.discard_buffer()
@@ -1477,12 +1514,35 @@ class Slice(metaclass=utils.Singleton):
         """
         if mask is None:
             mask = self.current_mask
-        for n in range(1, mask.matrix.shape[0]):
-            if mask.matrix[n, 0, 0] == 0:
-                m = mask.matrix[n, 1:, 1:]
-                mask.matrix[n, 1:, 1:] = self.do_threshold_to_a_slice(
-                    self.matrix[n - 1], m, mask.threshold_range
-                )
+        thresh_min, thresh_max = mask.threshold_range
+        to_do = np.flatnonzero(mask.matrix[1:, 0, 0] == 0)
+        if not to_do.size:
+            return
+        # Thresholding the whole mask in the copy-on-write mapping of the
+        # project file would keep all of it in memory.
+        mask.detach_project_file()
+        if self.matrix.dtype in THRESHOLD_KERNEL_DTYPES:
+            threshold.threshold_volume(
+                self.matrix,
+                mask.matrix,
+                thresh_min,
+                thresh_max,
+                ses.Session().GetConfig("threshold_threads", 0),
+            )
+            mask.mark_dirty(to_do)
+        else:
+            # Same as the kernel, by slabs of slices.
+            for z, slab in iu.iter_slabs(self.matrix):
+                m = mask.matrix[z + 1 : z + slab.shape[0] + 1]
+                slab_to_do = m[:, 0, 0] == 0
+                if not slab_to_do.any():
+                    continue
+                m_slab = m[slab_to_do, 1:, 1:]
+                edited = np.isin(m_slab, (1, 2, 253, 254))
+                selected = (slab[slab_to_do] >= thresh_min) & (slab[slab_to_do] <= thresh_max)
+                m[slab_to_do, 1:, 1:] = np.where(edited, m_slab, selected * np.uint8(255))
+                m[slab_to_do, 0, 0] = 1
+                mask.mark_dirty(np.flatnonzero(slab_to_do) + z)
 
         mask.matrix.flush()
 
@@ -1492,7 +1552,7 @@ class Slice(metaclass=utils.Singleton):
         else:
             # map scalar values into colors
             _min, _max = iu.get_LUT_value_255(
-                np.array((self.matrix.min(), self.matrix.max())),
+                np.array(self.scalar_range),
                 self.window_width,
                 self.window_level,
             )
@@ -1612,14 +1672,29 @@ class Slice(metaclass=utils.Singleton):
         future_mask.spacing = self.spacing
         future_mask.name = new_name
 
-        future_mask.matrix[:] = 1
-        m = future_mask.matrix[1:, 1:, 1:]
+        # The new mask is zeroed, only the flags are set and the operation is
+        # done only in the region of the masks that can have selected voxels.
+        future_mask.matrix[0, :, :] = 1
+        future_mask.matrix[:, 0, :] = 1
+        future_mask.matrix[:, :, 0] = 1
 
         self.do_threshold_to_all_slices(m1)
-        m1 = m1.matrix[1:, 1:, 1:]
-
         self.do_threshold_to_all_slices(m2)
-        m2 = m2.matrix[1:, 1:, 1:]
+
+        region1 = m1.get_region()
+        region2 = m2.get_region()
+        if op in (const.BOOLEAN_UNION, const.BOOLEAN_XOR):
+            region = _union_region(region1, region2)
+        elif op == const.BOOLEAN_DIFF:
+            region = region1
+        else:
+            region = _intersection_region(region1, region2)
+        if region is None:
+            region = (slice(0, 0),) * 3
+
+        m = future_mask.matrix[1:, 1:, 1:][region]
+        m1 = m1.matrix[1:, 1:, 1:][region]
+        m2 = m2.matrix[1:, 1:, 1:][region]
 
         if op == const.BOOLEAN_UNION:
             m[:] = ((m1 > 2) + (m2 > 2)) * 255
@@ -1675,6 +1750,7 @@ class Slice(metaclass=utils.Singleton):
             self.current_mask.matrix[1:, 1:, index + 1] = b_mask
             self.current_mask.matrix[0, 0, index + 1] = 2
 
+        self.current_mask.update_region(index, orientation)
         self.current_mask.save_history(index, orientation, b_mask, p_mask)
         self.current_mask.was_edited = True
 
@@ -1685,6 +1761,8 @@ class Slice(metaclass=utils.Singleton):
         Publisher.sendMessage("Reload actual slice")
 
     def apply_reorientation(self):
+        self.detach_project_file()
+        Project().matrix_version += 1
         temp_fd, temp_file = tempfile.mkstemp()
         mcopy = np.memmap(temp_file, shape=self.matrix.shape, dtype=self.matrix.dtype, mode="w+")
         mcopy[:] = self.matrix
@@ -1709,13 +1787,16 @@ class Slice(metaclass=utils.Singleton):
         del mcopy
         os.close(temp_fd)
         os.remove(temp_file)
+        self.scalar_range = iu.chunked_min_max(self.matrix)
 
         self.q_orientation = np.array((1, 0, 0, 0))
         self.center = [(s * d / 2.0) for (d, s) in zip(self.matrix.shape[::-1], self.spacing)]
 
         self.__clean_current_mask()
         if self.current_mask:
+            self.current_mask.detach_project_file()
             self.current_mask.matrix[:] = 0
+            self.current_mask.mark_dirty()
             self.current_mask.was_edited = False
 
         for o in self.buffer_slices:
@@ -1751,11 +1832,41 @@ class Slice(metaclass=utils.Singleton):
             self.buffer_slices[o].discard_vtk_mask()
         Publisher.sendMessage("Reload actual slice")
 
-    def _open_image_matrix(self, filename, shape, dtype):
+    def _open_image_matrix(self, filename, shape, dtype, offset=0):
         self.matrix_filename = filename
-        self.matrix = np.memmap(filename, shape=shape, dtype=dtype, mode="r+")
+        if offset:
+            # The matrix is inside the project file (see
+            # Project.OpenPlistProject), it's never written there.
+            self.matrix = np.memmap(filename, shape=shape, dtype=dtype, mode="c", offset=offset)
+        else:
+            self.matrix = np.memmap(filename, shape=shape, dtype=dtype, mode="r+")
+
+    def detach_project_file(self):
+        """
+        Copies the image matrix mapped from the project file to a temp file.
+        It's necessary before the matrix is changed and before the project
+        file is overwritten.
+        """
+        if self._matrix is None or self._matrix.mode != "c":
+            return
+        temp_fd, temp_file = tempfile.mkstemp()
+        os.close(temp_fd)
+        matrix = np.memmap(temp_file, shape=self._matrix.shape, dtype=self._matrix.dtype, mode="w+")
+        matrix[:] = self._matrix
+        matrix.flush()
+        self.cancel_prefetch(wait=True)
+        self._matrix._mmap.close()
+        self._matrix = matrix
+        self.matrix_filename = temp_file
+
+        proj = Project()
+        proj.matrix_filename = temp_file
+        proj.matrix_offset = 0
+        proj.matrix_shape = matrix.shape
 
     def OnFlipVolume(self, axis):
+        self.detach_project_file()
+        Project().matrix_version += 1
         if axis == 0:
             self.matrix[:] = self.matrix[::-1]
         elif axis == 1:
@@ -1814,7 +1925,10 @@ class Slice(metaclass=utils.Singleton):
         if mask is None:
             mask = self.current_mask
         self.do_threshold_to_all_slices(mask)
-        values = self.matrix[mask.matrix[1:, 1:, 1:] > 127]
+        region = mask.get_region()
+        if region is None:
+            return 0, 0, 0, 0
+        values = self.matrix[region][mask.matrix[1:, 1:, 1:][region] > 127]
 
         if len(values):
             _min = values.min()
@@ -1830,7 +1944,11 @@ class Slice(metaclass=utils.Singleton):
             mask = self.current_mask
 
         self.do_threshold_to_all_slices(mask)
-        bin_img = mask.matrix[1:, 1:, 1:] > 127
+        # One voxel of margin, the neighbours of the border voxels are used.
+        region = mask.get_region(margin=1)
+        if region is None:
+            return 0.0
+        bin_img = mask.matrix[1:, 1:, 1:][region] > 127
 
         sx, sy, sz = self.spacing
 
@@ -1854,6 +1972,31 @@ class Slice(metaclass=utils.Singleton):
         return not np.allclose(self.affine, np.eye(4))
 
 
+def _union_region(region1, region2):
+    """
+    The smallest region (tuple of slices, see Mask.get_region) containing
+    both regions.
+    """
+    if region1 is None:
+        return region2
+    if region2 is None:
+        return region1
+    return tuple(
+        slice(min(r1.start, r2.start), max(r1.stop, r2.stop)) for r1, r2 in zip(region1, region2)
+    )
+
+
+def _intersection_region(region1, region2):
+    if region1 is None or region2 is None:
+        return None
+    region = tuple(
+        slice(max(r1.start, r2.start), min(r1.stop, r2.stop)) for r1, r2 in zip(region1, region2)
+    )
+    if any(r.start >= r.stop for r in region):
+        return None
+    return region
+
+
 def _conv_area(x: np.ndarray, sx: float, sy: float, sz: float) -> float:
     x = x.reshape((3, 3, 3))
     if x[1, 1, 1]:
@@ -1466,7 +1466,10 @@ class EditorInteractorStyle(DefaultInteractorStyle):
         self.viewer._flush_buffer = True
         self.viewer.slice_.apply_slice_buffer_to_mask(self.orientation)
         self.viewer._flush_buffer = False
-        self.viewer.slice_.current_mask.modified()
+        self.viewer.slice_.current_mask.modified(
+            index=self.viewer.slice_.buffer_slices[self.orientation].index,
+            orientation=self.orientation,
+        )
 
     def EOnScrollForward(self, evt, obj):
         iren = self.viewer.interactor
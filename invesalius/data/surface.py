@@ -18,6 +18,7 @@
 # --------------------------------------------------------------------------
 
 import functools
+import math
 import multiprocessing
 import os
 import plistlib
@@ -77,13 +78,71 @@ import invesalius.data.vtk_utils as vtk_utils
 import invesalius.project as prj
 import invesalius.session as ses
 import invesalius.utils as utl
-from invesalius.data.converters import convert_custom_bin_to_vtk
+from invesalius.data.converters import arrays_to_polydata, convert_custom_bin_to_vtk
 from invesalius.gui import dialogs
 from invesalius.i18n import tr as _
 from invesalius_cy import cy_mesh
 
 # TODO: Verificar ReleaseDataFlagOn and SetSource
 
+# The volume is split in about PIECES_PER_PROCESS pieces per surface worker,
+# so the work is balanced when some pieces have more surface than others,
+# each piece having at least MIN_PIECE_SIZE slices.
+PIECES_PER_PROCESS = 2
+MIN_PIECE_SIZE = 8
+
+
+def get_piece_size(n_slices, n_processes):
+    return max(MIN_PIECE_SIZE, math.ceil(n_slices / (n_processes * PIECES_PER_PROCESS)))
+
+
+def create_label_volumes(masks, shape, max_bytes=64 * 1024**2):
+    """
+    Writes the masks (not empty) as labels (1, 2, ...) of label volumes
+    (temp memmaps with the given shape) to create their surfaces at once.
+    Each voxel has only one label, so a mask overlapping the masks already
+    written in a volume goes to a new one. Returns a list of (label_volume,
+    {label: mask}).
+    """
+    dtype = np.uint8 if len(masks) < 256 else np.uint16
+    n_slices = max(1, max_bytes // (shape[1] * shape[2]))
+    label_volumes = []
+    for mask in masks:
+        # Only the region of the mask with selected voxels is read.
+        z_range, y_range, x_range = mask.get_region()
+        for label_volume, labels in label_volumes:
+            overlaps = False
+            for z in range(z_range.start, z_range.stop, n_slices):
+                z_end = min(z + n_slices, z_range.stop)
+                selected = mask.matrix[z + 1 : z_end + 1, 1:, 1:][:, y_range, x_range] > 127
+                if np.any(label_volume[z:z_end][:, y_range, x_range][selected]):
+                    overlaps = True
+                    break
+            if not overlaps:
+                break
+        else:
+            fd, filename = tempfile.mkstemp(suffix="_labels")
+            os.close(fd)
+            label_volume = np.memmap(filename, shape=shape, dtype=dtype, mode="w+")
+            labels = {}
+            label_volumes.append((label_volume, labels))
+
+        label = len(labels) + 1
+        labels[label] = mask
+        for z in range(z_range.start, z_range.stop, n_slices):
+            z_end = min(z + n_slices, z_range.stop)
+            slab = label_volume[z:z_end][:, y_range, x_range]
+            slab[mask.matrix[z + 1 : z_end + 1, 1:, 1:][:, y_range, x_range] > 127] = label
+        label_volume.flush()
+    return label_volumes
+
+
+def remove_label_volume(label_volume):
+    try:
+        os.remove(label_volume.filename)
+    except OSError:
+        pass
+
 
 class Surface:
     """
@@ -187,6 +246,11 @@ class SurfaceManager:
         self.actors_dict = {}
         self.last_surface_index = 0
         self.convert_to_inv = None
+
+        self._pool = None
+        self._manager = None
+        self._msg_queue = None
+
         self.__bind_events()
 
         self._default_parameters = {
@@ -210,6 +274,7 @@ class SurfaceManager:
 
     def __bind_events(self):
         Publisher.subscribe(self.AddNewActor, "Create surface")
+        Publisher.subscribe(self.AddNewActors, "Create surfaces")
         Publisher.subscribe(self.GetActor, "Get Actor")
         Publisher.subscribe(self.SetActorTransparency, "Set surface transparency")
         Publisher.subscribe(self.SetActorColour, "Set surface colour")
@@ -236,6 +301,7 @@ class SurfaceManager:
         Publisher.subscribe(self.UpdateConvertToInvFlag, "Update convert_to_inv flag")
 
         Publisher.subscribe(self.CreateSurfaceFromPolydata, "Create surface from polydata")
+        Publisher.subscribe(self._Exit, "Exit")
 
     def OnDuplicate(self, surface_indexes):
         proj = prj.Project()
@@ -751,10 +817,10 @@ class SurfaceManager:
     # (mask_index, surface_name, quality, fill_holes, keep_largest)
 
     def _on_complete_surface_creation(self, args, overwrite, surface_name, colour, dialog):
-        surface_filename, surface_measures = args
+        surface_arrays, surface_measures = args
         wx.CallAfter(
             self._show_surface,
-            surface_filename,
+            surface_arrays,
             surface_measures,
             overwrite,
             surface_name,
@@ -763,13 +829,11 @@ class SurfaceManager:
         )
 
     def _show_surface(
-        self, surface_filename, surface_measures, overwrite, surface_name, colour, dialog
+        self, surface_arrays, surface_measures, overwrite, surface_name, colour, dialog
     ):
-        print(surface_filename, surface_measures)
-        reader = vtkXMLPolyDataReader()
-        reader.SetFileName(surface_filename)
-        reader.Update()
-        polydata = reader.GetOutput()
+        print(surface_measures)
+        polydata = arrays_to_polydata(surface_arrays)
+        del surface_arrays
 
         # Map polygonal data (vtkPolyData) to graphics primitives.
         mapper = vtkPolyDataMapper()
@@ -838,7 +902,8 @@ class SurfaceManager:
         """
         Create surface actor, save into project and send it to viewer.
         """
-        if mask.matrix.max() < 127:
+        region = mask.get_region()
+        if region is None:
             wx.MessageBox(
                 _(
                     "It's not possible to create a surface because there is not any voxel selected on mask"
@@ -851,6 +916,9 @@ class SurfaceManager:
         filename_img = slice_.matrix_filename
         spacing = slice_.spacing
 
+        # The worker processes read the mask file, so the changes of a mask
+        # mapped from the project file must be in a file.
+        mask.detach_project_file()
         mask_temp_file = mask.temp_file
         mask_shape = mask.matrix.shape
         mask_dtype = mask.matrix.dtype
@@ -895,6 +963,8 @@ class SurfaceManager:
 
         session = ses.Session()
         language = session.GetConfig("language")
+        # Threads used by the context aware smoothing (0 uses all).
+        num_threads = session.GetConfig("surface_threads", 0)
 
         if prj.Project().original_orientation == const.CORONAL:
             flip_image = False
@@ -911,62 +981,69 @@ class SurfaceManager:
             mask_shape = mask.shape
             mask_dtype = mask.dtype
 
+        # Not 0 when the image is mapped from the project file.
+        image_offset = getattr(matrix, "offset", 0)
+
         n_processors = multiprocessing.cpu_count()
 
-        o_piece = 1
-        piece_size = 20
+        from_binary = algorithm != "Default"
+        z_start, z_stop = 0, matrix.shape[0]
+        if from_binary and imagedata_resolution <= 0:
+            # Only the slices with selected voxels plus an empty one at each
+            # side, to close the surface.
+            z_start = max(0, region[0].start - 1)
+            z_stop = min(matrix.shape[0], region[0].stop + 1)
 
-        n_pieces = int(round(matrix.shape[0] / piece_size + 0.5, 0))
+        o_piece = 1
+        piece_size = get_piece_size(z_stop - z_start, n_processors)
+        n_pieces = math.ceil((z_stop - z_start) / piece_size)
 
-        filenames = []
-        ctx = multiprocessing.get_context("spawn")
-        pool = ctx.Pool(processes=min(n_pieces, n_processors))
-        manager = multiprocessing.Manager()
-        msg_queue = manager.Queue(1)
+        pool, msg_queue = self._get_pool()
 
         print("Resolution", imagedata_resolution)
 
-        # If InVesalius is running without GUI
-        if wx.GetApp() is None:
-            for i in range(n_pieces):
-                init = i * piece_size
-                end = init + piece_size + o_piece
-                roi = slice(init, end)
-                print("new_piece", roi)
-                f = pool.apply_async(
-                    surface_process.create_surface_piece,
-                    args=(
-                        filename_img,
-                        matrix.shape,
-                        matrix.dtype,
-                        mask_temp_file,
-                        mask_shape,
-                        mask_dtype,
-                        roi,
-                        spacing,
-                        mode,
-                        min_value,
-                        max_value,
-                        decimate_reduction,
-                        smooth_relaxation_factor,
-                        smooth_iterations,
-                        language,
-                        flip_image,
-                        algorithm != "Default",
-                        algorithm,
-                        imagedata_resolution,
-                        fill_border_holes,
-                    ),
-                    callback=lambda x: filenames.append(x),
+        pieces_args = []
+        for i in range(n_pieces):
+            init = z_start + i * piece_size
+            end = min(init + piece_size + o_piece, z_stop)
+            roi = slice(init, end)
+            print("new_piece", roi)
+            pieces_args.append(
+                (
+                    filename_img,
+                    matrix.shape,
+                    matrix.dtype,
+                    mask_temp_file,
+                    mask_shape,
+                    mask_dtype,
+                    roi,
+                    spacing,
+                    mode,
+                    min_value,
+                    max_value,
+                    decimate_reduction,
+                    smooth_relaxation_factor,
+                    smooth_iterations,
+                    language,
+                    flip_image,
+                    from_binary,
+                    algorithm,
+                    imagedata_resolution,
+                    fill_border_holes,
+                    image_offset,
                 )
+            )
 
-            while len(filenames) != n_pieces:
-                time.sleep(0.25)
+        # If InVesalius is running without GUI
+        if wx.GetApp() is None:
+            # The pieces are returned in order, so the seams are merged
+            # always the same way.
+            pieces = pool.starmap(surface_process.create_surface_piece, pieces_args)
 
             f = pool.apply_async(
                 surface_process.join_process_surface,
                 args=(
-                    filenames,
+                    pieces,
                     algorithm,
                     smooth_iterations,
                     smooth_relaxation_factor,
@@ -975,89 +1052,42 @@ class SurfaceManager:
                     fill_holes,
                     options,
                     msg_queue,
+                    num_threads,
                 ),
             )
-
-            while not f.ready():
-                time.sleep(0.25)
+            del pieces
 
             try:
-                surface_filename, surface_measures = f.get()
+                surface_arrays, surface_measures = f.get()
             except Exception as e:
                 print(_("InVesalius was not able to create the surface"))
                 print(traceback.print_exc())
                 return
 
-            reader = vtkXMLPolyDataReader()
-            reader.SetFileName(surface_filename)
-            reader.Update()
-
-            polydata = reader.GetOutput()
-
-            proj = prj.Project()
-            # Create Surface instance
-            if overwrite:
-                surface = Surface(index=self.last_surface_index)
-                proj.ChangeSurface(surface)
-            else:
-                surface = Surface(name=surface_name)
-                index = proj.AddSurface(surface)
-                surface.index = index
-                self.last_surface_index = index
-
-            surface.colour = colour
-            surface.polydata = polydata
-            surface.volume = surface_measures["volume"]
-            surface.area = surface_measures["area"]
+            self._add_surface(surface_arrays, surface_measures, overwrite, surface_name, colour)
+            del surface_arrays
 
         # With GUI
         else:
             sp = dialogs.SurfaceProgressWindow()
-            for i in range(n_pieces):
-                init = i * piece_size
-                end = init + piece_size + o_piece
-                roi = slice(init, end)
-                print("new_piece", roi)
-                f = pool.apply_async(
-                    surface_process.create_surface_piece,
-                    args=(
-                        filename_img,
-                        matrix.shape,
-                        matrix.dtype,
-                        mask_temp_file,
-                        mask_shape,
-                        mask_dtype,
-                        roi,
-                        spacing,
-                        mode,
-                        min_value,
-                        max_value,
-                        decimate_reduction,
-                        smooth_relaxation_factor,
-                        smooth_iterations,
-                        language,
-                        flip_image,
-                        algorithm != "Default",
-                        algorithm,
-                        imagedata_resolution,
-                        fill_border_holes,
-                    ),
-                    callback=lambda x: filenames.append(x),
-                    error_callback=functools.partial(self._on_callback_error, dialog=sp),
-                )
+            pieces_result = pool.starmap_async(
+                surface_process.create_surface_piece,
+                pieces_args,
+                error_callback=functools.partial(self._on_callback_error, dialog=sp),
+            )
 
-            while len(filenames) != n_pieces:
+            while not pieces_result.ready():
                 if sp.WasCancelled() or not sp.running:
                     break
-                time.sleep(0.25)
+                pieces_result.wait(0.1)
                 sp.Update(_("Creating 3D surface..."))
                 wx.Yield()
 
-            if not sp.WasCancelled() or sp.running:
+            if pieces_result.ready() and pieces_result.successful() and not sp.WasCancelled():
                 f = pool.apply_async(
                     surface_process.join_process_surface,
                     args=(
-                        filenames,
+                        pieces_result.get(),
                         algorithm,
                         smooth_iterations,
                         smooth_relaxation_factor,
@@ -1066,6 +1096,7 @@ class SurfaceManager:
                         fill_holes,
                         options,
                         msg_queue,
+                        num_threads,
                     ),
                     callback=functools.partial(
                         self._on_complete_surface_creation,
@@ -1080,13 +1111,18 @@ class SurfaceManager:
                 while sp.running:
                     if sp.WasCancelled():
                         break
-                    time.sleep(0.25)
+                    f.wait(0.1)
                     try:
                         msg = msg_queue.get_nowait()
                         sp.Update(msg)
                     except:
                         sp.Update(None)
                     wx.Yield()
+            del pieces_result
+
+            if sp.WasCancelled():
+                # The workers may still be working on the surface.
+                self._close_pool()
 
             t_end = time.time()
             print("Elapsed time - {}".format(t_end - t_init))
@@ -1096,18 +1132,259 @@ class SurfaceManager:
                 dlg.ShowModal()
             del sp
 
-        pool.close()
-        try:
-            pool.terminate()
-        except AssertionError:
-            pass
-        del pool
-        del manager
-        del msg_queue
         import gc
 
         gc.collect()
 
+    def _add_surface(self, surface_arrays, surface_measures, overwrite, surface_name, colour):
+        """
+        Adds the surface to the project without creating its actor, used when
+        InVesalius is running without GUI.
+        """
+        polydata = arrays_to_polydata(surface_arrays)
+
+        proj = prj.Project()
+        # Create Surface instance
+        if overwrite:
+            surface = Surface(index=self.last_surface_index)
+            proj.ChangeSurface(surface)
+        else:
+            surface = Surface(name=surface_name)
+            index = proj.AddSurface(surface)
+            surface.index = index
+            self.last_surface_index = index
+
+        surface.colour = colour
+        surface.polydata = polydata
+        surface.volume = surface_measures["volume"]
+        surface.area = surface_measures["area"]
+        return surface
+
+    def AddNewActors(self, slice_, masks, surface_parameters):
+        """
+        Creates one surface per mask walking the volume only once: the masks
+        are written as labels of a label volume and all surfaces are
+        extracted at once with discrete flying edges, sharing the surface
+        workers. The surface options (index, name and overwrite aside) are
+        the same for all surfaces.
+        """
+        masks = [mask for mask in masks if mask.get_region() is not None]
+        if not masks:
+            if wx.GetApp() is None:
+                print(
+                    "It's not possible to create the surfaces because there is not any voxel selected on the masks"
+                )
+            else:
+                wx.MessageBox(
+                    _(
+                        "It's not possible to create the surfaces because there is not any voxel selected on the masks"
+                    ),
+                    _("Create surface warning"),
+                )
+            return
+        t_init = time.time()
+        spacing = slice_.spacing
+        shape = slice_.matrix.shape
+
+        algorithm = surface_parameters["method"]["algorithm"]
+        options = surface_parameters["method"]["options"]
+
+        quality = surface_parameters["options"]["quality"]
+        fill_holes = surface_parameters["options"]["fill"]
+        keep_largest = surface_parameters["options"]["keep_largest"]
+        fill_border_holes = surface_parameters["options"].get("fill_border_holes", True)
+
+        (
+            imagedata_resolution,
+            smooth_iterations,
+            smooth_relaxation_factor,
+            decimate_reduction,
+        ) = const.SURFACE_QUALITY[quality]
+
+        label_volumes = create_label_volumes(masks, shape)
+        # Only the slices with selected voxels plus an empty one at each side.
+        z_ranges = [mask.get_region()[0] for mask in masks]
+        z_start = max(0, min(r.start for r in z_ranges) - 1)
+        z_stop = min(shape[0], max(r.stop for r in z_ranges) + 1)
+        if imagedata_resolution > 0:
+            spacing = tuple([s * imagedata_resolution for s in spacing])
+            resized_volumes = []
+            for label_volume, labels in label_volumes:
+                resized = iu.resize_image_array(
+                    label_volume, 1.0 / imagedata_resolution, True, order=0
+                )
+                remove_label_volume(label_volume)
+                resized_volumes.append((resized, labels))
+            label_volumes = resized_volumes
+            z_start, z_stop = 0, label_volumes[0][0].shape[0]
+
+        pool, msg_queue = self._get_pool()
+
+        # One task per piece of each label volume, each one creating the
+        # pieces of the surfaces of all labels in that volume.
+        pieces_args = []
+        pieces_volume = []
+        for n, (label_volume, labels) in enumerate(label_volumes):
+            piece_size = get_piece_size(z_stop - z_start, multiprocessing.cpu_count())
+            for init in range(z_start, z_stop, piece_size):
+                roi = slice(init, min(init + piece_size + 1, z_stop))
+                pieces_args.append(
+                    (
+                        label_volume.filename,
+                        label_volume.shape,
+                        label_volume.dtype,
+                        list(labels),
+                        roi,
+                        spacing,
+                        fill_border_holes,
+                    )
+                )
+                pieces_volume.append(n)
+
+        def join_args(label_pieces):
+            surfaces_pieces = {}
+            for n, pieces in zip(pieces_volume, label_pieces):
+                for label, piece in pieces.items():
+                    surfaces_pieces.setdefault((n, label), []).append(piece)
+            surfaces = []
+            args = []
+            for n, (label_volume, labels) in enumerate(label_volumes):
+                for label, mask in labels.items():
+                    if (n, label) in surfaces_pieces:
+                        surfaces.append(mask)
+                        args.append(
+                            (
+                                surfaces_pieces.pop((n, label)),
+                                algorithm,
+                                smooth_iterations,
+                                smooth_relaxation_factor,
+                                decimate_reduction,
+                                keep_largest,
+                                fill_holes,
+                                options,
+                                msg_queue,
+                            )
+                        )
+            # The surfaces are joined at the same time, so the threads
+            # are split among them.
+            num_threads = ses.Session().GetConfig("surface_threads", 0)
+            if not num_threads:
+                num_threads = max(1, multiprocessing.cpu_count() // max(1, len(args)))
+            args = [arg + (num_threads,) for arg in args]
+            return surfaces, args
+
+        try:
+            # If InVesalius is running without GUI
+            if wx.GetApp() is None:
+                label_pieces = pool.starmap(
+                    surface_process.create_label_surface_piece, pieces_args
+                )
+                surface_masks, args = join_args(label_pieces)
+                del label_pieces
+                try:
+                    results = pool.starmap(surface_process.join_process_surface, args)
+                except Exception:
+                    print(_("InVesalius was not able to create the surface"))
+                    traceback.print_exc()
+                    return
+                del args
+                for mask, (surface_arrays, surface_measures) in zip(surface_masks, results):
+                    self._add_surface(
+                        surface_arrays, surface_measures, False, mask.name, mask.colour[:3]
+                    )
+            # With GUI
+            else:
+                sp = dialogs.SurfaceProgressWindow()
+                result = pool.starmap_async(
+                    surface_process.create_label_surface_piece,
+                    pieces_args,
+                    error_callback=functools.partial(self._on_callback_error, dialog=sp),
+                )
+                surface_masks = None
+                while not sp.WasCancelled() and sp.running:
+                    result.wait(0.1)
+                    if result.ready():
+                        if not result.successful():
+                            break
+                        if surface_masks is not None:
+                            for mask, (surface_arrays, surface_measures) in zip(
+                                surface_masks, result.get()
+                            ):
+                                self._show_surface(
+                                    surface_arrays,
+                                    surface_measures,
+                                    False,
+                                    mask.name,
+                                    mask.colour[:3],
+                                    sp,
+                                )
+                            break
+                        surface_masks, args = join_args(result.get())
+                        result = pool.starmap_async(
+                            surface_process.join_process_surface,
+                            args,
+                            error_callback=functools.partial(self._on_callback_error, dialog=sp),
+                        )
+                        del args
+                    try:
+                        msg = msg_queue.get_nowait()
+                        sp.Update(msg)
+                    except queue.Empty:
+                        sp.Update(_("Creating 3D surface..."))
+                    wx.Yield()
+                del result
+
+                if sp.WasCancelled():
+                    # The workers may still be working on the surfaces.
+                    self._close_pool()
+
+                sp.Close()
+                if sp.error:
+                    dlg = GMD.GenericMessageDialog(
+                        None, sp.error, "Exception!", wx.OK | wx.ICON_ERROR
+                    )
+                    dlg.ShowModal()
+                del sp
+        finally:
+            for label_volume, labels in label_volumes:
+                remove_label_volume(label_volume)
+
+        print("Elapsed time - {}".format(time.time() - t_init))
+
+    def _get_pool(self):
+        """
+        Returns the pool of surface workers and the queue used by them to
+        send progress messages. The pool is started the first time a surface
+        is created and reused by the next ones.
+        """
+        if self._pool is None:
+            ctx = multiprocessing.get_context("spawn")
+            self._pool = ctx.Pool(processes=multiprocessing.cpu_count())
+            self._manager = ctx.Manager()
+            self._msg_queue = self._manager.Queue(1)
+        else:
+            # Messages left by the last surface creation.
+            try:
+                while True:
+                    self._msg_queue.get_nowait()
+            except queue.Empty:
+                pass
+        return self._pool, self._msg_queue
+
+    def _close_pool(self):
+        if self._pool is not None:
+            try:
+                self._pool.terminate()
+            except AssertionError:
+                pass
+            self._manager.shutdown()
+            self._pool = None
+            self._manager = None
+            self._msg_queue = None
+
+    def _Exit(self):
+        self._close_pool()
+
     def GetActor(self, surface_index):
         Publisher.sendMessage("Send Actor", e_field_actor=self.actors_dict[surface_index])
 
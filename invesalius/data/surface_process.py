@@ -8,20 +8,22 @@ except ImportError:
     import Queue as queue
 
 import numpy
+from vtkmodules.util import numpy_support
 from vtkmodules.vtkCommonCore import vtkFileOutputWindow, vtkOutputWindow
 from vtkmodules.vtkFiltersCore import (
     vtkAppendPolyData,
     vtkCleanPolyData,
     vtkContourFilter,
+    vtkFlyingEdges3D,
     vtkMassProperties,
     vtkPolyDataConnectivityFilter,
     vtkPolyDataNormals,
     vtkQuadricDecimation,
 )
+from vtkmodules.vtkFiltersGeneral import vtkDiscreteFlyingEdges3D
 from vtkmodules.vtkFiltersModeling import vtkFillHolesFilter
 from vtkmodules.vtkImagingCore import vtkImageFlip, vtkImageResample
 from vtkmodules.vtkImagingGeneral import vtkImageGaussianSmooth
-from vtkmodules.vtkIOXML import vtkXMLPolyDataReader, vtkXMLPolyDataWriter
 
 import invesalius.data.converters as converters
 from invesalius.i18n import tr as _
@@ -90,6 +92,7 @@ def create_surface_piece(
     algorithm,
     imagedata_resolution,
     fill_border_holes,
+    image_offset=0,
 ):
     log_fd, log_path = tempfile.mkstemp("vtkoutput.txt")
     fow = vtkFileOutputWindow()
@@ -115,7 +118,7 @@ def create_surface_piece(
         image = converters.to_vtk(a_mask, spacing, roi.start, "AXIAL", padding=padding)
         del a_mask
     else:
-        image = numpy.memmap(filename, mode="r", dtype=dtype, shape=shape)
+        image = numpy.memmap(filename, mode="r", dtype=dtype, shape=shape, offset=image_offset)
         mask = numpy.memmap(mask_filename, mode="r", dtype=mask_dtype, shape=mask_shape)
         if fill_border_holes:
             a_image = pad_image(image[roi], numpy.iinfo(image.dtype).min, pad_bottom, pad_top)
@@ -154,53 +157,301 @@ def create_surface_piece(
     #  if imagedata_resolution:
     #  image = ResampleImage3D(image, imagedata_resolution)
 
-    flip = vtkImageFlip()
-    flip.SetInputData(image)
-    flip.SetFilteredAxis(1)
-    flip.FlipAboutOriginOn()
-    flip.ReleaseDataFlagOn()
-    flip.Update()
-
-    #  writer = vtkXMLImageDataWriter()
-    #  writer.SetFileName('/tmp/camboja.vti')
-    #  writer.SetInputData(flip.GetOutput())
-    #  writer.Write()
+    if algorithm == "flying_edges":
+        # The image is not flipped, the flip is applied to the output points
+        # (flip_points) to avoid copying the image.
+        contour = vtkFlyingEdges3D()
+        contour.SetInputData(image)
+        contour.SetValue(0, 127)
+        contour.ComputeNormalsOff()
+        contour.ComputeGradientsOff()
+        contour.ComputeScalarsOff()
+        contour.Update()
+        flip_points = True
+    else:
+        flip = vtkImageFlip()
+        flip.SetInputData(image)
+        flip.SetFilteredAxis(1)
+        flip.FlipAboutOriginOn()
+        flip.ReleaseDataFlagOn()
+        flip.Update()
+
+        #  writer = vtkXMLImageDataWriter()
+        #  writer.SetFileName('/tmp/camboja.vti')
+        #  writer.SetInputData(flip.GetOutput())
+        #  writer.Write()
+
+        del image
+        image = flip.GetOutput()
+        del flip
+
+        contour = vtkContourFilter()
+        contour.SetInputData(image)
+        if from_binary:
+            contour.SetValue(0, 127)  # initial threshold
+        else:
+            contour.SetValue(0, min_value)  # initial threshold
+            contour.SetValue(1, max_value)  # final threshold
+        #  contour.ComputeScalarsOn()
+        #  contour.ComputeGradientsOn()
+        #  contour.ComputeNormalsOn()
+        contour.ReleaseDataFlagOn()
+        contour.Update()
+        flip_points = False
 
+    polydata = contour.GetOutput()
     del image
-    image = flip.GetOutput()
-    del flip
+    del contour
 
-    contour = vtkContourFilter()
-    contour.SetInputData(image)
-    if from_binary:
-        contour.SetValue(0, 127)  # initial threshold
+    # Coincident points inside the piece are merged here, in parallel. The
+    # points in the seams with the neighbour pieces are merged by
+    # merge_surface_pieces.
+    clean = vtkCleanPolyData()
+    clean.SetInputData(polydata)
+    clean.PointMergingOn()
+    clean.Update()
+    del polydata
+    polydata = clean.GetOutput()
+    del clean
+
+    # The piece is sent back to the main process as numpy arrays (pickled)
+    # instead of being written to a temp file.
+    piece = converters.polydata_to_arrays(polydata)
+    if flip_points:
+        flip_surface_arrays(piece, 1)
+    # z of the first and last slices of the piece, the seams with the
+    # previous and next pieces.
+    piece["seam_z"] = (roi.start * spacing[2], (min(roi.stop, shape[0]) - 1) * spacing[2])
+    return piece
+
+
+def create_label_surface_piece(
+    label_filename,
+    label_shape,
+    label_dtype,
+    labels,
+    roi,
+    spacing,
+    fill_border_holes,
+):
+    """
+    Creates the surfaces of all labels of the piece roi of the label volume
+    at once with discrete flying edges. Returns a dict label -> piece (as
+    numpy arrays, see converters.polydata_to_arrays), the pieces of each
+    label are joined with merge_surface_pieces.
+    """
+    log_fd, log_path = tempfile.mkstemp("vtkoutput.txt")
+    fow = vtkFileOutputWindow()
+    fow.SetFileName(log_path)
+    ow = vtkOutputWindow()
+    ow.SetInstance(fow)
+    os.close(log_fd)
+
+    pad_bottom = roi.start == 0
+    pad_top = roi.stop >= label_shape[0]
+
+    label_volume = numpy.memmap(label_filename, mode="r", dtype=label_dtype, shape=label_shape)
+    if fill_border_holes:
+        a_labels = pad_image(label_volume[roi], 0, pad_bottom, pad_top)
+        padding = (1, 1, pad_bottom)
     else:
-        contour.SetValue(0, min_value)  # initial threshold
-        contour.SetValue(1, max_value)  # final threshold
-    #  contour.ComputeScalarsOn()
-    #  contour.ComputeGradientsOn()
-    #  contour.ComputeNormalsOn()
-    contour.ReleaseDataFlagOn()
-    contour.Update()
+        a_labels = numpy.array(label_volume[roi])
+        padding = (0, 0, 0)
+    del label_volume
 
+    seam_z = (roi.start * spacing[2], (min(roi.stop, label_shape[0]) - 1) * spacing[2])
+    present = set(numpy.unique(a_labels).tolist())
+    labels = [label for label in labels if label in present]
+    if not labels:
+        return {}
+
+    image = converters.to_vtk(a_labels, spacing, roi.start, "AXIAL", padding=padding)
+    del a_labels
+
+    # The point scalars are the label of the point, used to split the
+    # output by label. The image is not flipped, see flip_surface_arrays.
+    contour = vtkDiscreteFlyingEdges3D()
+    contour.SetInputData(image)
+    for i, label in enumerate(labels):
+        contour.SetValue(i, label)
+    contour.ComputeNormalsOff()
+    contour.ComputeGradientsOff()
+    contour.ComputeScalarsOn()
+    contour.Update()
     polydata = contour.GetOutput()
     del image
     del contour
 
-    fd, filename = tempfile.mkstemp(suffix="_%d_%d.vtp" % (roi.start, roi.stop))
-    writer = vtkXMLPolyDataWriter()
-    writer.SetInputData(polydata)
-    writer.SetFileName(filename)
-    writer.Write()
+    point_labels = numpy_support.vtk_to_numpy(polydata.GetPointData().GetScalars()).copy()
+    polydata.GetPointData().Initialize()
+    surface = converters.polydata_to_arrays(polydata)
+    del polydata
+
+    pieces = split_surface_arrays(surface, point_labels, labels)
+    for piece in pieces.values():
+        flip_surface_arrays(piece, 1)
+        piece["seam_z"] = seam_z
+    return pieces
 
-    print("Writing piece", roi, "to", filename)
-    print("MY PID MC", os.getpid())
-    os.close(fd)
-    return filename
+
+def split_surface_arrays(surface, point_labels, labels):
+    """
+    Splits the triangles of the surface (as numpy arrays, see
+    converters.polydata_to_arrays) by the label of their points. Flying
+    edges creates the points of each contour value apart, so all points of a
+    triangle have the same label. Returns a dict label -> surface.
+    """
+    polys = surface["polys"].reshape(-1, 4)
+    triangle_labels = point_labels[polys[:, 1]]
+    pieces = {}
+    for label in labels:
+        triangles = polys[triangle_labels == label]
+        if not len(triangles):
+            continue
+        point_ids, new_ids = numpy.unique(triangles[:, 1:], return_inverse=True)
+        triangles = triangles.copy()
+        triangles[:, 1:] = new_ids.reshape(-1, 3)
+        pieces[label] = {
+            "points": surface["points"][point_ids],
+            "polys": triangles.ravel(),
+            "number_of_polys": len(triangles),
+            "point_data": [],
+            "cell_data": [],
+        }
+    return pieces
+
+
+def flip_surface_arrays(surface, axis):
+    """
+    Mirrors the surface (as numpy arrays, see converters.polydata_to_arrays)
+    about the origin along axis, the same as flipping the image with
+    vtkImageFlip (FlipAboutOriginOn) before extracting the surface. The
+    triangles are reversed to keep their orientation.
+    """
+    surface["points"][:, axis] *= -1
+    polys = surface["polys"]
+    if polys.size == 4 * surface["number_of_polys"] and numpy.all(polys[::4] == 3):
+        polys = polys.reshape(-1, 4)
+        polys[:, [2, 3]] = polys[:, [3, 2]]
+    for name, array, attribute in surface["point_data"] + surface["cell_data"]:
+        if array.ndim == 2 and array.shape[1] == 3:
+            array[:, axis] *= -1
+
+
+def _common_data_arrays(pieces, key):
+    """
+    Name and attribute of the point (or cell) data arrays present in all
+    pieces, in the order of the first one.
+    """
+    common = [(name, attribute) for name, _array, attribute in pieces[0][key]]
+    for piece in pieces[1:]:
+        names = {(name, attribute) for name, _array, attribute in piece[key]}
+        common = [i for i in common if i in names]
+    return common
+
+
+def _get_data_array(piece, key, name, attribute):
+    for array_name, array, array_attribute in piece[key]:
+        if (array_name, array_attribute) == (name, attribute):
+            return array
+
+
+def _match_points(points, seam_points):
+    """
+    Returns which points are in seam_points (exact coordinates) and their
+    positions in seam_points.
+    """
+    dtype = [("x", points.dtype), ("y", points.dtype), ("z", points.dtype)]
+    keys = numpy.ascontiguousarray(points).view(dtype).ravel()
+    seam_keys = numpy.ascontiguousarray(seam_points, dtype=points.dtype).view(dtype).ravel()
+
+    sorter = numpy.argsort(seam_keys)
+    positions = numpy.searchsorted(seam_keys, keys, sorter=sorter)
+    positions = sorter[numpy.clip(positions, 0, len(seam_keys) - 1)]
+    found = seam_keys[positions] == keys
+    return found, positions[found]
+
+
+def merge_surface_pieces(pieces):
+    """
+    Joins the surface pieces, ordered by their first slice, into one surface
+    (as numpy arrays, see converters.polydata_to_arrays).
+
+    Consecutive pieces share one slice, so the points in that plane are
+    computed by both pieces with the same coordinates. They are merged here
+    by their coordinates, deterministically and without a global
+    vtkCleanPolyData. Returns None if some polygon is not a triangle, then
+    the pieces have to be joined with vtkAppendPolyData and cleaned.
+    """
+    pieces = [piece for piece in pieces if len(piece["points"])]
+    for piece in pieces:
+        polys = piece["polys"]
+        if polys.size != 4 * piece["number_of_polys"] or numpy.any(polys[::4] != 3):
+            return None
+    if not pieces:
+        return None
+
+    point_data_arrays = _common_data_arrays(pieces, "point_data")
+    cell_data_arrays = _common_data_arrays(pieces, "cell_data")
+
+    points_list = []
+    polys_list = []
+    point_data = {i: [] for i in point_data_arrays}
+    cell_data = {i: [] for i in cell_data_arrays}
+
+    n_points = 0
+    previous_seam = None
+    for piece in pieces:
+        points = piece["points"]
+        bottom_z, top_z = piece["seam_z"]
+        tolerance = 1e-4 * max(abs(top_z - bottom_z), 1.0)
+
+        ids = numpy.empty(len(points), dtype=numpy.int64)
+        keep = numpy.ones(len(points), dtype=bool)
+        if previous_seam is not None:
+            seam_z, seam_points, seam_ids = previous_seam
+            if abs(seam_z - bottom_z) <= tolerance and len(seam_points):
+                bottom = numpy.nonzero(numpy.abs(points[:, 2] - bottom_z) <= tolerance)[0]
+                found, positions = _match_points(points[bottom], seam_points)
+                ids[bottom[found]] = seam_ids[positions]
+                keep[bottom[found]] = False
+
+        n_keep = int(keep.sum())
+        ids[keep] = numpy.arange(n_points, n_points + n_keep)
+        n_points += n_keep
+
+        points_list.append(points[keep])
+        polys = piece["polys"].reshape(-1, 4).copy()
+        polys[:, 1:] = ids[polys[:, 1:]]
+        polys_list.append(polys.ravel())
+
+        for name, attribute in point_data_arrays:
+            array = _get_data_array(piece, "point_data", name, attribute)
+            point_data[(name, attribute)].append(array[keep])
+        for name, attribute in cell_data_arrays:
+            array = _get_data_array(piece, "cell_data", name, attribute)
+            cell_data[(name, attribute)].append(array)
+
+        top = numpy.nonzero(numpy.abs(points[:, 2] - top_z) <= tolerance)[0]
+        previous_seam = (top_z, points[top], ids[top])
+
+    return {
+        "points": numpy.concatenate(points_list),
+        "polys": numpy.concatenate(polys_list),
+        "number_of_polys": sum(piece["number_of_polys"] for piece in pieces),
+        "point_data": [
+            (name, numpy.concatenate(point_data[(name, attribute)]), attribute)
+            for name, attribute in point_data_arrays
+        ],
+        "cell_data": [
+            (name, numpy.concatenate(cell_data[(name, attribute)]), attribute)
+            for name, attribute in cell_data_arrays
+        ],
+    }
 
 
 def join_process_surface(
-    filenames,
+    pieces,
     algorithm,
     smooth_iterations,
     smooth_relaxation_factor,
@@ -209,6 +460,7 @@ def join_process_surface(
     fill_holes,
     options,
     msg_queue,
+    num_threads=0,
 ):
     def send_message(msg):
         try:
@@ -224,40 +476,41 @@ def join_process_surface(
     os.close(log_fd)
 
     send_message("Joining surfaces ...")
-    polydata_append = vtkAppendPolyData()
-    for f in filenames:
-        reader = vtkXMLPolyDataReader()
-        reader.SetFileName(f)
-        reader.Update()
+    surface = merge_surface_pieces(pieces)
+    if surface is not None:
+        del pieces
+        polydata = converters.arrays_to_polydata(surface)
+        del surface
+    else:
+        polydata_append = vtkAppendPolyData()
+        for piece in pieces:
+            polydata = converters.arrays_to_polydata(piece)
+            polydata_append.AddInputData(polydata)
+            del polydata
+        del pieces
+
+        polydata_append.Update()
+        #  polydata_append.GetOutput().ReleaseDataFlagOn()
+        polydata = polydata_append.GetOutput()
+        # polydata.Register(None)
+        #  polydata.SetSource(None)
+        del polydata_append
 
-        polydata = reader.GetOutput()
+        send_message("Cleaning surface ...")
+        clean = vtkCleanPolyData()
+        #  clean.ReleaseDataFlagOn()
+        #  clean.GetOutput().ReleaseDataFlagOn()
+        clean_ref = weakref.ref(clean)
+        #  clean_ref().AddObserver("ProgressEvent", lambda obj,evt:
+        #  UpdateProgress(clean_ref(), _("Creating 3D surface...")))
+        clean.SetInputData(polydata)
+        clean.PointMergingOn()
+        clean.Update()
 
-        polydata_append.AddInputData(polydata)
-        del reader
         del polydata
-
-    polydata_append.Update()
-    #  polydata_append.GetOutput().ReleaseDataFlagOn()
-    polydata = polydata_append.GetOutput()
-    # polydata.Register(None)
-    #  polydata.SetSource(None)
-    del polydata_append
-
-    send_message("Cleaning surface ...")
-    clean = vtkCleanPolyData()
-    #  clean.ReleaseDataFlagOn()
-    #  clean.GetOutput().ReleaseDataFlagOn()
-    clean_ref = weakref.ref(clean)
-    #  clean_ref().AddObserver("ProgressEvent", lambda obj,evt:
-    #  UpdateProgress(clean_ref(), _("Creating 3D surface...")))
-    clean.SetInputData(polydata)
-    clean.PointMergingOn()
-    clean.Update()
-
-    del polydata
-    polydata = clean.GetOutput()
-    #  polydata.SetSource(None)
-    del clean
+        polydata = clean.GetOutput()
+        #  polydata.SetSource(None)
+        del clean
 
     if algorithm == "ca_smoothing":
         send_message("Calculating normals ...")
@@ -304,7 +557,12 @@ def join_process_surface(
         send_message("Context Aware smoothing ...")
         mesh = cy_mesh.Mesh(polydata)
         cy_mesh.ca_smoothing(
-            mesh, options["angle"], options["max distance"], options["min weight"], options["steps"]
+            mesh,
+            options["angle"],
+            options["max distance"],
+            options["min weight"],
+            options["steps"],
+            num_threads,
         )
         #  polydata = mesh.to_vtk()
 
@@ -443,13 +701,4 @@ def join_process_surface(
     area = float(measured_polydata.GetSurfaceArea())
     del measured_polydata
 
-    fd, filename = tempfile.mkstemp(suffix="_full.vtp")
-    writer = vtkXMLPolyDataWriter()
-    writer.SetInputData(polydata)
-    writer.SetFileName(filename)
-    writer.Write()
-    del writer
-
-    print("MY PID", os.getpid())
-    os.close(fd)
-    return filename, {"volume": volume, "area": area}
+    return converters.polydata_to_arrays(polydata), {"volume": volume, "area": area}
@@ -14,10 +14,11 @@ import numpy as np
 import wx
 
 import invesalius.data.slice_ as slc
+import invesalius.session as ses
 from invesalius.gui import dialogs
 from invesalius.i18n import tr as _
 from invesalius.pubsub import pub as Publisher
-from invesalius.segmentation.deep_learning import segment, utils
+from invesalius.segmentation.deep_learning import quantization, segment, utils
 
 HAS_THEANO = bool(importlib.util.find_spec("theano"))
 HAS_PLAIDML = bool(importlib.util.find_spec("plaidml"))
@@ -41,6 +42,23 @@ if HAS_TORCH:
     TORCH_DEVICES["CPU"] = "cpu"
 
 
+try:
+    import onnxruntime
+
+    HAS_ONNXRUNTIME = True
+except ImportError:
+    HAS_ONNXRUNTIME = False
+
+ONNX_DEVICES = {}
+if HAS_ONNXRUNTIME:
+    _providers = onnxruntime.get_available_providers()
+    if "OpenVINOExecutionProvider" in _providers:
+        ONNX_DEVICES["OpenVINO (CPU)"] = "OpenVINOExecutionProvider"
+    if "CUDAExecutionProvider" in _providers:
+        ONNX_DEVICES["CUDA"] = "CUDAExecutionProvider"
+    ONNX_DEVICES["CPU"] = segment.ONNX_CPU_PROVIDER
+
+
 if HAS_PLAIDML:
     with multiprocessing.Pool(1) as p:
         try:
@@ -53,7 +71,14 @@ if HAS_PLAIDML:
 
 class DeepLearningSegmenterDialog(wx.Dialog):
     def __init__(
-        self, parent, title, has_torch=True, has_plaidml=True, has_theano=True, segmenter=None
+        self,
+        parent,
+        title,
+        has_torch=True,
+        has_plaidml=True,
+        has_theano=True,
+        segmenter=None,
+        has_onnx=False,
     ):
         wx.Dialog.__init__(
             self,
@@ -69,10 +94,17 @@ class DeepLearningSegmenterDialog(wx.Dialog):
             backends.append("PlaidML")
         if HAS_THEANO and has_theano:
             backends.append("Theano")
+        if HAS_ONNXRUNTIME and has_onnx:
+            backends.append(segment.ONNX_BACKEND)
         self.segmenter = segmenter
         #  self.pg_dialog = None
         self.torch_devices = TORCH_DEVICES
         self.plaidml_devices = PLAIDML_DEVICES
+        self.onnx_devices = ONNX_DEVICES
+        if HAS_ONNXRUNTIME and has_onnx:
+            self.onnx_precisions = quantization.available_precisions(segmenter.model_name)
+        else:
+            self.onnx_precisions = [segment.PRECISION_FLOAT32]
 
         self.backends = backends
 
@@ -83,6 +115,9 @@ class DeepLearningSegmenterDialog(wx.Dialog):
         self.overlap_options = (0, 10, 25, 50)
         self.default_overlap = 50
 
+        # Number of patches run at once by the network.
+        self.batch_size = ses.Session().GetConfig("segmentation_batch_size", segment.BATCH_SIZE)
+
         self.elapsed_time_timer = wx.Timer()
 
         self._init_gui()
@@ -103,13 +138,16 @@ class DeepLearningSegmenterDialog(wx.Dialog):
         w, h = self.CalcSizeFromTextSize("MM" * (1 + max(len(i) for i in self.backends)))
         self.cb_backends.SetMinClientSize((w, -1))
         self.chk_use_gpu = wx.CheckBox(self, wx.ID_ANY, _("Use GPU"))
-        if HAS_TORCH or HAS_PLAIDML:
+        if HAS_TORCH or HAS_PLAIDML or HAS_ONNXRUNTIME:
             if HAS_TORCH:
                 choices = list(self.torch_devices.keys())
                 value = choices[0]
-            else:
+            elif HAS_PLAIDML:
                 choices = list(self.plaidml_devices.keys())
                 value = choices[0]
+            else:
+                choices = list(self.onnx_devices.keys())
+                value = choices[0]
             self.lbl_device = wx.StaticText(self, -1, _("Device"))
             self.cb_devices = wx.ComboBox(
                 self,
@@ -118,6 +156,20 @@ class DeepLearningSegmenterDialog(wx.Dialog):
                 value=value,
                 style=wx.CB_DROPDOWN | wx.CB_READONLY,
             )
+        precision = ses.Session().GetConfig("segmentation_precision", segment.PRECISION_FLOAT32)
+        if precision not in self.onnx_precisions:
+            precision = segment.PRECISION_FLOAT32
+        self.lbl_precision = wx.StaticText(self, -1, _("Precision"))
+        self.cb_precision = wx.ComboBox(
+            self,
+            wx.ID_ANY,
+            choices=self.onnx_precisions,
+            value=precision,
+            style=wx.CB_DROPDOWN | wx.CB_READONLY,
+        )
+        self.cb_precision.SetToolTip(
+            _("int8 is listed when a model calibrated by scripts/quantize_segmentation.py exists")
+        )
         self.sld_threshold = wx.Slider(self, wx.ID_ANY, 75, 0, 100)
         w, h = self.CalcSizeFromTextSize("M" * 20)
         self.sld_threshold.SetMinClientSize((w, -1))
@@ -156,10 +208,14 @@ class DeepLearningSegmenterDialog(wx.Dialog):
         main_sizer.Add(sizer_backends, 0, wx.ALL | wx.EXPAND, 5)
         main_sizer.Add(self.chk_use_gpu, 0, wx.ALL, 5)
         sizer_devices = wx.BoxSizer(wx.HORIZONTAL)
-        if HAS_TORCH or HAS_PLAIDML:
+        if HAS_TORCH or HAS_PLAIDML or HAS_ONNXRUNTIME:
             sizer_devices.Add(self.lbl_device, 0, wx.ALIGN_CENTER, 0)
             sizer_devices.Add(self.cb_devices, 1, wx.LEFT, 5)
         main_sizer.Add(sizer_devices, 0, wx.ALL | wx.EXPAND, 5)
+        sizer_precision = wx.BoxSizer(wx.HORIZONTAL)
+        sizer_precision.Add(self.lbl_precision, 0, wx.ALIGN_CENTER, 0)
+        sizer_precision.Add(self.cb_precision, 1, wx.LEFT, 5)
+        main_sizer.Add(sizer_precision, 0, wx.ALL | wx.EXPAND, 5)
         main_sizer.Add(self.overlap, 0, wx.ALL | wx.EXPAND, 5)
         label_5 = wx.StaticText(self, wx.ID_ANY, _("Level of certainty"))
         main_sizer.Add(label_5, 0, wx.ALL, 5)
@@ -225,6 +281,14 @@ class DeepLearningSegmenterDialog(wx.Dialog):
                 self.lbl_device.Show()
                 self.cb_devices.Show()
             self.chk_use_gpu.Hide()
+        elif self.cb_backends.GetValue() == segment.ONNX_BACKEND:
+            choices = list(self.onnx_devices.keys())
+            self.cb_devices.Clear()
+            self.cb_devices.SetItems(choices)
+            self.cb_devices.SetValue(choices[0])
+            self.lbl_device.Show()
+            self.cb_devices.Show()
+            self.chk_use_gpu.Hide()
         elif self.cb_backends.GetValue().lower() == "plaidml":
             if HAS_PLAIDML:
                 choices = list(self.plaidml_devices.keys())
@@ -235,11 +299,18 @@ class DeepLearningSegmenterDialog(wx.Dialog):
                 self.cb_devices.Show()
             self.chk_use_gpu.Hide()
         else:
-            if HAS_PLAIDML:
+            if HAS_PLAIDML or HAS_ONNXRUNTIME:
                 self.lbl_device.Hide()
                 self.cb_devices.Hide()
             self.chk_use_gpu.Show()
 
+        if self.cb_backends.GetValue() == segment.ONNX_BACKEND:
+            self.lbl_precision.Show()
+            self.cb_precision.Show()
+        else:
+            self.lbl_precision.Hide()
+            self.cb_precision.Hide()
+
         self.main_sizer.Fit(self)
         self.main_sizer.SetSizeHints(self)
 
@@ -268,11 +339,18 @@ class DeepLearningSegmenterDialog(wx.Dialog):
         self.elapsed_time_timer.Start(1000)
         image = slc.Slice().matrix
         backend = self.cb_backends.GetValue()
+        precision = segment.PRECISION_FLOAT32
         if backend.lower() == "pytorch":
             try:
                 device_id = self.torch_devices[self.cb_devices.GetValue()]
             except (KeyError, AttributeError):
                 device_id = "cpu"
+        elif backend == segment.ONNX_BACKEND:
+            try:
+                device_id = self.onnx_devices[self.cb_devices.GetValue()]
+            except (KeyError, AttributeError):
+                device_id = segment.ONNX_CPU_PROVIDER
+            precision = self.cb_precision.GetValue()
         else:
             try:
                 device_id = self.plaidml_devices[self.cb_devices.GetValue()]
@@ -303,6 +381,8 @@ class DeepLearningSegmenterDialog(wx.Dialog):
                 apply_wwwl,
                 window_width,
                 window_level,
+                batch_size=self.batch_size,
+                precision=precision,
             )
             self.ps.start()
         except (multiprocessing.ProcessError, OSError, ValueError) as err:
@@ -406,6 +486,7 @@ class BrainSegmenterDialog(DeepLearningSegmenterDialog):
             has_plaidml=True,
             has_theano=True,
             segmenter=segment.BrainSegmentProcess,
+            has_onnx=True,
         )
 
 
@@ -418,6 +499,7 @@ class TracheaSegmenterDialog(DeepLearningSegmenterDialog):
             has_plaidml=False,
             has_theano=False,
             segmenter=segment.TracheaSegmentProcess,
+            has_onnx=True,
         )
 
 
@@ -466,8 +548,8 @@ class MandibleSegmenterDialog(DeepLearningSegmenterDialog):
 
     def _do_layout(self):
         super()._do_layout()
-        self.main_sizer.Insert(8, self.chk_apply_resize_by_spacing, 0, wx.EXPAND | wx.ALL, 5)
-        self.main_sizer.Insert(9, self.path_sizer, 0, wx.EXPAND | wx.ALL, 5)
+        self.main_sizer.Insert(9, self.chk_apply_resize_by_spacing, 0, wx.EXPAND | wx.ALL, 5)
+        self.main_sizer.Insert(10, self.path_sizer, 0, wx.EXPAND | wx.ALL, 5)
 
     def OnSegment(self, evt):
         self.ShowProgress()
@@ -515,6 +597,7 @@ class MandibleSegmenterDialog(DeepLearningSegmenterDialog):
                 window_width,
                 window_level,
                 patch_size=patch_size,
+                batch_size=self.batch_size,
                 resize_by_spacing=resize_by_spacing,
                 image_spacing=slc.Slice().spacing,
             )
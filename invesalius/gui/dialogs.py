@@ -240,9 +240,15 @@ class ResizeImageDialog(wx.Dialog):
         sizer_percent.Add(lbl_message_percent, 0, wx.EXPAND | wx.ALL, 5)
         sizer_percent.Add(num_ctrl_percent, 0, wx.ALL, 5)
 
+        self.chk_out_of_core = wx.CheckBox(
+            self, -1, _("Keep the original resolution, reading the image from disk (slower)")
+        )
+        self.chk_out_of_core.Bind(wx.EVT_CHECKBOX, self.OnCheckOutOfCore)
+
         sizer_itens = wx.BoxSizer(wx.VERTICAL)
         sizer_itens.Add(lbl_message, 0, wx.EXPAND | wx.ALL, 5)
         sizer_itens.Add(sizer_percent, 0, wx.EXPAND | wx.ALL, 5)
+        sizer_itens.Add(self.chk_out_of_core, 0, wx.EXPAND | wx.ALL, 5)
         sizer_itens.Add(btn_sizer, 0, wx.EXPAND | wx.ALL, 5)
 
         sizer_general = wx.BoxSizer(wx.HORIZONTAL)
@@ -255,12 +261,18 @@ class ResizeImageDialog(wx.Dialog):
         self.Layout()
         self.Centre()
 
+    def OnCheckOutOfCore(self, evt: wx.CommandEvent) -> None:
+        self.num_ctrl_porcent.Enable(not self.chk_out_of_core.GetValue())
+
     def SetValue(self, value: Union[float, str]) -> None:
         self.num_ctrl_porcent.SetValue(value)
 
     def GetValue(self) -> int:
         return self.num_ctrl_porcent.GetValue()
 
+    def GetOutOfCore(self) -> bool:
+        return self.chk_out_of_core.GetValue()
+
     def Close(self) -> None:
         self.Destroy()
 
@@ -2067,6 +2079,7 @@ class SurfaceMethodPanel(wx.Panel):
             _("Default"): "Default",
             _("Context aware smoothing"): "ca_smoothing",
             _("Binary"): "Binary",
+            _("Binary (flying edges)"): "flying_edges",
         }
         self.edited_imp = [
             _("Default"),
@@ -552,10 +552,9 @@ class DicomPreviewSlice(wx.Panel):
         dicom_files = group.GetHandSortedList()
         n = 0
         for dicom in dicom_files:
-            if isinstance(dicom.image.thumbnail_path, list):
+            if dicom.image.number_of_frames > 1:
                 _slice = 0
-                for thumbnail in dicom.image.thumbnail_path:
-                    print(thumbnail)
+                for frame in range(dicom.image.number_of_frames):
                     info = DicomInfo(
                         n, dicom, _("Image %d") % (n), "%.2f" % (dicom.image.position[2]), _slice
                     )
@@ -587,10 +586,9 @@ class DicomPreviewSlice(wx.Panel):
         dicom_files = group.GetHandSortedList()
         n = 0
         for dicom in dicom_files:
-            if isinstance(dicom.image.thumbnail_path, list):
+            if dicom.image.number_of_frames > 1:
                 _slice = 0
-                for thumbnail in dicom.image.thumbnail_path:
-                    print(thumbnail)
+                for frame in range(dicom.image.number_of_frames):
                     info = DicomInfo(
                         n, dicom, _("Image %d") % int(n), "%.2f" % (dicom.image.position[2]), _slice
                     )
@@ -755,6 +755,9 @@ class Frame(wx.Frame):
             logging_file = values[const.LOGFILE]
             console_logging = values[const.CONSOLE_LOGGING]
             console_logging_level = values[const.CONSOLE_LOGGING_LEVEL]
+            project_storage = values[const.PROJECT_STORAGE]
+            project_container = values[const.PROJECT_CONTAINER]
+            import_workers = values[const.IMPORT_WORKERS]
 
             session.SetConfig("rendering", rendering)
             session.SetConfig("surface_interpolation", surface_interpolation)
@@ -766,6 +769,9 @@ class Frame(wx.Frame):
             session.SetConfig("logging_file", logging_file)
             session.SetConfig("console_logging", console_logging)
             session.SetConfig("console_logging_level", console_logging_level)
+            session.SetConfig("project_storage", project_storage)
+            session.SetConfig("project_container", project_container)
+            session.SetConfig("import_workers", import_workers)
 
             Publisher.sendMessage("Remove Volume")
             Publisher.sendMessage("Reset Raycasting")
@@ -938,6 +944,7 @@ class Frame(wx.Frame):
             deep_learning_seg_dialog.HAS_PLAIDML
             or deep_learning_seg_dialog.HAS_THEANO
             or deep_learning_seg_dialog.HAS_TORCH
+            or deep_learning_seg_dialog.HAS_ONNXRUNTIME
         ):
             dlg = deep_learning_seg_dialog.BrainSegmenterDialog(self)
             dlg.Show()
@@ -947,7 +954,7 @@ class Frame(wx.Frame):
                 _(
                     "It's not possible to run brain segmenter because your system doesn't have the following modules installed:"
                 )
-                + " Torch, PlaidML or Theano",
+                + " Torch, ONNX Runtime, PlaidML or Theano",
                 "InVesalius 3 - Brain segmenter",
                 wx.ICON_INFORMATION | wx.OK,
             )
@@ -957,7 +964,7 @@ class Frame(wx.Frame):
     def OnTracheSegmentation(self):
         from invesalius.gui import deep_learning_seg_dialog
 
-        if deep_learning_seg_dialog.HAS_TORCH:
+        if deep_learning_seg_dialog.HAS_TORCH or deep_learning_seg_dialog.HAS_ONNXRUNTIME:
             dlg = deep_learning_seg_dialog.TracheaSegmenterDialog(self)
             dlg.Show()
         else:
@@ -966,7 +973,7 @@ class Frame(wx.Frame):
                 _(
                     "It's not possible to run trachea segmenter because your system doesn't have the following modules installed:"
                 )
-                + " Torch",
+                + " Torch or ONNX Runtime",
                 "InVesalius 3 - Trachea segmenter",
                 wx.ICON_INFORMATION | wx.OK,
             )
@@ -1,3 +1,4 @@
+import multiprocessing
 import os
 import sys
 from functools import partial
@@ -39,6 +40,7 @@ class Preferences(wx.Dialog):
 
         self.visualization_tab = VisualizationTab(self.book)
         self.language_tab = LanguageTab(self.book)
+        self.files_tab = FilesTab(self.book)
         if self.have_log_tab == 1:
             self.logging_tab = LoggingTab(self.book)
 
@@ -67,6 +69,7 @@ class Preferences(wx.Dialog):
             self.book.AddPage(self.object_tab, _("TMS Coil"))
 
         self.book.AddPage(self.language_tab, _("Language"))
+        self.book.AddPage(self.files_tab, _("Files"))
         if self.have_log_tab == 1:
             self.book.AddPage(self.logging_tab, _("Logging"))
 
@@ -95,6 +98,7 @@ class Preferences(wx.Dialog):
 
         values.update(lang)
         values.update(viewer)
+        values.update(self.files_tab.GetSelection())
 
         if self.have_log_tab == 1:
             logging = self.logging_tab.GetSelection()
@@ -108,6 +112,9 @@ class Preferences(wx.Dialog):
         surface_interpolation = session.GetConfig("surface_interpolation")
         language = session.GetConfig("language")
         slice_interpolation = session.GetConfig("slice_interpolation")
+        project_storage = session.GetConfig("project_storage", const.PROJECT_STORAGE_RAW)
+        project_container = session.GetConfig("project_container", const.PROJECT_CONTAINER_TAR)
+        import_workers = session.GetConfig("import_workers", const.DEFAULT_IMPORT_WORKERS)
 
         # logger = log.MyLogger()
         file_logging = log.invLogger.GetConfig("file_logging")
@@ -133,10 +140,14 @@ class Preferences(wx.Dialog):
             const.LOGFILE: logging_file,
             const.CONSOLE_LOGGING: console_logging,
             const.CONSOLE_LOGGING_LEVEL: console_logging_level,
+            const.PROJECT_STORAGE: project_storage,
+            const.PROJECT_CONTAINER: project_container,
+            const.IMPORT_WORKERS: import_workers,
         }
 
         self.visualization_tab.LoadSelection(values)
         self.language_tab.LoadSelection(values)
+        self.files_tab.LoadSelection(values)
         if self.have_log_tab == 1:
             self.logging_tab.LoadSelection(values)
 
@@ -208,6 +219,92 @@ class VisualizationTab(wx.Panel):
         self.rb_inter_sl.SetSelection(int(slice_interpolation))
 
 
+class FilesTab(wx.Panel):
+    def __init__(self, parent):
+        wx.Panel.__init__(self, parent)
+
+        self.storages = [const.PROJECT_STORAGE_RAW, const.PROJECT_STORAGE_CHUNKED]
+        self.containers = [const.PROJECT_CONTAINER_TAR, const.PROJECT_CONTAINER_INCREMENTAL]
+
+        bsizer = wx.StaticBoxSizer(wx.VERTICAL, self, _("Project file"))
+        lbl_container = wx.StaticText(bsizer.GetStaticBox(), -1, _("File format"))
+        rb_container = self.rb_container = wx.RadioBox(
+            bsizer.GetStaticBox(),
+            -1,
+            choices=[_("Standard"), _("Incremental")],
+            majorDimension=2,
+            style=wx.RA_SPECIFY_COLS | wx.NO_BORDER,
+        )
+        rb_container.SetToolTip(
+            _(
+                "Incremental project files only write what was changed since the last save,"
+                " they can't be opened by older versions of InVesalius."
+            )
+        )
+        bsizer.Add(lbl_container, 0, wx.TOP | wx.LEFT | wx.FIXED_MINSIZE, 10)
+        bsizer.Add(rb_container, 0, wx.TOP | wx.LEFT | wx.FIXED_MINSIZE, 0)
+
+        lbl_storage = wx.StaticText(bsizer.GetStaticBox(), -1, _("Image and masks storage"))
+        rb_storage = self.rb_storage = wx.RadioBox(
+            bsizer.GetStaticBox(),
+            -1,
+            choices=[_("Uncompressed"), _("Compressed chunks")],
+            majorDimension=2,
+            style=wx.RA_SPECIFY_COLS | wx.NO_BORDER,
+        )
+        rb_storage.SetToolTip(
+            _(
+                "Compressed chunks make smaller project files, they are decompressed"
+                " to disk when the project is opened."
+            )
+        )
+        bsizer.Add(lbl_storage, 0, wx.TOP | wx.LEFT | wx.FIXED_MINSIZE, 10)
+        bsizer.Add(rb_storage, 0, wx.TOP | wx.LEFT | wx.FIXED_MINSIZE, 0)
+
+        bsizer_import = wx.StaticBoxSizer(wx.VERTICAL, self, _("DICOM import"))
+        lbl_workers = wx.StaticText(
+            bsizer_import.GetStaticBox(), -1, _("Processes reading the files")
+        )
+        spin_workers = self.spin_workers = wx.SpinCtrl(
+            bsizer_import.GetStaticBox(), -1, min=0, max=multiprocessing.cpu_count()
+        )
+        spin_workers.SetToolTip(
+            _("0 uses one process per CPU, 1 reads the files without starting other processes.")
+        )
+        sizer_workers = wx.BoxSizer(wx.HORIZONTAL)
+        sizer_workers.Add(lbl_workers, 0, wx.ALIGN_CENTER_VERTICAL | wx.RIGHT, 5)
+        sizer_workers.Add(spin_workers, 0, wx.ALIGN_CENTER_VERTICAL)
+        bsizer_import.Add(sizer_workers, 0, wx.ALL | wx.FIXED_MINSIZE, 10)
+
+        border = wx.BoxSizer(wx.VERTICAL)
+        border.Add(bsizer, 0, wx.EXPAND | wx.ALL | wx.FIXED_MINSIZE, 10)
+        border.Add(bsizer_import, 0, wx.EXPAND | wx.ALL | wx.FIXED_MINSIZE, 10)
+
+        self.SetSizerAndFit(border)
+        self.Layout()
+
+    def GetSelection(self):
+        options = {
+            const.PROJECT_STORAGE: self.storages[self.rb_storage.GetSelection()],
+            const.PROJECT_CONTAINER: self.containers[self.rb_container.GetSelection()],
+            const.IMPORT_WORKERS: self.spin_workers.GetValue(),
+        }
+        return options
+
+    def LoadSelection(self, values):
+        storage = values[const.PROJECT_STORAGE]
+        if storage not in self.storages:
+            storage = const.PROJECT_STORAGE_RAW
+        self.rb_storage.SetSelection(self.storages.index(storage))
+
+        container = values[const.PROJECT_CONTAINER]
+        if container not in self.containers:
+            container = const.PROJECT_CONTAINER_TAR
+        self.rb_container.SetSelection(self.containers.index(container))
+
+        self.spin_workers.SetValue(int(values[const.IMPORT_WORKERS]))
+
+
 class LoggingTab(wx.Panel):
     def __init__(self, parent):
         wx.Panel.__init__(self, parent)
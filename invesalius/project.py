@@ -24,14 +24,16 @@ import shutil
 import sys
 import tarfile
 import tempfile
-from typing import TYPE_CHECKING, Dict, List, Union
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Union
 
 import numpy as np
 from vtkmodules.vtkCommonCore import vtkFileOutputWindow, vtkOutputWindow
 
 import invesalius.constants as const
+import invesalius.session as ses
 from invesalius import inv_paths
-from invesalius.data import imagedata_utils
+from invesalius.data import compression, imagedata_utils, project_container
+from invesalius.data.chunked_array import ChunkedArray
 from invesalius.presets import Presets
 from invesalius.pubsub import pub as Publisher
 from invesalius.utils import Singleton, TwoWaysDictionary, debug, decode
@@ -77,6 +79,21 @@ class Project(metaclass=Singleton):
 
         self.compress = False
 
+        # Offset of the image matrix inside matrix_filename, not 0 when it's
+        # mapped from an uncompressed project file.
+        self.matrix_offset = 0
+        # Incremented when the image matrix is changed in place (see
+        # Slice.OnFlipVolume).
+        self.matrix_version = 0
+
+        # The incremental project file (see data/project_container.py) last
+        # opened or saved and, for the image and mask files it has, their
+        # name inside it and the version of their content when it was
+        # written (see _get_file_versions). They aren't written again while
+        # the version doesn't change.
+        self.container_filename = None
+        self.container_files = {}
+
         self.invesalius_version = const.INVESALIUS_VERSION
 
         self.presets = Presets()
@@ -201,6 +218,38 @@ class Project(metaclass=Singleton):
             measures[str(m.index)] = m.get_as_dict()
         return measures
 
+    def _get_file_versions(self, chunked):
+        """
+        Returns the names of the image and mask files in the project file
+        with the version of their content.
+        """
+        ext = ".chk" if chunked else ".dat"
+        versions = {"matrix" + ext: (self.matrix_filename, self.matrix_version)}
+        for mask in self.mask_dict.values():
+            versions["mask_%d%s" % (mask.index, ext)] = mask.version
+        return versions
+
+    def _get_unchanged_files(self, path, versions):
+        """
+        Returns the files of versions that are the same in the incremental
+        project file path, mapped to their name inside it.
+        """
+        if self.container_filename != os.path.abspath(path):
+            return {}
+        try:
+            stored = project_container.read_manifest(path)["files"]
+        except (OSError, ValueError):
+            return {}
+        unchanged = {}
+        for name, version in versions.items():
+            try:
+                container_name, container_version = self.container_files[name]
+            except KeyError:
+                continue
+            if container_version == version and container_name in stored:
+                unchanged[name] = container_name
+        return unchanged
+
     def SavePlistProject(self, dir_, filename, compress=False):
         dir_temp = decode(tempfile.mkdtemp(), const.FS_ENCODE)
 
@@ -227,20 +276,62 @@ class Project(metaclass=Singleton):
             "image_fiducials": self.image_fiducials.tolist(),
         }
 
+        # The image matrix and masks mapped from the opened project file are
+        # copied to temp files, the project file may be overwritten.
+        if self.matrix_offset:
+            import invesalius.data.slice_ as slc
+
+            slc.Slice().detach_project_file()
+
+        session = ses.Session()
+        chunked = (
+            session.GetConfig("project_storage", const.PROJECT_STORAGE_RAW)
+            == const.PROJECT_STORAGE_CHUNKED
+        )
+        path = os.path.join(dir_, filename)
+        incremental = (
+            session.GetConfig("project_container", const.PROJECT_CONTAINER_TAR)
+            == const.PROJECT_CONTAINER_INCREMENTAL
+        )
+        versions = self._get_file_versions(chunked)
+        unchanged = self._get_unchanged_files(path, versions) if incremental else {}
+
         # Saving the matrix containing the slices
-        matrix = {
-            "filename": "matrix.dat",
-            "shape": self.matrix_shape,
-            "dtype": self.matrix_dtype,
-        }
+        if chunked:
+            matrix = {
+                "filename": "matrix.chk",
+                "shape": self.matrix_shape,
+                "dtype": self.matrix_dtype,
+                "format": const.PROJECT_STORAGE_CHUNKED,
+            }
+            if "matrix.chk" not in unchanged:
+                chunked_filename = os.path.join(dir_temp, "matrix.chk")
+                image = np.memmap(
+                    self.matrix_filename,
+                    shape=tuple(self.matrix_shape),
+                    dtype=self.matrix_dtype,
+                    mode="r",
+                )
+                ChunkedArray.from_array(image, chunked_filename).close()
+                del image
+                filelist[chunked_filename] = "matrix.chk"
+        else:
+            matrix = {
+                "filename": "matrix.dat",
+                "shape": self.matrix_shape,
+                "dtype": self.matrix_dtype,
+            }
+            if "matrix.dat" not in unchanged:
+                filelist[self.matrix_filename] = "matrix.dat"
         project["matrix"] = matrix
-        filelist[self.matrix_filename] = "matrix.dat"
         # shutil.copyfile(self.matrix_filename, filename_tmp)
 
         # Saving the masks
         masks = {}
         for index in self.mask_dict:
-            masks[str(index)] = self.mask_dict[index].SavePlist(dir_temp, filelist)
+            masks[str(index)] = self.mask_dict[index].SavePlist(
+                dir_temp, filelist, chunked=chunked, unchanged=unchanged
+            )
         project["masks"] = masks
 
         # Saving the surfaces
@@ -270,8 +361,17 @@ class Project(metaclass=Singleton):
         os.close(temp_fd)
 
         # Compressing and generating the .inv3 file
-        path = os.path.join(dir_, filename)
-        Compress(dir_temp, path, filelist, compress)
+        if incremental:
+            codec = None if compress else project_container.RAW_CODEC
+            project_container.save(path, filelist, codec=codec, unchanged=unchanged)
+            self.container_filename = os.path.abspath(path)
+            self.container_files = {name: (name, version) for name, version in versions.items()}
+        else:
+            self.container_filename = None
+            self.container_files = {}
+            codec = session.GetConfig("project_codec", compression.GZIP_STREAM)
+            level = session.GetConfig("project_codec_level", None)
+            Compress(dir_temp, path, filelist, compress, codec, level)
 
         # Removing the temp folder.
         shutil.rmtree(dir_temp)
@@ -288,13 +388,35 @@ class Project(metaclass=Singleton):
             ow = vtkOutputWindow()
             ow.SetInstance(fow)
 
-        filelist = Extract(filename, tempfile.mkdtemp())
-        dirpath = os.path.abspath(os.path.split(filelist[0])[0])
-        self.load_from_folder(dirpath)
+        mapped_files = None
+        self.container_filename = None
+        if project_container.is_container(filename):
+            dirpath = os.path.abspath(tempfile.mkdtemp())
+            project_container.extract(filename, dirpath)
+            self.container_filename = os.path.abspath(filename)
+        elif IsUncompressed(filename):
+            # The image matrix and masks are mapped from the project file,
+            # only the small files are extracted.
+            filelist, mapped_files = ExtractMapped(filename, tempfile.mkdtemp())
+            dirpath = os.path.abspath(os.path.split(filelist[0])[0])
+        else:
+            filelist = Extract(filename, tempfile.mkdtemp())
+            dirpath = os.path.abspath(os.path.split(filelist[0])[0])
+        self.load_from_folder(dirpath, mapped_files)
 
-    def load_from_folder(self, dirpath):
+    def _add_container_file(self, container_name, name, version):
         """
-        Loads invesalius3 project files from dipath.
+        Keeps the name inside the opened project file of the file saved as
+        name (plus the extension, the masks are renumbered when opened).
+        """
+        ext = os.path.splitext(container_name)[1]
+        self.container_files[name + ext] = (container_name, version)
+
+    def load_from_folder(self, dirpath, mapped_files=None):
+        """
+        Loads invesalius3 project files from dipath. mapped_files maps the
+        names of the files not extracted to dirpath to (project file path,
+        offset), see ExtractMapped.
         """
         import invesalius.data.mask as msk
         import invesalius.data.measures as ms
@@ -324,9 +446,28 @@ class Project(metaclass=Singleton):
 
         # Opening the matrix containing the slices
         filepath: str = os.path.join(dirpath, project["matrix"]["filename"])
+        matrix_format = project["matrix"].get("format", const.PROJECT_STORAGE_RAW)
+        if matrix_format == const.PROJECT_STORAGE_CHUNKED:
+            # The slices are used as a memmap, so the chunked matrix is
+            # decompressed into the project folder.
+            chunked_filepath = filepath
+            filepath = os.path.splitext(chunked_filepath)[0] + ".dat"
+            carray = ChunkedArray(chunked_filepath)
+            carray.to_memmap(filepath)
+            carray.close()
+            os.remove(chunked_filepath)
+        self.matrix_offset = 0
+        if mapped_files and project["matrix"]["filename"] in mapped_files:
+            filepath, self.matrix_offset = mapped_files[project["matrix"]["filename"]]
         self.matrix_filename = filepath
         self.matrix_shape = project["matrix"]["shape"]
         self.matrix_dtype = project["matrix"]["dtype"]
+        self.container_files = {}
+        self._add_container_file(
+            project["matrix"]["filename"],
+            "matrix",
+            (self.matrix_filename, self.matrix_version),
+        )
 
         if project.get("affine", ""):
             self.affine = project["affine"]
@@ -343,9 +484,10 @@ class Project(metaclass=Singleton):
             filepath = os.path.join(dirpath, filename)
             m = msk.Mask()
             m.spacing = self.spacing
-            m.OpenPList(filepath)
+            mask_file = m.OpenPList(filepath, mapped_files)
             m.index = len(self.mask_dict)
             self.mask_dict[m.index] = m
+            self._add_container_file(mask_file, "mask_%d" % m.index, m.version)
 
         # Opening the surfaces
         self.surface_dict: dict[int, srf.Surface] = {}
@@ -423,9 +565,13 @@ class Project(metaclass=Singleton):
 
         import invesalius.data.slice_ as slc
 
+        session = ses.Session()
+        codec = session.GetConfig("hdf5_codec", compression.ZlibCodec.name)
+        level = session.GetConfig("hdf5_codec_level", None)
+
         s = slc.Slice()
         with h5py.File(filename, "w") as f:
-            f["image"] = s.matrix
+            compression.write_hdf5_dataset(f, "image", s.matrix, codec, level)
             f["spacing"] = s.spacing
 
             f["invesalius_version"] = const.INVESALIUS_VERSION
@@ -444,7 +590,9 @@ class Project(metaclass=Singleton):
                     s.do_threshold_to_all_slices(mask)
                     key = f"masks/{index}"
                     f[key + "/name"] = mask.name
-                    f[key + "/matrix"] = mask.matrix[1:, 1:, 1:]
+                    compression.write_hdf5_dataset(
+                        f, key + "/matrix", mask.matrix[1:, 1:, 1:], codec, level
+                    )
                     f[key + "/colour"] = mask.colour[:3]
                     f[key + "/opacity"] = mask.opacity
                     f[key + "/threshold_range"] = mask.threshold_range
@@ -485,7 +633,15 @@ def Compress(
     filename: Union[str, os.PathLike],
     filelist: Dict[Union[str, os.PathLike], Union[str, os.PathLike]],
     compress: bool = False,
+    codec: Optional[str] = None,
+    level: Optional[int] = None,
+    n_threads: Optional[int] = None,
 ) -> None:
+    """
+    Creates the tar project file filename with the files in filelist. When
+    compress is True the tar is compressed in parallel with codec: gzip (the
+    default, readable by all InVesalius versions) or zstd.
+    """
     tmpdir, tmpdir_ = os.path.split(folder)
     # current_dir = os.path.abspath(".")
     fd_inv3, temp_inv3 = tempfile.mkstemp()
@@ -495,13 +651,18 @@ def Compress(
     temp_inv3 = decode(temp_inv3, const.FS_ENCODE)
     # os.chdir(tmpdir)
     # file_list = glob.glob(os.path.join(tmpdir_,"*"))
-    if compress:
-        tar = tarfile.open(temp_inv3, "w:gz")
-    else:
-        tar = tarfile.open(temp_inv3, "w")
-    for name in filelist:
-        tar.add(name, arcname=os.path.join(tmpdir_, filelist[name]))
-    tar.close()
+    with open(temp_inv3, "wb") as f:
+        if compress:
+            fileobj = compression.stream_writer(f, codec, level, n_threads)
+            tar = tarfile.open(fileobj=fileobj, mode="w|")
+        else:
+            fileobj = None
+            tar = tarfile.open(fileobj=f, mode="w")
+        for name in filelist:
+            tar.add(name, arcname=os.path.join(tmpdir_, filelist[name]))
+        tar.close()
+        if fileobj is not None:
+            fileobj.close()
     os.close(fd_inv3)
     shutil.move(temp_inv3, filename)
     # os.chdir(current_dir)
@@ -512,11 +673,18 @@ def Extract(filename: Union[str, bytes, os.PathLike], folder: Union[str, bytes,
         folder = win32api.GetShortPathName(folder)
     folder = decode(folder, const.FS_ENCODE)
 
-    tar = tarfile.open(filename, "r")
-    idir = decode(os.path.split(tar.getnames()[0])[0], "utf8")
-    os.mkdir(os.path.join(folder, idir))
+    if compression.is_zstd_stream(filename):
+        # Read as a stream, the members are extracted in order.
+        fileobj = compression.stream_reader(open(filename, "rb"))
+        tar = tarfile.open(fileobj=fileobj, mode="r|")
+    else:
+        fileobj = None
+        tar = tarfile.open(filename, "r")
     filelist = []
-    for t in tar.getmembers():
+    for t in tar:
+        if not filelist:
+            idir = decode(os.path.split(t.name)[0], "utf8")
+            os.mkdir(os.path.join(folder, idir))
         fsrc = tar.extractfile(t)
         if fsrc is None:
             raise Exception("Error extracting file")
@@ -529,9 +697,57 @@ def Extract(filename: Union[str, bytes, os.PathLike], folder: Union[str, bytes,
         del fsrc
         del fdst
     tar.close()
+    if fileobj is not None:
+        fileobj.close()
     return filelist
 
 
+def IsUncompressed(filename: Union[str, bytes, os.PathLike]) -> bool:
+    """
+    Returns True if filename is an uncompressed tar project file.
+    """
+    try:
+        with tarfile.open(filename, "r:"):
+            return True
+    except tarfile.ReadError:
+        return False
+
+
+def ExtractMapped(
+    filename: Union[str, bytes, os.PathLike], folder: Union[str, bytes, os.PathLike]
+) -> Tuple[List[str], Dict[str, Tuple[str, int]]]:
+    """
+    Extracts the files from the uncompressed project file filename, except
+    the raw volumes (.dat). Returns the list of extracted files and a dict
+    mapping the name of each volume not extracted to (filename, offset of
+    its data in filename), so they can be memory mapped.
+    """
+    if _has_win32api:
+        folder = win32api.GetShortPathName(folder)
+    folder = decode(folder, const.FS_ENCODE)
+    filename = os.path.abspath(filename)
+
+    filelist = []
+    mapped_files = {}
+    with tarfile.open(filename, "r:") as tar:
+        idir = decode(os.path.split(tar.getnames()[0])[0], "utf8")
+        os.mkdir(os.path.join(folder, idir))
+        for t in tar.getmembers():
+            name = decode(t.name, "utf-8")
+            if t.isfile() and name.endswith(".dat"):
+                mapped_files[os.path.basename(name)] = (filename, t.offset_data)
+                continue
+            fsrc = tar.extractfile(t)
+            if fsrc is None:
+                raise Exception("Error extracting file")
+            fname = os.path.join(folder, name)
+            with open(fname, "wb") as fdst:
+                shutil.copyfileobj(fsrc, fdst)
+            fsrc.close()
+            filelist.append(fname)
+    return filelist, mapped_files
+
+
 def Extract_(
     filename: Union[str, bytes, os.PathLike], folder: Union[str, os.PathLike]
 ) -> List[str]:
@@ -1903,7 +1903,31 @@ class Acquisition(object):
 
 class Image(object):
     def __init__(self):
-        pass
+        self._thumbnail_path = None
+        self._data_image = None
+
+    @property
+    def thumbnail_path(self):
+        # Files read only up to the pixel data during the grouping have their
+        # thumbnail created the first time it's needed.
+        if self._thumbnail_path is None and self._data_image is not None:
+            import invesalius.reader.dicom_cache as dicom_cache
+            import invesalius.reader.dicom_reader as dicom_reader
+
+            thumbnail_path = dicom_reader.CreateDicomThumbnail(self.file, self._data_image)
+            # Kept in the header cache, so the file isn't decoded again the
+            # next time the folder is opened.
+            if thumbnail_path is not None:
+                cache = dicom_cache.open_cache()
+                if cache is not None:
+                    thumbnail_path = cache.set_thumbnail(self.file, thumbnail_path)
+                    cache.close()
+            self._thumbnail_path = thumbnail_path
+        return self._thumbnail_path
+
+    @thumbnail_path.setter
+    def thumbnail_path(self, value):
+        self._thumbnail_path = value
 
     def SetParser(self, parser):
         self.level = parser.GetImageWindowLevel()
@@ -1923,6 +1947,7 @@ class Image(object):
         # self.imagedata = parser.GetImageData()
         self.bits_allocad = parser._GetBitsAllocated()
         self.thumbnail_path = parser.thumbnail_path
+        self._data_image = parser.data_image
 
         self.number_of_frames = parser.GetNumberOfFrames()
         self.samples_per_pixel = parser.GetImageSamplesPerPixel()
@@ -0,0 +1,308 @@
+# --------------------------------------------------------------------------
+# Software:     InVesalius - Software de Reconstrucao 3D de Imagens Medicas
+# Copyright:    (C) 2001  Centro de Pesquisas Renato Archer
+# Homepage:     http://www.softwarepublico.gov.br
+# Contact:      invesalius@cti.gov.br
+# License:      GNU - GPL 2 (LICENSE.txt/LICENCA.txt)
+# --------------------------------------------------------------------------
+#    Este programa e software livre; voce pode redistribui-lo e/ou
+#    modifica-lo sob os termos da Licenca Publica Geral GNU, conforme
+#    publicada pela Free Software Foundation; de acordo com a versao 2
+#    da Licenca.
+#
+#    Este programa eh distribuido na expectativa de ser util, mas SEM
+#    QUALQUER GARANTIA; sem mesmo a garantia implicita de
+#    COMERCIALIZACAO ou de ADEQUACAO A QUALQUER PROPOSITO EM
+#    PARTICULAR. Consulte a Licenca Publica Geral GNU para obter mais
+#    detalhes.
+# --------------------------------------------------------------------------
+"""
+Persistent cache of the parsed DICOM headers and their thumbnails.
+
+The headers are stored in a SQLite database inside the user InVesalius
+folder, keyed by the file path and validated by the file size and
+modification time, so a folder that was already scanned only has its new
+or changed files parsed again. The least recently scanned files are removed
+when the cache has more than MAX_ENTRIES files. If the database fails
+during a scan (locked, corrupted, disk full, ...) the cache is disabled and
+the files are parsed as if it didn't exist.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import time
+
+import invesalius.utils as utils
+from invesalius import inv_paths
+
+CACHE_VERSION = 2
+COMMIT_INTERVAL = 256
+# Around 1 GiB of headers and thumbnails. When it's exceeded the least
+# recently scanned files are removed until only PRUNE_RATIO of it is left,
+# so the pruning doesn't run again on every scan.
+MAX_ENTRIES = 100000
+PRUNE_RATIO = 0.9
+
+
+def _thumbnail_list(thumbnail_path):
+    # Multiframe files have a list of thumbnails.
+    if thumbnail_path is None:
+        return []
+    elif isinstance(thumbnail_path, list):
+        return thumbnail_path
+    return [thumbnail_path]
+
+
+class DicomHeaderCache:
+    """
+    Maps a DICOM file path to the (data_dict, thumbnail_path) returned by
+    dicom_reader.ReadDicomHeader. Files that GDCM couldn't read are cached as
+    None so they are skipped on the next scan too. After a sqlite3.Error the
+    cache is disabled: get always misses and put doesn't store.
+    """
+
+    def __init__(self, folder=None, max_entries=MAX_ENTRIES):
+        if folder is None:
+            folder = inv_paths.USER_DICOM_CACHE_DIR
+        self.folder = str(folder)
+        self.thumbnails_folder = os.path.join(self.folder, "thumbnails")
+        self.max_entries = max_entries
+        os.makedirs(self.thumbnails_folder, exist_ok=True)
+
+        self._connection = sqlite3.connect(
+            os.path.join(self.folder, "headers.sqlite"), check_same_thread=False
+        )
+        columns = [
+            row[1] for row in self._connection.execute("PRAGMA table_info(headers)").fetchall()
+        ]
+        # Caches created by older versions don't have the access time.
+        if columns and "accessed" not in columns:
+            self._connection.execute("DROP TABLE headers")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS headers ("
+            "filepath TEXT PRIMARY KEY, "
+            "size INTEGER NOT NULL, "
+            "mtime INTEGER NOT NULL, "
+            "version INTEGER NOT NULL, "
+            "header TEXT, "
+            "thumbnail TEXT, "
+            "accessed INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS headers_accessed ON headers (accessed)"
+        )
+        self._connection.commit()
+        self._pending = 0
+        self._now = int(time.time())
+        self._disabled = False
+
+    def _disable(self, err):
+        utils.debug("DICOM header cache disabled: {}".format(err))
+        self._disabled = True
+
+    def _stat(self, filepath):
+        st = os.stat(filepath)
+        return st.st_size, st.st_mtime_ns
+
+    def get(self, filepath):
+        """
+        Return the cached (data_dict, thumbnail_path) of filepath, or None if
+        filepath is not a DICOM file. Raises KeyError if filepath is not in
+        the cache or was modified since it was cached.
+        """
+        if self._disabled:
+            raise KeyError(filepath)
+        try:
+            size, mtime = self._stat(filepath)
+        except OSError:
+            raise KeyError(filepath)
+
+        try:
+            row = self._connection.execute(
+                "SELECT size, mtime, version, header, thumbnail FROM headers WHERE filepath = ?",
+                (filepath,),
+            ).fetchone()
+            if row is None:
+                raise KeyError(filepath)
+
+            c_size, c_mtime, c_version, header, thumbnail = row
+            if c_size != size or c_mtime != mtime or c_version != CACHE_VERSION:
+                raise KeyError(filepath)
+
+            self._connection.execute(
+                "UPDATE headers SET accessed = ? WHERE filepath = ?", (self._now, filepath)
+            )
+            self._count_pending()
+        except sqlite3.Error as err:
+            self._disable(err)
+            raise KeyError(filepath)
+
+        if header is None:
+            return None
+
+        thumbnail_path = json.loads(thumbnail)
+        if not all(os.path.exists(t) for t in _thumbnail_list(thumbnail_path)):
+            raise KeyError(filepath)
+
+        return json.loads(header), thumbnail_path
+
+    def put(self, filepath, header):
+        """
+        Store the header of filepath returned by ReadDicomHeader. The
+        thumbnails are moved into the cache folder, so the returned header
+        (with the new thumbnail paths) must be used instead of the given one.
+        """
+        if self._disabled:
+            return header
+        try:
+            size, mtime = self._stat(filepath)
+        except OSError:
+            return header
+
+        if header is None:
+            values = (filepath, size, mtime, CACHE_VERSION, None, None, self._now)
+        else:
+            data_dict, thumbnail_path = header
+            if thumbnail_path is not None:
+                thumbnail_path = self._store_thumbnails(filepath, thumbnail_path)
+            header = data_dict, thumbnail_path
+            values = (
+                filepath,
+                size,
+                mtime,
+                CACHE_VERSION,
+                json.dumps(data_dict),
+                json.dumps(thumbnail_path),
+                self._now,
+            )
+
+        try:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO headers "
+                "(filepath, size, mtime, version, header, thumbnail, accessed) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                values,
+            )
+            self._count_pending()
+        except sqlite3.Error as err:
+            self._disable(err)
+        return header
+
+    def set_thumbnail(self, filepath, thumbnail_path):
+        """
+        Store the thumbnail created on demand (see
+        dicom_reader.CreateDicomThumbnail) of a file cached with its header
+        only. Returns the path of the thumbnail to be used, which is the
+        given one if filepath is not in the cache.
+        """
+        try:
+            data_dict, cached_thumbnail = self.get(filepath)
+        except (KeyError, TypeError):
+            return thumbnail_path
+        if cached_thumbnail is not None:
+            return thumbnail_path
+
+        thumbnail_path = self._store_thumbnails(filepath, thumbnail_path)
+        try:
+            self._connection.execute(
+                "UPDATE headers SET thumbnail = ? WHERE filepath = ?",
+                (json.dumps(thumbnail_path), filepath),
+            )
+            self.commit()
+        except sqlite3.Error as err:
+            self._disable(err)
+        return thumbnail_path
+
+    def _count_pending(self):
+        self._pending += 1
+        if self._pending >= COMMIT_INTERVAL:
+            self.commit()
+
+    def _store_thumbnails(self, filepath, thumbnail_path):
+        key = hashlib.sha1(filepath.encode("utf-8", "surrogateescape")).hexdigest()
+        if isinstance(thumbnail_path, list):
+            return [
+                self._move_thumbnail(t, "{}_{}.png".format(key, n))
+                for n, t in enumerate(thumbnail_path)
+            ]
+        return self._move_thumbnail(thumbnail_path, "{}.png".format(key))
+
+    def _move_thumbnail(self, thumbnail_path, name):
+        cached_path = os.path.join(self.thumbnails_folder, name)
+        try:
+            shutil.move(thumbnail_path, cached_path)
+        except OSError as err:
+            utils.debug("Could not cache thumbnail {}: {}".format(thumbnail_path, err))
+            return thumbnail_path
+        return cached_path
+
+    def commit(self):
+        self._connection.commit()
+        self._pending = 0
+
+    def prune(self):
+        """
+        Remove the least recently scanned files, and their thumbnails, when
+        there are more than max_entries files in the cache.
+        """
+        if self._disabled:
+            return
+        try:
+            (count,) = self._connection.execute("SELECT COUNT(*) FROM headers").fetchone()
+            if count <= self.max_entries:
+                return
+            n_remove = count - int(self.max_entries * PRUNE_RATIO)
+            rows = self._connection.execute(
+                "SELECT filepath, thumbnail FROM headers ORDER BY accessed LIMIT ?", (n_remove,)
+            ).fetchall()
+            self._connection.executemany(
+                "DELETE FROM headers WHERE filepath = ?", [(row[0],) for row in rows]
+            )
+            self.commit()
+        except sqlite3.Error as err:
+            self._disable(err)
+            return
+        # The thumbnails are removed after their rows are deleted, so the
+        # cache never points to missing thumbnails.
+        for filepath, thumbnail in rows:
+            thumbnail_path = json.loads(thumbnail) if thumbnail else None
+            for t in _thumbnail_list(thumbnail_path):
+                # Only the thumbnails moved into the cache folder are owned by it.
+                if os.path.dirname(t) == self.thumbnails_folder:
+                    try:
+                        os.remove(t)
+                    except OSError:
+                        pass
+
+    def close(self):
+        self.prune()
+        try:
+            if not self._disabled:
+                self.commit()
+            self._connection.close()
+        except sqlite3.Error as err:
+            utils.debug("Could not close the DICOM header cache: {}".format(err))
+
+    def clear(self):
+        """
+        Remove every cached header and thumbnail.
+        """
+        self._connection.execute("DELETE FROM headers")
+        self.commit()
+        shutil.rmtree(self.thumbnails_folder, ignore_errors=True)
+        os.makedirs(self.thumbnails_folder, exist_ok=True)
+
+
+def open_cache():
+    """
+    Return the user DicomHeaderCache, or None if it couldn't be opened (e.g.
+    read-only home folder). The DICOM scan works without it.
+    """
+    try:
+        return DicomHeaderCache()
+    except (OSError, sqlite3.Error) as err:
+        utils.debug("Could not open the DICOM header cache: {}".format(err))
+        return None
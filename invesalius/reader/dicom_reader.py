@@ -16,6 +16,8 @@
 #    PARTICULAR. Consulte a Licenca Publica Geral GNU para obter mais
 #    detalhes.
 # --------------------------------------------------------------------------
+import functools
+import multiprocessing
 import os
 import sys
 import tempfile
@@ -38,6 +40,7 @@ from vtkmodules.vtkCommonCore import vtkFileOutputWindow, vtkOutputWindow
 
 import invesalius.constants as const
 import invesalius.reader.dicom as dicom
+import invesalius.reader.dicom_cache as dicom_cache
 import invesalius.reader.dicom_grouper as dicom_grouper
 import invesalius.session as ses
 import invesalius.utils as utils
@@ -114,212 +117,330 @@ class LoadDicom:
         self.run()
 
     def run(self):
-        grouper = self.grouper
-        reader = gdcm.ImageReader()
-        if _has_win32api:
-            try:
-                reader.SetFileName(
-                    utils.encode(win32api.GetShortPathName(self.filepath), const.FS_ENCODE)
-                )
-            except TypeError:
-                reader.SetFileName(win32api.GetShortPathName(self.filepath))
-        else:
-            try:
-                reader.SetFileName(utils.encode(self.filepath, const.FS_ENCODE))
-            except TypeError:
-                reader.SetFileName(self.filepath)
-        if reader.Read():
-            file = reader.GetFile()
-            # Retrieve data set
-            dataSet = file.GetDataSet()
-            # Retrieve header
-            header = file.GetHeader()
-            stf = gdcm.StringFilter()
-            stf.SetFile(file)
-
-            field_dict = {}
-            data_dict = {}
-
-            tag = gdcm.Tag(0x0008, 0x0005)
-            ds = reader.GetFile().GetDataSet()
-            image_helper = gdcm.ImageHelper()
-            data_dict["spacing"] = image_helper.GetSpacingValue(reader.GetFile())
-            if ds.FindDataElement(tag):
-                data_element = ds.GetDataElement(tag)
-                if data_element.IsEmpty():
-                    encoding_value = "ISO_IR 100"
-                else:
-                    encoding_value = str(ds.GetDataElement(tag).GetValue()).split("\\")[0]
-
-                if encoding_value.startswith("Loaded"):
-                    encoding = "ISO_IR 100"
-                else:
-                    try:
-                        encoding = const.DICOM_ENCODING_TO_PYTHON[encoding_value]
-                    except KeyError:
-                        encoding = "ISO_IR 100"
-            else:
-                encoding = "ISO_IR 100"
+        header = ReadDicomHeader(self.filepath)
+        if header is not None:
+            data_dict, thumbnail_path = header
+            AddDicomToGrouper(self.grouper, self.filepath, data_dict, thumbnail_path)
 
-            # Iterate through the Header
-            iterator = header.GetDES().begin()
-            while not iterator.equal(header.GetDES().end()):
-                dataElement = iterator.next()
-                if not dataElement.IsUndefinedLength():
-                    tag = dataElement.GetTag()
-                    data = stf.ToStringPair(tag)
-                    stag = tag.PrintAsPipeSeparatedString()
 
-                    group = str(tag.GetGroup())
-                    field = str(tag.GetElement())
+# The parallel scan starts a worker process for each MIN_FILES_PER_WORKER
+# files to parse at most, small folders are parsed by this process.
+MIN_FILES_PER_WORKER = 32
 
-                    tag_labels[stag] = data[0]
+PIXEL_DATA_TAG = gdcm.Tag(0x7FE0, 0x0010)
+ROWS_TAG = gdcm.Tag(0x0028, 0x0010)
 
-                    if not group in data_dict.keys():
-                        data_dict[group] = {}
 
-                    if not (utils.VerifyInvalidPListCharacter(data[1])):
-                        data_dict[group][field] = utils.decode(data[1], encoding)
-                    else:
-                        data_dict[group][field] = "Invalid Character"
+def _SetReaderFileName(reader, filepath):
+    if _has_win32api:
+        try:
+            reader.SetFileName(utils.encode(win32api.GetShortPathName(filepath), const.FS_ENCODE))
+        except TypeError:
+            reader.SetFileName(win32api.GetShortPathName(filepath))
+    else:
+        try:
+            reader.SetFileName(utils.encode(filepath, const.FS_ENCODE))
+        except TypeError:
+            reader.SetFileName(filepath)
 
-            # Iterate through the Data set
-            iterator = dataSet.GetDES().begin()
-            while not iterator.equal(dataSet.GetDES().end()):
-                dataElement = iterator.next()
-                if not dataElement.IsUndefinedLength():
-                    tag = dataElement.GetTag()
-                    #  if (tag.GetGroup() == 0x0009 and tag.GetElement() == 0x10e3) \
-                    #  or (tag.GetGroup() == 0x0043 and tag.GetElement() == 0x1027):
-                    #  continue
-                    data = stf.ToStringPair(tag)
-                    stag = tag.PrintAsPipeSeparatedString()
 
-                    group = str(tag.GetGroup())
-                    field = str(tag.GetElement())
+def _GetThumbnailWindowLevel(data_dict):
+    try:
+        data = data_dict[str(0x028)][str(0x1050)]
+        level = [float(value) for value in data.split("\\")][0]
+        data = data_dict[str(0x028)][str(0x1051)]
+        window = [float(value) for value in data.split("\\")][0]
+    except (KeyError, ValueError):
+        level = None
+        window = None
+    return window, level
 
-                    tag_labels[stag] = data[0]
 
-                    if not group in data_dict.keys():
-                        data_dict[group] = {}
+def ReadDicomHeader(filepath, header_only=False):
+    """
+    Parse the header of the given DICOM file and create its thumbnail.
 
-                    if not (utils.VerifyInvalidPListCharacter(data[1])):
-                        data_dict[group][field] = utils.decode(data[1], encoding, "replace")
-                    else:
-                        data_dict[group][field] = "Invalid Character"
+    If header_only is True the file is read only up to the pixel data, which
+    is neither decoded nor used to create the thumbnail (thumbnail_path is
+    None, see CreateDicomThumbnail).
 
-            # -------------- To Create DICOM Thumbnail -----------
+    Returns a tuple (data_dict, thumbnail_path) containing only plain python
+    objects, so it can be returned from a worker process, or None if the file
+    couldn't be read by GDCM.
+    """
+    if header_only:
+        reader = gdcm.Reader()
+        _SetReaderFileName(reader, filepath)
+        if not reader.ReadUpToTag(PIXEL_DATA_TAG):
+            return None
+        # Same files gdcm.ImageReader would refuse: the ones without image.
+        if not reader.GetFile().GetDataSet().FindDataElement(ROWS_TAG):
+            return None
+    else:
+        reader = gdcm.ImageReader()
+        _SetReaderFileName(reader, filepath)
+        if not reader.Read():
+            return None
+
+    file = reader.GetFile()
+    # Retrieve data set
+    dataSet = file.GetDataSet()
+    # Retrieve header
+    header = file.GetHeader()
+    stf = gdcm.StringFilter()
+    stf.SetFile(file)
+
+    data_dict = {}
+
+    tag = gdcm.Tag(0x0008, 0x0005)
+    ds = reader.GetFile().GetDataSet()
+    image_helper = gdcm.ImageHelper()
+    data_dict["spacing"] = image_helper.GetSpacingValue(reader.GetFile())
+    if ds.FindDataElement(tag):
+        data_element = ds.GetDataElement(tag)
+        if data_element.IsEmpty():
+            encoding_value = "ISO_IR 100"
+        else:
+            encoding_value = str(ds.GetDataElement(tag).GetValue()).split("\\")[0]
 
+        if encoding_value.startswith("Loaded"):
+            encoding = "ISO_IR 100"
+        else:
             try:
-                data = data_dict[str(0x028)][str(0x1050)]
-                level = [float(value) for value in data.split("\\")][0]
-                data = data_dict[str(0x028)][str(0x1051)]
-                window = [float(value) for value in data.split("\\")][0]
-            except (KeyError, ValueError):
-                level = None
-                window = None
+                encoding = const.DICOM_ENCODING_TO_PYTHON[encoding_value]
+            except KeyError:
+                encoding = "ISO_IR 100"
+    else:
+        encoding = "ISO_IR 100"
 
-            img = reader.GetImage()
-            thumbnail_path = imagedata_utils.create_dicom_thumbnails(img, window, level)
+    # Iterate through the Header
+    iterator = header.GetDES().begin()
+    while not iterator.equal(header.GetDES().end()):
+        dataElement = iterator.next()
+        if not dataElement.IsUndefinedLength():
+            tag = dataElement.GetTag()
+            data = stf.ToStringPair(tag)
+            stag = tag.PrintAsPipeSeparatedString()
 
-            # ------ Verify the orientation --------------------------------
+            group = str(tag.GetGroup())
+            field = str(tag.GetElement())
 
-            direc_cosines = img.GetDirectionCosines()
-            orientation = gdcm.Orientation()
-            try:
-                _type = orientation.GetType(tuple(direc_cosines))
-            except TypeError:
-                _type = orientation.GetType(direc_cosines)
-            label = orientation.GetLabel(_type)
+            tag_labels[stag] = data[0]
 
-            # ----------   Refactory --------------------------------------
-            data_dict["invesalius"] = {"orientation_label": label}
+            if not group in data_dict.keys():
+                data_dict[group] = {}
 
-            # -------------------------------------------------------------
-            dict_file[self.filepath] = data_dict
+            if not (utils.VerifyInvalidPListCharacter(data[1])):
+                data_dict[group][field] = utils.decode(data[1], encoding)
+            else:
+                data_dict[group][field] = "Invalid Character"
+
+    # Iterate through the Data set
+    iterator = dataSet.GetDES().begin()
+    while not iterator.equal(dataSet.GetDES().end()):
+        dataElement = iterator.next()
+        if not dataElement.IsUndefinedLength():
+            tag = dataElement.GetTag()
+            #  if (tag.GetGroup() == 0x0009 and tag.GetElement() == 0x10e3) \
+            #  or (tag.GetGroup() == 0x0043 and tag.GetElement() == 0x1027):
+            #  continue
+            data = stf.ToStringPair(tag)
+            stag = tag.PrintAsPipeSeparatedString()
+
+            group = str(tag.GetGroup())
+            field = str(tag.GetElement())
+
+            tag_labels[stag] = data[0]
+
+            if not group in data_dict.keys():
+                data_dict[group] = {}
+
+            if not (utils.VerifyInvalidPListCharacter(data[1])):
+                data_dict[group][field] = utils.decode(data[1], encoding, "replace")
+            else:
+                data_dict[group][field] = "Invalid Character"
 
-            # ----------  Verify is DICOMDir -------------------------------
-            is_dicom_dir = 1
-            try:
-                if data_dict[str(0x002)][str(0x002)] != "1.2.840.10008.1.3.10":  # DICOMDIR
-                    is_dicom_dir = 0
-            except KeyError:
-                is_dicom_dir = 0
+    # -------------- To Create DICOM Thumbnail -----------
+
+    if header_only:
+        thumbnail_path = None
+        direc_cosines = image_helper.GetDirectionCosinesValue(reader.GetFile())
+    else:
+        window, level = _GetThumbnailWindowLevel(data_dict)
+        img = reader.GetImage()
+        thumbnail_path = imagedata_utils.create_dicom_thumbnails(img, window, level)
+        direc_cosines = img.GetDirectionCosines()
 
-            if not (is_dicom_dir):
-                parser = dicom.Parser()
-                parser.SetDataImage(dict_file[self.filepath], self.filepath, thumbnail_path)
+    # ------ Verify the orientation --------------------------------
 
-                dcm = dicom.Dicom()
-                # self.l.acquire()
-                dcm.SetParser(parser)
-                grouper.AddFile(dcm)
+    orientation = gdcm.Orientation()
+    try:
+        _type = orientation.GetType(tuple(direc_cosines))
+    except TypeError:
+        _type = orientation.GetType(direc_cosines)
+    label = orientation.GetLabel(_type)
 
-                # self.l.release()
+    # ----------   Refactory --------------------------------------
+    data_dict["invesalius"] = {"orientation_label": label}
 
-        # ==========  used in test =======================================
-        # print dict_file
-        # main_dict = dict(
-        #                data  = dict_file,
-        #                labels  = tag_labels)
-        # print main_dict
-        # print "\n"
-        # plistlib.writePlist(main_dict, ".//teste.plist")
+    return data_dict, thumbnail_path
 
 
-def yGetDicomGroups(directory, recursive=True, gui=True):
+def CreateDicomThumbnail(filepath, data_dict):
     """
-    Return all full paths to DICOM files inside given directory.
+    Decode the pixel data of the given DICOM file and create its thumbnail.
+    Used to create on demand the thumbnails of the files read with
+    ReadDicomHeader(header_only=True).
     """
-    nfiles = 0
-    # Find total number of files
-    if recursive:
-        for dirpath, dirnames, filenames in os.walk(directory):
-            nfiles += len(filenames)
-    else:
-        dirpath, dirnames, filenames = os.walk(directory)
-        nfiles = len(filenames)
+    reader = gdcm.ImageReader()
+    _SetReaderFileName(reader, filepath)
+    if not reader.Read():
+        return None
+    window, level = _GetThumbnailWindowLevel(data_dict)
+    return imagedata_utils.create_dicom_thumbnails(reader.GetImage(), window, level)
 
-    counter = 0
-    grouper = dicom_grouper.DicomPatientGrouper()
-    # q = Queue.Queue()
-    # l = threading.Lock()
-    # threads = []
-    # for i in xrange(cpu_count()):
-    #    t = LoadDicom(grouper, q, l)
-    #    t.start()
-    #    threads.append(t)
-    # Retrieve only DICOM files, splited into groups
+
+def AddDicomToGrouper(grouper, filepath, data_dict, thumbnail_path):
+    """
+    Add the DICOM file described by data_dict to grouper. Only the process
+    owning the grouper should call it.
+    """
+    dict_file[filepath] = data_dict
+
+    # ----------  Verify is DICOMDir -------------------------------
+    is_dicom_dir = 1
+    try:
+        if data_dict[str(0x002)][str(0x002)] != "1.2.840.10008.1.3.10":  # DICOMDIR
+            is_dicom_dir = 0
+    except KeyError:
+        is_dicom_dir = 0
+
+    if not (is_dicom_dir):
+        parser = dicom.Parser()
+        parser.SetDataImage(dict_file[filepath], filepath, thumbnail_path)
+
+        dcm = dicom.Dicom()
+        dcm.SetParser(parser)
+        grouper.AddFile(dcm)
+
+
+def _read_dicom_header_worker(filepath, header_only=False):
+    """
+    Used by yGetDicomGroups. Runs in a worker process in the parallel scan.
+    """
+    return filepath, ReadDicomHeader(filepath, header_only)
+
+
+def ListDicomFiles(directory, recursive=True):
+    """
+    Return the full path of every file inside the given directory, in
+    os.walk order.
+    """
+    filepaths = []
     if recursive:
         for dirpath, dirnames, filenames in os.walk(directory):
             for name in filenames:
-                filepath = os.path.join(dirpath, name)
-                counter += 1
-                if gui:
-                    yield (counter, nfiles)
-                LoadDicom(grouper, filepath)
+                filepaths.append(os.path.join(dirpath, name))
     else:
-        dirpath, dirnames, filenames = os.walk(directory)
+        dirpath, dirnames, filenames = next(os.walk(directory))
         for name in filenames:
-            filepath = str(os.path.join(dirpath, name))
+            filepaths.append(str(os.path.join(dirpath, name)))
+    return filepaths
+
+
+def yGetDicomGroups(
+    directory, recursive=True, gui=True, n_workers=1, use_cache=True, header_only=True
+):
+    """
+    Return all full paths to DICOM files inside given directory.
+
+    If n_workers is greater than 1 the DICOM headers are parsed by a pool of
+    n_workers processes (n_workers <= 0 means one per CPU), limited to one
+    process for each MIN_FILES_PER_WORKER files to parse. Only this process
+    touches the grouper and the files are added in os.walk order, so the
+    groups are the same as the ones from the serial scan.
+
+    If use_cache is True, headers from files not modified since the last
+    scan are read from the DicomHeaderCache instead of being parsed again.
+
+    If header_only is True the pixel data is not read while grouping, the
+    thumbnails are created only when they are first shown.
+    """
+    filepaths = [utils.decode(f, const.FS_ENCODE) for f in ListDicomFiles(directory, recursive)]
+    nfiles = len(filepaths)
+
+    cache = dicom_cache.open_cache() if use_cache else None
+
+    headers = {}
+    missing = []
+    if cache is None:
+        missing = filepaths
+    else:
+        for filepath in filepaths:
+            try:
+                headers[filepath] = cache.get(filepath)
+            except KeyError:
+                missing.append(filepath)
+
+    counter = nfiles - len(missing)
+    if gui and counter:
+        yield (counter, nfiles)
+
+    if n_workers is None:
+        n_workers = 1
+    elif n_workers <= 0:
+        n_workers = cpu_count()
+    n_workers = min(n_workers, len(missing) // MIN_FILES_PER_WORKER)
+
+    read_header = functools.partial(_read_dicom_header_worker, header_only=header_only)
+
+    pool = None
+    if n_workers > 1:
+        chunksize = max(1, min(16, len(missing) // (n_workers * 4)))
+        ctx = multiprocessing.get_context("spawn")
+        pool = ctx.Pool(processes=n_workers)
+        results = pool.imap(read_header, missing, chunksize=chunksize)
+    else:
+        results = map(read_header, missing)
+
+    try:
+        for filepath, header in results:
             counter += 1
             if gui:
                 yield (counter, nfiles)
-            # q.put(filepath)
-
-    # for t in threads:
-    #    q.put(0)
+            if cache is not None:
+                header = cache.put(filepath, header)
+            headers[filepath] = header
+    finally:
+        if pool is not None:
+            pool.terminate()
+        if cache is not None:
+            cache.close()
 
-    # for t in threads:
-    #    t.join()
+    # Retrieve only DICOM files, splited into groups
+    grouper = dicom_grouper.DicomPatientGrouper()
+    for filepath in filepaths:
+        header = headers[filepath]
+        if header is not None:
+            data_dict, thumbnail_path = header
+            AddDicomToGrouper(grouper, filepath, data_dict, thumbnail_path)
 
     # TODO: Is this commented update necessary?
     # grouper.Update()
     yield grouper.GetPatientsGroups()
 
 
-def GetDicomGroups(directory, recursive=True):
-    return next(yGetDicomGroups(directory, recursive, gui=False))
+def GetDicomGroups(directory, recursive=True, n_workers=1, use_cache=True, header_only=True):
+    return next(
+        yGetDicomGroups(
+            directory,
+            recursive,
+            gui=False,
+            n_workers=n_workers,
+            use_cache=use_cache,
+            header_only=header_only,
+        )
+    )
 
 
 class ProgressDicomReader:
@@ -333,10 +454,12 @@ class ProgressDicomReader:
     def SetWindowEvent(self, frame):
         self.frame = frame
 
-    def SetDirectoryPath(self, path, recursive=True):
+    def SetDirectoryPath(self, path, recursive=True, n_workers=None):
         self.running = True
         self.stoped = False
-        self.GetDicomGroups(path, recursive)
+        if n_workers is None:
+            n_workers = ses.Session().GetConfig("import_workers", const.DEFAULT_IMPORT_WORKERS)
+        self.GetDicomGroups(path, recursive, n_workers)
 
     def UpdateLoadFileProgress(self, cont_progress):
         Publisher.sendMessage("Update dicom load", data=cont_progress)
@@ -344,7 +467,7 @@ class ProgressDicomReader:
     def EndLoadFile(self, patient_list):
         Publisher.sendMessage("End dicom load", patient_series=patient_list)
 
-    def GetDicomGroups(self, path, recursive):
+    def GetDicomGroups(self, path, recursive, n_workers=1):
         if not const.VTK_WARNING:
             log_path = utils.encode(
                 str(inv_paths.USER_LOG_DIR.joinpath("vtkoutput.txt")), const.FS_ENCODE
@@ -354,7 +477,7 @@ class ProgressDicomReader:
             ow = vtkOutputWindow()
             ow.SetInstance(fow)
 
-        y = yGetDicomGroups(path, recursive)
+        y = yGetDicomGroups(path, recursive, n_workers=n_workers)
         for value_progress in y:
             print(">>>>", value_progress)
             if not self.running:
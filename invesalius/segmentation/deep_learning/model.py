@@ -123,6 +123,36 @@ class WrapModel(torch.nn.Module):
         return torch.sigmoid(output[:, 1])
 
 
+def load_unet3d(weights_file):
+    """
+    Loads a Unet3D from the weights file (.pt) used by the segmenters.
+    """
+    state_dict = torch.load(str(weights_file), map_location=torch.device("cpu"))
+    model = Unet3D()
+    model.load_state_dict(state_dict["model_state_dict"])
+    model.eval()
+    return model
+
+
+def export_onnx(model, filename, patch_size=SIZE, opset_version=13):
+    """
+    Exports model to the ONNX file filename, used by the ONNX Runtime backend
+    of the segmenters. The batch axis is dynamic.
+    """
+    model.eval()
+    dummy_input = torch.zeros((1, 1, patch_size, patch_size, patch_size), dtype=torch.float32)
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            dummy_input,
+            str(filename),
+            input_names=["image"],
+            output_names=["probability"],
+            dynamic_axes={"image": {0: "batch"}, "probability": {0: "batch"}},
+            opset_version=opset_version,
+        )
+
+
 def main():
     import torchviz
 
@@ -0,0 +1,153 @@
+"""
+Reduced precision versions (int8 and float16) of the ONNX models used by the
+ONNX Runtime backend of the segmenters, and the functions to check their
+accuracy against the float32 model.
+
+int8 uses the static quantization of ONNX Runtime (QDQ format, weights
+quantized per channel), the range of the activations is calibrated running
+the float32 model over sample patches. float16 converts the weights and
+operations with onnxconverter_common, keeping float32 input and output.
+"""
+
+import math
+
+import numpy as np
+
+from . import segment
+
+try:
+    import onnx
+
+    _has_onnx = True
+except ImportError:
+    _has_onnx = False
+
+try:
+    from onnxruntime.quantization import (
+        CalibrationDataReader,
+        QuantFormat,
+        QuantType,
+        quantize_static,
+    )
+
+    _has_quantization = True
+except ImportError:
+    CalibrationDataReader = object
+    _has_quantization = False
+
+try:
+    from onnxconverter_common import float16
+
+    _has_float16 = True
+except ImportError:
+    _has_float16 = False
+
+CALIBRATION_PATCHES = 64
+
+
+def available_precisions(name=""):
+    """
+    Returns the precisions of the ONNX models of the segmenter name (see
+    SegmentProcess.model_name) that can be used. int8 is only available when
+    the model calibrated by scripts/quantize_segmentation.py exists, float16
+    needs onnx and onnxconverter_common to convert the float32 model.
+    """
+    precisions = [segment.PRECISION_FLOAT32]
+    if name and segment.find_onnx_file(name, segment.PRECISION_INT8) is not None:
+        precisions.append(segment.PRECISION_INT8)
+    if _has_onnx and _has_float16:
+        precisions.append(segment.PRECISION_FLOAT16)
+    return precisions
+
+
+def calibration_patches(volumes, patch_size, max_patches=CALIBRATION_PATCHES, skip_threshold=None):
+    """
+    Returns up to max_patches patches (n, patch_size, patch_size,
+    patch_size) evenly spread over the volumes, which must be normalized as
+    the input of the network. Background patches (all values <=
+    skip_threshold) are not used.
+    """
+    per_volume = math.ceil(max_patches / len(volumes))
+    patches = []
+    for volume in volumes:
+        positions = []
+        for iz, iy, ix in segment.patch_positions(volume.shape, patch_size, 0):
+            sub_image = volume[iz : iz + patch_size, iy : iy + patch_size, ix : ix + patch_size]
+            if skip_threshold is None or sub_image.max() > skip_threshold:
+                positions.append((iz, iy, ix))
+        if len(positions) > per_volume:
+            idx = np.linspace(0, len(positions) - 1, per_volume).round().astype(int)
+            positions = [positions[i] for i in idx]
+        for iz, iy, ix in positions:
+            patch = np.zeros((patch_size, patch_size, patch_size), dtype=np.float32)
+            sub_image = volume[iz : iz + patch_size, iy : iy + patch_size, ix : ix + patch_size]
+            sz, sy, sx = sub_image.shape
+            patch[0:sz, 0:sy, 0:sx] = sub_image
+            patches.append(patch)
+    return np.array(patches[:max_patches], dtype=np.float32)
+
+
+class PatchCalibrationReader(CalibrationDataReader):
+    """
+    Feeds the calibration patches, one at a time, to the ONNX Runtime
+    calibration.
+    """
+
+    def __init__(self, input_name, patches):
+        self.input_name = input_name
+        self.patches = patches
+        self._index = 0
+
+    def get_next(self):
+        if self._index >= len(self.patches):
+            return None
+        patch = self.patches[self._index]
+        self._index += 1
+        return {self.input_name: patch[np.newaxis, np.newaxis]}
+
+    def rewind(self):
+        self._index = 0
+
+
+def quantize_int8(onnx_file, output_file, patches):
+    """
+    Writes to output_file the int8 version of the float32 model onnx_file,
+    calibrated with patches (see calibration_patches).
+    """
+    if not _has_onnx or not _has_quantization:
+        raise ValueError("The int8 quantization needs the onnx and onnxruntime modules")
+    if not len(patches):
+        raise ValueError("No patches to calibrate the int8 quantization")
+    input_name = onnx.load(str(onnx_file)).graph.input[0].name
+    quantize_static(
+        str(onnx_file),
+        str(output_file),
+        PatchCalibrationReader(input_name, patches),
+        quant_format=QuantFormat.QDQ,
+        per_channel=True,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+    )
+
+
+def convert_float16(onnx_file, output_file):
+    """
+    Writes to output_file the float16 version of the float32 model onnx_file.
+    """
+    if not _has_onnx or not _has_float16:
+        raise ValueError("The float16 conversion needs the onnx and onnxconverter_common modules")
+    model = onnx.load(str(onnx_file))
+    model = float16.convert_float_to_float16(model, keep_io_types=True)
+    onnx.save(model, str(output_file))
+
+
+def dice(mask_a, mask_b):
+    """
+    Dice coefficient of two binary masks, 1.0 when both are empty.
+    """
+    mask_a = np.asarray(mask_a, dtype=bool)
+    mask_b = np.asarray(mask_b, dtype=bool)
+    total = int(mask_a.sum()) + int(mask_b.sum())
+    if total == 0:
+        return 1.0
+    return 2.0 * int(np.logical_and(mask_a, mask_b).sum()) / total
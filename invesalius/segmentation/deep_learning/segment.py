@@ -1,4 +1,6 @@
+import importlib.util
 import itertools
+import math
 import multiprocessing
 import os
 import pathlib
@@ -11,6 +13,7 @@ from skimage.transform import resize
 from vtkmodules.vtkIOXML import vtkXMLImageDataWriter
 
 import invesalius.data.slice_ as slc
+import invesalius.session as ses
 from invesalius import inv_paths
 from invesalius.data import imagedata_utils
 from invesalius.data.converters import to_vtk
@@ -20,59 +23,249 @@ from invesalius.utils import new_name_by_pattern
 from . import utils
 
 SIZE = 48
+BATCH_SIZE = 8
+# Maximum number of voxels in a batch, big patches are run in smaller
+# batches.
+MAX_BATCH_VOXELS = BATCH_SIZE * SIZE**3
 
+ONNX_BACKEND = "ONNX Runtime"
+ONNX_CPU_PROVIDER = "CPUExecutionProvider"
 
-def gen_patches(image, patch_size, overlap):
+# Precision of the ONNX models, int8 and float16 are faster on some CPUs at
+# the cost of a small loss of accuracy (see quantization.py).
+PRECISION_FLOAT32 = "float32"
+PRECISION_INT8 = "int8"
+PRECISION_FLOAT16 = "float16"
+
+# How the predictions of overlapping patches are averaged.
+WEIGHTING_CONSTANT = "constant"
+WEIGHTING_GAUSSIAN = "gaussian"
+
+
+def get_batch_size(patch_size, batch_size=BATCH_SIZE):
+    return max(1, min(batch_size, MAX_BATCH_VOXELS // patch_size**3))
+
+
+def patch_positions(shape, patch_size, overlap):
     overlap = int(patch_size * overlap / 100)
-    sz, sy, sx = image.shape
-    i_cuts = list(
+    sz, sy, sx = shape
+    return list(
         itertools.product(
             range(0, sz, patch_size - overlap),
             range(0, sy, patch_size - overlap),
             range(0, sx, patch_size - overlap),
         )
     )
-    sub_image = np.empty(shape=(patch_size, patch_size, patch_size), dtype="float32")
-    for idx, (iz, iy, ix) in enumerate(i_cuts):
-        sub_image[:] = 0
+
+
+def gen_patch_batches(image, patch_size, overlap, batch_size, out=None, skip_threshold=None):
+    """
+    Yields the completion, a batch of patches (n, patch_size, patch_size,
+    patch_size), the region of each patch in image and the number of
+    patches skipped since the last batch. The batches are written in out (a
+    float32 array with batch_size patches, allocated if None), so each batch
+    must be used before getting the next one. Patches in the border of the
+    image are padded with 0.
+
+    If skip_threshold is not None, the patches with all the values <=
+    skip_threshold are background and skipped, their prediction is 0.
+    """
+    positions = patch_positions(image.shape, patch_size, overlap)
+    if out is None:
+        out = np.empty((batch_size, patch_size, patch_size, patch_size), dtype=np.float32)
+    patches = []
+    skipped = 0
+    for idx, (iz, iy, ix) in enumerate(positions):
         _sub_image = image[iz : iz + patch_size, iy : iy + patch_size, ix : ix + patch_size]
-        sz, sy, sx = _sub_image.shape
-        sub_image[0:sz, 0:sy, 0:sx] = _sub_image
-        ez = iz + sz
-        ey = iy + sy
-        ex = ix + sx
+        if skip_threshold is not None and _sub_image.max() <= skip_threshold:
+            skipped += 1
+        else:
+            n = len(patches)
+            sz, sy, sx = _sub_image.shape
+            if (sz, sy, sx) != (patch_size, patch_size, patch_size):
+                out[n] = 0
+            out[n, 0:sz, 0:sy, 0:sx] = _sub_image
+            patches.append(((iz, iz + sz), (iy, iy + sy), (ix, ix + sx)))
+        if len(patches) == batch_size or idx == len(positions) - 1:
+            yield (idx + 1.0) / len(positions), out[: len(patches)], patches, skipped
+            patches = []
+            skipped = 0
+
+
+def patch_weights(patch_size, weighting=WEIGHTING_CONSTANT):
+    """
+    Weights of the voxels of a patch along one axis, the weight of a voxel
+    is the product of the weights of its 3 coordinates. Gaussian weighting
+    gives less importance to the borders of the patches, where the network
+    has less context.
+    """
+    if weighting == WEIGHTING_GAUSSIAN:
+        sigma = patch_size / 8.0
+        x = np.arange(patch_size) - (patch_size - 1) / 2.0
+        return np.exp(-(x**2) / (2 * sigma**2))
+    return np.ones(patch_size)
+
+
+class PatchAggregator:
+    """
+    Weighted average of the overlapping predictions of the patches, written
+    in probability_array.
+
+    The patches are in a regular grid, so the sum of the weights of each
+    voxel is the product of a sum per axis, computed from the patch size
+    and stride, and no volume of the size of the image is needed to
+    accumulate them. Skipped patches count as predictions of 0.
+    """
+
+    def __init__(self, probability_array, patch_size, overlap, weighting=WEIGHTING_CONSTANT):
+        self.probability_array = probability_array
+        self.patch_size = patch_size
+        stride = patch_size - int(patch_size * overlap / 100)
 
-        yield (idx + 1.0) / len(i_cuts), sub_image, ((iz, ez), (iy, ey), (ix, ex))
+        weights = patch_weights(patch_size, weighting)
+        if weighting == WEIGHTING_CONSTANT:
+            self.weights = None
+        else:
+            self.weights = np.einsum("i,j,k->ijk", weights, weights, weights).astype(np.float32)
+
+        self.axis_sums = []
+        for size in probability_array.shape:
+            axis_sum = np.zeros(size)
+            for start in range(0, size, stride):
+                end = min(start + patch_size, size)
+                axis_sum[start:end] += weights[: end - start]
+            self.axis_sums.append(axis_sum)
+
+    def add(self, sub_masks, patches):
+        """
+        Adds the predicted sub_masks (n, patch_size, patch_size, patch_size)
+        to their regions in probability_array.
+        """
+        for sub_mask, ((iz, ez), (iy, ey), (ix, ex)) in zip(sub_masks, patches):
+            sub_mask = sub_mask[0 : ez - iz, 0 : ey - iy, 0 : ex - ix]
+            if self.weights is not None:
+                sub_mask = sub_mask * self.weights[0 : ez - iz, 0 : ey - iy, 0 : ex - ix]
+            self.probability_array[iz:ez, iy:ey, ix:ex] += sub_mask
+
+    def normalize(self):
+        """
+        Divides probability_array by the sum of the weights, one slice at a
+        time.
+        """
+        sum_z, sum_y, sum_x = self.axis_sums
+        sum_yx = np.outer(sum_y, sum_x)
+        for z in range(self.probability_array.shape[0]):
+            self.probability_array[z] /= sum_z[z] * sum_yx
+
+
+class TorchBatchPredictor:
+    """
+    Runs a torch model over batches of patches. The patches are written by
+    gen_patch_batches directly in the input tensor (pinned when using
+    CUDA), which is reused for all the batches, and the output of each batch
+    is copied back to the CPU once.
+    """
+
+    def __init__(self, model, device, patch_size, batch_size):
+        import torch
+
+        self.model = model
+        self.device = device
+        self.patch_size = patch_size
+        self.batch_size = batch_size
+        self.input_tensor = torch.empty(
+            (batch_size, 1, patch_size, patch_size, patch_size),
+            dtype=torch.float32,
+            pin_memory=device.type == "cuda",
+        )
+        self.buffer = self.input_tensor.numpy()[:, 0]
 
+    def __call__(self, batch):
+        import torch
 
-def predict_patch(sub_image, patch, nn_model, patch_size):
-    (iz, ez), (iy, ey), (ix, ex) = patch
-    sub_mask = nn_model.predict(sub_image.reshape(1, patch_size, patch_size, patch_size, 1))
-    return sub_mask.reshape(patch_size, patch_size, patch_size)[
-        0 : ez - iz, 0 : ey - iy, 0 : ex - ix
-    ]
+        n = len(batch)
+        with torch.no_grad():
+            input_tensor = self.input_tensor[:n].to(self.device, non_blocking=True)
+            sub_masks = self.model(input_tensor).cpu().numpy()
+        return sub_masks.reshape(n, self.patch_size, self.patch_size, self.patch_size)
 
 
-def predict_patch_torch(sub_image, patch, nn_model, device, patch_size):
-    import torch
+def segment_patches(
+    image,
+    predict,
+    overlap,
+    probability_array,
+    comm_array,
+    patch_size,
+    batch_size,
+    buffer=None,
+    weighting=WEIGHTING_CONSTANT,
+    skip_threshold=None,
+):
+    """
+    Runs predict (a function receiving a batch of patches and returning
+    their predictions) over image by patches and averages the predictions
+    in probability_array. Patches with all the values <= skip_threshold are
+    not predicted.
+    """
+    aggregator = PatchAggregator(probability_array, patch_size, overlap, weighting)
+    n_patches = 0
+    n_skipped = 0
+    for completion, batch, patches, skipped in gen_patch_batches(
+        image, patch_size, overlap, batch_size, buffer, skip_threshold
+    ):
+        if patches:
+            aggregator.add(predict(batch), patches)
+        n_patches += len(patches) + skipped
+        n_skipped += skipped
+        comm_array[0] = completion
 
-    with torch.no_grad():
-        (iz, ez), (iy, ey), (ix, ex) = patch
-        sub_mask = (
-            nn_model(
-                torch.from_numpy(sub_image.reshape(1, 1, patch_size, patch_size, patch_size)).to(
-                    device
-                )
-            )
-            .cpu()
-            .numpy()
+    aggregator.normalize()
+    print(f"Skipped {n_skipped} of {n_patches} patches as background ({n_skipped / n_patches:.1%})")
+
+
+class OnnxBatchPredictor:
+    """
+    Runs an ONNX model (see model.export_onnx) over batches of patches with
+    ONNX Runtime, using the execution provider (CPU, OpenVINO, ...) and
+    num_threads intra-op threads (0 uses all the cores). The patches are
+    written by gen_patch_batches directly in the input array.
+    """
+
+    def __init__(self, onnx_file, provider, patch_size, batch_size, num_threads=0):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        providers = [provider]
+        if provider != ONNX_CPU_PROVIDER:
+            providers.append(ONNX_CPU_PROVIDER)
+        self.session = onnxruntime.InferenceSession(str(onnx_file), options, providers=providers)
+        self.input_name = self.session.get_inputs()[0].name
+        self.patch_size = patch_size
+        self.input_array = np.empty(
+            (batch_size, 1, patch_size, patch_size, patch_size), dtype=np.float32
         )
-    return sub_mask.reshape(patch_size, patch_size, patch_size)[
-        0 : ez - iz, 0 : ey - iy, 0 : ex - ix
-    ]
+        self.buffer = self.input_array[:, 0]
 
+    def __call__(self, batch):
+        n = len(batch)
+        (sub_masks,) = self.session.run(None, {self.input_name: self.input_array[:n]})
+        return sub_masks.reshape(n, self.patch_size, self.patch_size, self.patch_size)
 
-def segment_keras(image, weights_file, overlap, probability_array, comm_array, patch_size):
+
+def segment_keras(
+    image,
+    weights_file,
+    overlap,
+    probability_array,
+    comm_array,
+    patch_size,
+    batch_size=BATCH_SIZE,
+    weighting=WEIGHTING_CONSTANT,
+    skip_threshold=None,
+):
     import keras
 
     # Loading model
@@ -81,20 +274,103 @@ def segment_keras(image, weights_file, overlap, probability_array, comm_array, p
     model.load_weights(str(weights_file.parent.joinpath("model.h5")))
     model.compile("Adam", "binary_crossentropy")
 
-    image = imagedata_utils.image_normalize(image, 0.0, 1.0, output_dtype=np.float32)
-    sums = np.zeros_like(image)
-    # segmenting by patches
-    for completion, sub_image, patch in gen_patches(image, patch_size, overlap):
-        comm_array[0] = completion
-        (iz, ez), (iy, ey), (ix, ex) = patch
-        sub_mask = predict_patch(sub_image, patch, model, patch_size)
-        probability_array[iz:ez, iy:ey, ix:ex] += sub_mask
-        sums[iz:ez, iy:ey, ix:ex] += 1
+    def predict(batch):
+        n = len(batch)
+        sub_masks = model.predict(batch.reshape(n, patch_size, patch_size, patch_size, 1), n)
+        return sub_masks.reshape(n, patch_size, patch_size, patch_size)
 
-    probability_array /= sums
+    image = imagedata_utils.image_normalize(image, 0.0, 1.0, output_dtype=np.float32)
+    batch_size = get_batch_size(patch_size, batch_size)
+    segment_patches(
+        image,
+        predict,
+        overlap,
+        probability_array,
+        comm_array,
+        patch_size,
+        batch_size,
+        weighting=weighting,
+        skip_threshold=skip_threshold,
+    )
     comm_array[0] = np.Inf
 
 
+def foreground_region(image, margin=8, max_size=128):
+    """
+    Returns the bounding box (tuple of slices) of the foreground of image
+    (the head, neck, ...) or None if there is no foreground. It's computed
+    on a downsampled copy of image (at most max_size voxels per axis): Otsu
+    threshold, opening to remove noise and the largest connected component,
+    so the scanner table and other objects apart from the body are left
+    out. margin voxels are added to each side.
+    """
+    from scipy import ndimage
+    from skimage.filters import threshold_otsu
+
+    factor = max(1, math.ceil(max(image.shape) / max_size))
+    small = np.asarray(image[::factor, ::factor, ::factor], dtype=np.float32)
+    if small.min() == small.max():
+        return None
+    foreground = ndimage.binary_opening(small > threshold_otsu(small))
+    labels, n_labels = ndimage.label(foreground)
+    if n_labels == 0:
+        return None
+    sizes = ndimage.sum(foreground, labels, range(1, n_labels + 1))
+    largest = int(np.argmax(sizes)) + 1
+    bbox = ndimage.find_objects((labels == largest).astype(np.int8))[0]
+    margin += factor
+    return tuple(
+        slice(max(0, s.start * factor - margin), min(size, s.stop * factor + margin))
+        for s, size in zip(bbox, image.shape)
+    )
+
+
+def prepare_image(
+    image,
+    patch_size,
+    crop_foreground=True,
+    apply_wwwl=False,
+    window_width=255,
+    window_level=127,
+):
+    """
+    Returns the region of image given to the network (see
+    foreground_region, all the image if not crop_foreground) and the image
+    of that region with the window applied if apply_wwwl, as the segment_*
+    functions receive it (they normalize it to [0, 1]). The region is None
+    if there is nothing to segment.
+    """
+    if crop_foreground:
+        region = foreground_region(image, margin=patch_size // 4)
+    else:
+        region = tuple(slice(0, i) for i in image.shape)
+    if region is None:
+        return None, None
+    image = image[region]
+    if apply_wwwl:
+        image = imagedata_utils.get_LUT_value(image, window_width, window_level)
+    return region, image
+
+
+def find_onnx_file(name, precision=PRECISION_FLOAT32):
+    """
+    Returns the ONNX model of name in precision (name.onnx for float32,
+    name.<precision>.onnx otherwise) from the models folder or from the user
+    weights folder, or None if it doesn't exist yet.
+    """
+    if precision == PRECISION_FLOAT32:
+        filename = f"{name}.onnx"
+    else:
+        filename = f"{name}.{precision}.onnx"
+    for onnx_file in (
+        inv_paths.MODELS_DIR.joinpath(name, filename),
+        inv_paths.USER_DL_WEIGHTS.joinpath(filename),
+    ):
+        if onnx_file.exists():
+            return onnx_file
+    return None
+
+
 def download_callback(comm_array):
     def _download_callback(value):
         comm_array[0] = value
@@ -103,7 +379,16 @@ def download_callback(comm_array):
 
 
 def segment_torch(
-    image, weights_file, overlap, device_id, probability_array, comm_array, patch_size
+    image,
+    weights_file,
+    overlap,
+    device_id,
+    probability_array,
+    comm_array,
+    patch_size,
+    batch_size=BATCH_SIZE,
+    weighting=WEIGHTING_CONSTANT,
+    skip_threshold=None,
 ):
     import torch
 
@@ -120,17 +405,21 @@ def segment_torch(
     model.eval()
 
     image = imagedata_utils.image_normalize(image, 0.0, 1.0, output_dtype=np.float32)
-    sums = np.zeros_like(image)
+    batch_size = get_batch_size(patch_size, batch_size)
+    predictor = TorchBatchPredictor(model, device, patch_size, batch_size)
     # segmenting by patches
-    with torch.no_grad():
-        for completion, sub_image, patch in gen_patches(image, patch_size, overlap):
-            comm_array[0] = completion
-            (iz, ez), (iy, ey), (ix, ex) = patch
-            sub_mask = predict_patch_torch(sub_image, patch, model, device, patch_size)
-            probability_array[iz:ez, iy:ey, ix:ex] += sub_mask
-            sums[iz:ez, iy:ey, ix:ex] += 1
-
-    probability_array /= sums
+    segment_patches(
+        image,
+        predictor,
+        overlap,
+        probability_array,
+        comm_array,
+        patch_size,
+        batch_size,
+        predictor.buffer,
+        weighting,
+        skip_threshold,
+    )
     comm_array[0] = np.Inf
 
 
@@ -146,6 +435,9 @@ def segment_torch_jit(
     image_spacing=(1.0, 1.0, 1.0),
     needed_spacing=(0.5, 0.5, 0.5),
     flipped=False,
+    batch_size=BATCH_SIZE,
+    weighting=WEIGHTING_CONSTANT,
+    skip_threshold=None,
 ):
     import torch
 
@@ -174,16 +466,21 @@ def segment_torch_jit(
     model.to(device)
     model.eval()
 
-    sums = np.zeros_like(image)
+    batch_size = get_batch_size(patch_size, batch_size)
+    predictor = TorchBatchPredictor(model, device, patch_size, batch_size)
     # segmenting by patches
-    for completion, sub_image, patch in gen_patches(image, patch_size, overlap):
-        comm_array[0] = completion
-        (iz, ez), (iy, ey), (ix, ex) = patch
-        sub_mask = predict_patch_torch(sub_image, patch, model, device, patch_size)
-        probability_array[iz:ez, iy:ey, ix:ex] += sub_mask.squeeze()
-        sums[iz:ez, iy:ey, ix:ex] += 1
-
-    probability_array /= sums
+    segment_patches(
+        image,
+        predictor,
+        overlap,
+        probability_array,
+        comm_array,
+        patch_size,
+        batch_size,
+        predictor.buffer,
+        weighting,
+        skip_threshold,
+    )
 
     # FIX: to remove
     if flipped:
@@ -197,10 +494,50 @@ def segment_torch_jit(
     comm_array[0] = np.Inf
 
 
+def segment_onnx(
+    image,
+    onnx_file,
+    overlap,
+    provider,
+    probability_array,
+    comm_array,
+    patch_size,
+    batch_size=BATCH_SIZE,
+    weighting=WEIGHTING_CONSTANT,
+    skip_threshold=None,
+    num_threads=0,
+):
+    if not onnx_file.exists():
+        raise FileNotFoundError("ONNX file not found")
+    image = imagedata_utils.image_normalize(image, 0.0, 1.0, output_dtype=np.float32)
+    batch_size = get_batch_size(patch_size, batch_size)
+    predictor = OnnxBatchPredictor(onnx_file, provider, patch_size, batch_size, num_threads)
+    # segmenting by patches
+    segment_patches(
+        image,
+        predictor,
+        overlap,
+        probability_array,
+        comm_array,
+        patch_size,
+        batch_size,
+        predictor.buffer,
+        weighting,
+        skip_threshold,
+    )
+    comm_array[0] = np.Inf
+
+
 ctx = multiprocessing.get_context("spawn")
 
 
 class SegmentProcess(ctx.Process):
+    # Patches of the network input with all the values <= skip_threshold are
+    # background and not predicted (None predicts all of them).
+    skip_threshold = None
+    # Name of the model files (<model_name>.pt, <model_name>.onnx, ...).
+    model_name = ""
+
     def __init__(
         self,
         image,
@@ -213,10 +550,14 @@ class SegmentProcess(ctx.Process):
         window_width=255,
         window_level=127,
         patch_size=SIZE,
+        batch_size=BATCH_SIZE,
+        precision=PRECISION_FLOAT32,
     ):
         multiprocessing.Process.__init__(self)
 
         self._image_filename = image.filename
+        # Not 0 when the image is mapped from the project file.
+        self._image_offset = getattr(image, "offset", 0)
         self._image_dtype = image.dtype
         self._image_shape = image.shape
 
@@ -240,6 +581,14 @@ class SegmentProcess(ctx.Process):
         self.overlap = overlap
 
         self.patch_size = patch_size
+        self.batch_size = batch_size
+        self.weighting = ses.Session().GetConfig("segmentation_weighting", WEIGHTING_CONSTANT)
+        # The network is run only in the bounding box of the foreground.
+        self.crop_foreground = ses.Session().GetConfig("segmentation_crop_foreground", True)
+        # Intra-op threads of the ONNX Runtime backend (0 uses all).
+        self.num_threads = ses.Session().GetConfig("segmentation_threads", 0)
+        # Precision of the ONNX model (see _get_onnx_file).
+        self.precision = precision
 
         self.apply_wwwl = apply_wwwl
         self.window_width = window_width
@@ -256,6 +605,89 @@ class SegmentProcess(ctx.Process):
 
         self.mask = None
 
+    def _get_torch_weights_file(self, comm_array):
+        """
+        Returns the torch weights file, downloading it if necessary.
+        """
+        if not self.torch_weights_file_name:
+            raise FileNotFoundError("Weights file not specified.")
+        folder = inv_paths.MODELS_DIR.joinpath(self.torch_weights_file_name.split(".")[0])
+        system_state_dict_file = folder.joinpath(self.torch_weights_file_name)
+        user_state_dict_file = inv_paths.USER_DL_WEIGHTS.joinpath(self.torch_weights_file_name)
+        if system_state_dict_file.exists():
+            return system_state_dict_file
+        if not user_state_dict_file.exists():
+            download_url_to_file(
+                self.torch_weights_url,
+                user_state_dict_file,
+                self.torch_weights_hash,
+                download_callback(comm_array),
+            )
+        return user_state_dict_file
+
+    def _get_onnx_file(self, comm_array):
+        """
+        Returns the ONNX version of the torch weights, in self.precision. If
+        it doesn't exist yet it's exported from the torch weights (it needs
+        torch only this time), the same done by
+        scripts/convert_segmentation_to_onnx.py. The float16 model is
+        converted from it too, but the int8 one must be calibrated before
+        with scripts/quantize_segmentation.py, which also checks its
+        accuracy against the float32 model.
+        """
+        if not self.torch_weights_file_name:
+            raise FileNotFoundError("Weights file not specified.")
+        name = self.torch_weights_file_name.split(".")[0]
+        onnx_file = find_onnx_file(name)
+        if onnx_file is None:
+            user_onnx_file = inv_paths.USER_DL_WEIGHTS.joinpath(name + ".onnx")
+            if importlib.util.find_spec("torch") is None:
+                raise FileNotFoundError(
+                    f"The ONNX model {user_onnx_file} was not found and it can't be exported"
+                    " without PyTorch. Create it with scripts/convert_segmentation_to_onnx.py"
+                    " on a system with PyTorch and copy it to that folder."
+                )
+            from .model import export_onnx, load_unet3d
+
+            weights_file = self._get_torch_weights_file(comm_array)
+            export_onnx(load_unet3d(weights_file), user_onnx_file, self.patch_size)
+            onnx_file = user_onnx_file
+
+        if self.precision == PRECISION_FLOAT32:
+            return onnx_file
+        if self.precision not in (PRECISION_INT8, PRECISION_FLOAT16):
+            raise ValueError(f"Unknown precision {self.precision}")
+
+        reduced_file = find_onnx_file(name, self.precision)
+        if reduced_file is None:
+            reduced_file = inv_paths.USER_DL_WEIGHTS.joinpath(f"{name}.{self.precision}.onnx")
+            if self.precision == PRECISION_INT8:
+                raise FileNotFoundError(
+                    f"The int8 model {reduced_file} was not found, create it with"
+                    " scripts/quantize_segmentation.py"
+                )
+            from .quantization import convert_float16
+
+            convert_float16(onnx_file, reduced_file)
+        return reduced_file
+
+    def _prepare_image(self, image):
+        """
+        Returns the region of image to segment and the input image of the
+        segment_* functions (see prepare_image).
+        """
+        region, sub_image = prepare_image(
+            image,
+            self.patch_size,
+            self.crop_foreground,
+            self.apply_wwwl,
+            self.window_width,
+            self.window_level,
+        )
+        if region is not None:
+            print(f"Segmenting {sub_image.size / image.size:.1%} of the image, region {region}")
+        return region, sub_image
+
     def run(self):
         try:
             self._run_segmentation()
@@ -270,11 +702,8 @@ class SegmentProcess(ctx.Process):
             dtype=self._image_dtype,
             shape=self._image_shape,
             mode="r",
+            offset=self._image_offset,
         )
-
-        if self.apply_wwwl:
-            image = imagedata_utils.get_LUT_value(image, self.window_width, self.window_level)
-
         probability_array = np.memmap(
             self._prob_array_filename,
             dtype=np.float32,
@@ -283,24 +712,15 @@ class SegmentProcess(ctx.Process):
         )
         comm_array = np.memmap(self._comm_array_filename, dtype=np.float32, shape=(1,), mode="r+")
 
+        # The probabilities outside the region stay 0.
+        region, image = self._prepare_image(image)
+        if region is None:
+            comm_array[0] = np.Inf
+            return
+        probability_array = probability_array[region]
+
         if self.backend.lower() == "pytorch":
-            if not self.torch_weights_file_name:
-                raise FileNotFoundError("Weights file not specified.")
-            folder = inv_paths.MODELS_DIR.joinpath(self.torch_weights_file_name.split(".")[0])
-            system_state_dict_file = folder.joinpath(self.torch_weights_file_name)
-            user_state_dict_file = inv_paths.USER_DL_WEIGHTS.joinpath(self.torch_weights_file_name)
-            if system_state_dict_file.exists():
-                weights_file = system_state_dict_file
-            elif user_state_dict_file.exists():
-                weights_file = user_state_dict_file
-            else:
-                download_url_to_file(
-                    self.torch_weights_url,
-                    user_state_dict_file,
-                    self.torch_weights_hash,
-                    download_callback(comm_array),
-                )
-                weights_file = user_state_dict_file
+            weights_file = self._get_torch_weights_file(comm_array)
             segment_torch(
                 image,
                 weights_file,
@@ -309,6 +729,24 @@ class SegmentProcess(ctx.Process):
                 probability_array,
                 comm_array,
                 self.patch_size,
+                batch_size=self.batch_size,
+                weighting=self.weighting,
+                skip_threshold=self.skip_threshold,
+            )
+        elif self.backend.lower() == ONNX_BACKEND.lower():
+            onnx_file = self._get_onnx_file(comm_array)
+            segment_onnx(
+                image,
+                onnx_file,
+                self.overlap,
+                self.device_id,
+                probability_array,
+                comm_array,
+                self.patch_size,
+                batch_size=self.batch_size,
+                weighting=self.weighting,
+                skip_threshold=self.skip_threshold,
+                num_threads=self.num_threads,
             )
         else:
             utils.prepare_ambient(self.backend, self.device_id, self.use_gpu)
@@ -319,6 +757,9 @@ class SegmentProcess(ctx.Process):
                 probability_array,
                 comm_array,
                 self.patch_size,
+                batch_size=self.batch_size,
+                weighting=self.weighting,
+                skip_threshold=self.skip_threshold,
             )
 
     @property
@@ -340,6 +781,7 @@ class SegmentProcess(ctx.Process):
                 self.mask = slc.Slice().create_new_mask(name=name)
 
         self.mask.was_edited = True
+        self.mask.detach_project_file()
         self.mask.matrix[1:, 1:, 1:] = (self._probability_array >= threshold) * 255
         self.mask.modified(True)
 
@@ -357,6 +799,10 @@ class SegmentProcess(ctx.Process):
 
 
 class BrainSegmentProcess(SegmentProcess):
+    # Air in the T1 normalized to [0, 1].
+    skip_threshold = 0.01
+    model_name = "brain_mri_t1"
+
     def __init__(
         self,
         image,
@@ -369,6 +815,8 @@ class BrainSegmentProcess(SegmentProcess):
         window_width=255,
         window_level=127,
         patch_size=SIZE,
+        batch_size=BATCH_SIZE,
+        precision=PRECISION_FLOAT32,
     ):
         super().__init__(
             image,
@@ -381,8 +829,10 @@ class BrainSegmentProcess(SegmentProcess):
             window_width=window_width,
             window_level=window_level,
             patch_size=patch_size,
+            batch_size=batch_size,
+            precision=precision,
         )
-        self.torch_weights_file_name = "brain_mri_t1.pt"
+        self.torch_weights_file_name = f"{self.model_name}.pt"
         self.torch_weights_url = (
             "https://github.com/tfmoraes/deepbrain_torch/releases/download/v1.1.0/weights.pt"
         )
@@ -392,6 +842,8 @@ class BrainSegmentProcess(SegmentProcess):
 
 
 class TracheaSegmentProcess(SegmentProcess):
+    model_name = "trachea_ct"
+
     def __init__(
         self,
         image,
@@ -404,6 +856,8 @@ class TracheaSegmentProcess(SegmentProcess):
         window_width=255,
         window_level=127,
         patch_size=48,
+        batch_size=BATCH_SIZE,
+        precision=PRECISION_FLOAT32,
     ):
         super().__init__(
             image,
@@ -416,8 +870,10 @@ class TracheaSegmentProcess(SegmentProcess):
             window_width=window_width,
             window_level=window_level,
             patch_size=patch_size,
+            batch_size=batch_size,
+            precision=precision,
         )
-        self.torch_weights_file_name = "trachea_ct.pt"
+        self.torch_weights_file_name = f"{self.model_name}.pt"
         self.torch_weights_url = (
             "https://github.com/tfmoraes/deep_trachea_torch/releases/download/v1.0/weights.pt"
         )
@@ -425,6 +881,9 @@ class TracheaSegmentProcess(SegmentProcess):
 
 
 class MandibleCTSegmentProcess(SegmentProcess):
+    # The input is the binarized image, patches without bone are skipped.
+    skip_threshold = 0.0
+
     def __init__(
         self,
         image,
@@ -437,6 +896,7 @@ class MandibleCTSegmentProcess(SegmentProcess):
         window_width=255,
         window_level=127,
         patch_size=96,
+        batch_size=BATCH_SIZE,
         threshold=150,
         resize_by_spacing=True,
         image_spacing=(1.0, 1.0, 1.0),
@@ -452,6 +912,7 @@ class MandibleCTSegmentProcess(SegmentProcess):
             window_width=window_width,
             window_level=window_level,
             patch_size=patch_size,
+            batch_size=batch_size,
         )
 
         self.threshold = threshold
@@ -469,13 +930,8 @@ class MandibleCTSegmentProcess(SegmentProcess):
             dtype=self._image_dtype,
             shape=self._image_shape,
             mode="r",
+            offset=self._image_offset,
         )
-
-        if self.apply_wwwl:
-            image = imagedata_utils.get_LUT_value(image, self.window_width, self.window_level)
-
-        image = (image >= self.threshold).astype(np.float32)
-
         probability_array = np.memmap(
             self._prob_array_filename,
             dtype=np.float32,
@@ -484,24 +940,17 @@ class MandibleCTSegmentProcess(SegmentProcess):
         )
         comm_array = np.memmap(self._comm_array_filename, dtype=np.float32, shape=(1,), mode="r+")
 
+        # The probabilities outside the region stay 0.
+        region, image = self._prepare_image(image)
+        if region is None:
+            comm_array[0] = np.Inf
+            return
+        probability_array = probability_array[region]
+
+        image = (image >= self.threshold).astype(np.float32)
+
         if self.backend.lower() == "pytorch":
-            if not self.torch_weights_file_name:
-                raise FileNotFoundError("Weights file not specified.")
-            folder = inv_paths.MODELS_DIR.joinpath(self.torch_weights_file_name.split(".")[0])
-            system_state_dict_file = folder.joinpath(self.torch_weights_file_name)
-            user_state_dict_file = inv_paths.USER_DL_WEIGHTS.joinpath(self.torch_weights_file_name)
-            if system_state_dict_file.exists():
-                weights_file = system_state_dict_file
-            elif user_state_dict_file.exists():
-                weights_file = user_state_dict_file
-            else:
-                download_url_to_file(
-                    self.torch_weights_url,
-                    user_state_dict_file,
-                    self.torch_weights_hash,
-                    download_callback(comm_array),
-                )
-                weights_file = user_state_dict_file
+            weights_file = self._get_torch_weights_file(comm_array)
             segment_torch_jit(
                 image,
                 weights_file,
@@ -510,6 +959,9 @@ class MandibleCTSegmentProcess(SegmentProcess):
                 probability_array,
                 comm_array,
                 self.patch_size,
+                batch_size=self.batch_size,
+                weighting=self.weighting,
+                skip_threshold=self.skip_threshold,
                 resize_by_spacing=self.resize_by_spacing,
                 image_spacing=self.image_spacing,
                 needed_spacing=self.needed_spacing,
@@ -523,4 +975,7 @@ class MandibleCTSegmentProcess(SegmentProcess):
                 probability_array,
                 comm_array,
                 self.patch_size,
+                batch_size=self.batch_size,
+                weighting=self.weighting,
+                skip_threshold=self.skip_threshold,
             )
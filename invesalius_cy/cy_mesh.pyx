@@ -22,7 +22,7 @@ from libcpp.vector cimport vector
 from libcpp.pair cimport pair
 from libcpp cimport bool
 from libcpp.deque cimport deque as cdeque
-from cython.parallel cimport prange
+from cython.parallel cimport prange, threadid
 cimport openmp
 
 from .cy_my_types cimport vertex_t, normal_t, vertex_id_t
@@ -42,6 +42,23 @@ cdef struct Point:
 
 ctypedef pair[vertex_id_t, vertex_id_t] key
 
+# numpy dtypes of the Mesh buffers.
+VERTEX_DTYPE = np.float32
+NORMAL_DTYPE = np.float32
+VERTEX_ID_DTYPE = np.int64 if sizeof(vertex_id_t) == 8 else np.int32
+
+
+# Maximum memory used by the per thread accumulators of
+# calc_artifacts_weight, it limits the number of threads used there for big
+# meshes.
+cdef size_t MAX_ACCUMULATORS_BYTES = 256 * 1024 * 1024
+
+
+cdef inline int get_num_threads(int num_threads) noexcept nogil:
+    if num_threads <= 0:
+        return openmp.omp_get_max_threads()
+    return num_threads
+
 
 cdef class Mesh:
     cdef vertex_t[:, :] vertices
@@ -53,10 +70,16 @@ cdef class Mesh:
 
     cdef bool _initialized
 
-    def __cinit__(self, pd=None, other=None):
-        cdef int i
-        cdef map[key, int] edge_nfaces
-        cdef map[key, int].iterator it
+    def __cinit__(self, pd=None, other=None, vertices=None, faces=None, normals=None):
+        """
+        The mesh is built from the vtkPolyData `pd' (with the cell normals in
+        the "Normals" array), from the Mesh `other' (a copy) or from numpy
+        buffers: `vertices' (n, 3), `faces' (m, 4) in the vtkCellArray layout
+        (3, id0, id1, id2) or (m, 3) and the face `normals' (m, 3).
+
+        The vertices are not copied when they are a contiguous float32
+        array (or the points of pd), so the smoothing is done in place.
+        """
         if pd:
             self._initialized = True
             _vertices = numpy_support.vtk_to_numpy(pd.GetPoints().GetData())
@@ -71,24 +94,20 @@ cdef class Mesh:
             self.vertices = _vertices
             self.faces = _faces
             self.normals = _normals
+            self._build_topology()
 
-            for i in range(_faces.shape[0]):
-                self.map_vface[self.faces[i, 1]].push_back(i)
-                self.map_vface[self.faces[i, 2]].push_back(i)
-                self.map_vface[self.faces[i, 3]].push_back(i)
-
-                edge_nfaces[key(min(self.faces[i, 1], self.faces[i, 2]), max(self.faces[i, 1], self.faces[i, 2]))] += 1
-                edge_nfaces[key(min(self.faces[i, 2], self.faces[i, 3]), max(self.faces[i, 2], self.faces[i, 3]))] += 1
-                edge_nfaces[key(min(self.faces[i, 1], self.faces[i, 3]), max(self.faces[i, 1], self.faces[i, 3]))] += 1
-
-            it = edge_nfaces.begin()
-
-            while it != edge_nfaces.end():
-                if deref(it).second == 1:
-                    self.border_vertices[deref(it).first.first] = 1
-                    self.border_vertices[deref(it).first.second] = 1
+        elif vertices is not None:
+            self._initialized = True
+            _faces = np.asarray(faces)
+            if _faces.ndim == 1:
+                _faces = _faces.reshape(-1, 4)
+            if _faces.shape[1] == 3:
+                _faces = np.column_stack((np.full(_faces.shape[0], 3, dtype=_faces.dtype), _faces))
 
-                inc(it)
+            self.vertices = np.ascontiguousarray(vertices, dtype=VERTEX_DTYPE).reshape(-1, 3)
+            self.faces = np.ascontiguousarray(_faces, dtype=VERTEX_ID_DTYPE)
+            self.normals = np.ascontiguousarray(normals, dtype=NORMAL_DTYPE).reshape(-1, 3)
+            self._build_topology()
 
         elif other:
             _other = <Mesh>other
@@ -101,6 +120,46 @@ cdef class Mesh:
         else:
             self._initialized = False
 
+    cdef void _build_topology(self):
+        """
+        Builds the faces of each vertex and finds the border vertices (the
+        vertices of the edges with only one face).
+        """
+        cdef int i
+        cdef map[key, int] edge_nfaces
+        cdef map[key, int].iterator it
+
+        for i in range(self.faces.shape[0]):
+            self.map_vface[self.faces[i, 1]].push_back(i)
+            self.map_vface[self.faces[i, 2]].push_back(i)
+            self.map_vface[self.faces[i, 3]].push_back(i)
+
+            edge_nfaces[key(min(self.faces[i, 1], self.faces[i, 2]), max(self.faces[i, 1], self.faces[i, 2]))] += 1
+            edge_nfaces[key(min(self.faces[i, 2], self.faces[i, 3]), max(self.faces[i, 2], self.faces[i, 3]))] += 1
+            edge_nfaces[key(min(self.faces[i, 1], self.faces[i, 3]), max(self.faces[i, 1], self.faces[i, 3]))] += 1
+
+        it = edge_nfaces.begin()
+
+        while it != edge_nfaces.end():
+            if deref(it).second == 1:
+                self.border_vertices[deref(it).first.first] = 1
+                self.border_vertices[deref(it).first.second] = 1
+
+            inc(it)
+
+        # All vertices are added to map_vface (vertices without faces too),
+        # since the parallel kernels can't insert in it.
+        for i in range(self.vertices.shape[0]):
+            if self.map_vface.find(i) == self.map_vface.end():
+                self.map_vface[i] = vector[vertex_id_t]()
+
+    @property
+    def points(self):
+        """
+        The vertices of the mesh as a numpy array (shares the memory).
+        """
+        return np.asarray(self.vertices)
+
     cdef void copy_to(self, Mesh other):
         """
         Copies self content to other.
@@ -226,7 +285,7 @@ cdef class Mesh:
         return near_vertices
 
 
-cdef vector[weight_t]* calc_artifacts_weight(Mesh mesh, vector[vertex_id_t]& vertices_staircase, float tmax, float bmin) noexcept nogil:
+cdef vector[weight_t]* calc_artifacts_weight(Mesh mesh, vector[vertex_id_t]& vertices_staircase, float tmax, float bmin, int num_threads) noexcept nogil:
     """
     Calculate the artifact weight based on distance of each vertex to its
     nearest staircase artifact vertex.
@@ -237,27 +296,49 @@ cdef vector[weight_t]* calc_artifacts_weight(Mesh mesh, vector[vertex_id_t]& ver
         tmax: max distance the vertex must be to its nearest artifact vertex
               to considered to calculate the weight
         bmin: The minimum weight.
+        num_threads: number of threads (0 uses all).
     """
-    cdef int vi_id, vj_id, nnv, n_ids, i, j
+    cdef int vi_id, vj_id, nnv, n_ids, i, j, n_threads
     cdef vector[vertex_id_t]* near_vertices
     cdef weight_t value
     cdef float d
-    n_ids = vertices_staircase.size()
 
     cdef vertex_t* vi
     cdef vertex_t* vj
-    cdef size_t msize
+    cdef size_t msize, max_accumulators
+    cdef Py_ssize_t v
+    cdef int t
+    cdef weight_t* acc
+    cdef weight_t* first_accumulator
+    cdef weight_t* accumulators
 
     msize = mesh.vertices.shape[0]
+    n_ids = vertices_staircase.size()
+    n_threads = max(1, min(get_num_threads(num_threads), n_ids))
+    # Each accumulator has a weight per vertex of the mesh.
+    max_accumulators = MAX_ACCUMULATORS_BYTES // (max(msize, 1) * sizeof(weight_t))
+    n_threads = max(1, min(n_threads, max_accumulators))
+
     cdef vector[weight_t]* weights = new vector[weight_t](msize)
     weights.assign(msize, bmin)
 
-    cdef openmp.omp_lock_t lock
-    openmp.omp_init_lock(&lock)
-
-    for i in prange(n_ids, nogil=True):
+    # Each thread keeps the weights it calculates in its own accumulator,
+    # the first thread uses weights, and they are reduced by max at the end.
+    # The max doesn't depend on the order the artifact vertices are visited,
+    # so the weights are the same for any number of threads.
+    cdef vector[weight_t] thread_weights
+    thread_weights.assign((n_threads - 1) * msize, bmin)
+    first_accumulator = weights.data()
+    accumulators = thread_weights.data()
+
+    for i in prange(n_ids, nogil=True, num_threads=n_threads, schedule="dynamic"):
+        t = threadid()
+        if t == 0:
+            acc = first_accumulator
+        else:
+            acc = accumulators + (t - 1) * msize
         vi_id = vertices_staircase[i]
-        deref(weights)[vi_id] = 1.0
+        acc[vi_id] = 1.0
 
         vi = &mesh.vertices[vi_id, 0]
         near_vertices = mesh.get_near_vertices_to_v(vi_id, tmax)
@@ -272,13 +353,17 @@ cdef vector[weight_t]* calc_artifacts_weight(Mesh mesh, vector[vertex_id_t]& ver
                    + (vi[2] - vj[2]) * (vi[2] - vj[2]))
             value = (1.0 - d/tmax) * (1.0 - bmin) + bmin
 
-            if value > deref(weights)[vj_id]:
-                openmp.omp_set_lock(&lock)
-                deref(weights)[vj_id] = value
-                openmp.omp_unset_lock(&lock)
+            if value > acc[vj_id]:
+                acc[vj_id] = value
 
         del near_vertices
 
+    if n_threads > 1:
+        for v in prange(msize, nogil=True, num_threads=n_threads):
+            for t in range(n_threads - 1):
+                if thread_weights[t * msize + v] > deref(weights)[v]:
+                    deref(weights)[v] = thread_weights[t * msize + v]
+
     #  for i in range(msize):
         #  if mesh.is_border(i):
             #  deref(weights)[i] = 0.0
@@ -295,7 +380,6 @@ cdef vector[weight_t]* calc_artifacts_weight(Mesh mesh, vector[vertex_id_t]& ver
                     #  vi = &mesh.vertices[v1, 0]
                     #  deref(weights)[v0] = 0.0
 
-    openmp.omp_destroy_lock(&lock)
     return weights
 
 
@@ -350,7 +434,7 @@ cdef inline Point calc_d(Mesh mesh, vertex_id_t v_id) noexcept nogil:
     D.z = D.z / n
     return D
 
-cdef vector[vertex_id_t]* find_staircase_artifacts(Mesh mesh, double[3] stack_orientation, double T) noexcept nogil:
+cdef vector[vertex_id_t]* find_staircase_artifacts(Mesh mesh, double[3] stack_orientation, double T, int num_threads) noexcept nogil:
     """
     This function is used to find vertices at staircase artifacts, which are
     those vertices whose incident faces' orientation differences are
@@ -361,6 +445,7 @@ cdef vector[vertex_id_t]* find_staircase_artifacts(Mesh mesh, double[3] stack_or
         stack_orientation: orientation of slice stacking
         T: Min angle (between vertex faces and stack_orientation) to consider a
            vertex a staircase artifact.
+        num_threads: number of threads (0 uses all).
     """
     cdef int nv, nf, f_id, v_id
     cdef double of_z, of_y, of_x, min_z, max_z, min_y, max_y, min_x, max_x;
@@ -372,7 +457,11 @@ cdef vector[vertex_id_t]* find_staircase_artifacts(Mesh mesh, double[3] stack_or
 
     nv = mesh.vertices.shape[0]
 
-    for v_id in range(nv):
+    # The vertices are marked in parallel and gathered in order, so the
+    # output is the same for any number of threads.
+    cdef vector[char] is_artifact = vector[char](nv, 0)
+
+    for v_id in prange(nv, nogil=True, num_threads=get_num_threads(num_threads)):
         max_z = -10000
         min_z = 10000
         max_y = -10000
@@ -411,12 +500,16 @@ cdef vector[vertex_id_t]* find_staircase_artifacts(Mesh mesh, double[3] stack_or
 
 
             if ((fabs(max_z - min_z) >= T) or (fabs(max_y - min_y) >= T) or (fabs(max_x - min_x) >= T)):
-                output.push_back(v_id)
+                is_artifact[v_id] = 1
                 break
+
+    for v_id in range(nv):
+        if is_artifact[v_id]:
+            output.push_back(v_id)
     return output
 
 
-cdef void taubin_smooth(Mesh mesh, vector[weight_t]& weights, float l, float m, int steps) noexcept nogil:
+cdef void taubin_smooth(Mesh mesh, vector[weight_t]& weights, float l, float m, int steps, int num_threads) noexcept nogil:
     """
     Implementation of Taubin's smooth algorithm described in the paper "A
     Signal Processing Approach To Fair Surface Design". His benefeat is it
@@ -426,25 +519,26 @@ cdef void taubin_smooth(Mesh mesh, vector[weight_t]& weights, float l, float m,
     nvertices = mesh.vertices.shape[0]
     cdef vector[Point] D = vector[Point](nvertices)
     cdef vertex_t* vi
+    cdef int n_threads = get_num_threads(num_threads)
     for s in range(steps):
-        for i in prange(nvertices, nogil=True):
+        for i in prange(nvertices, nogil=True, num_threads=n_threads):
             D[i] = calc_d(mesh, i)
 
-        for i in prange(nvertices, nogil=True):
+        for i in prange(nvertices, nogil=True, num_threads=n_threads):
             mesh.vertices[i, 0] += weights[i]*l*D[i].x;
             mesh.vertices[i, 1] += weights[i]*l*D[i].y;
             mesh.vertices[i, 2] += weights[i]*l*D[i].z;
 
-        for i in prange(nvertices, nogil=True):
+        for i in prange(nvertices, nogil=True, num_threads=n_threads):
             D[i] = calc_d(mesh, i)
 
-        for i in prange(nvertices, nogil=True):
+        for i in prange(nvertices, nogil=True, num_threads=n_threads):
             mesh.vertices[i, 0] += weights[i]*m*D[i].x;
             mesh.vertices[i, 1] += weights[i]*m*D[i].y;
             mesh.vertices[i, 2] += weights[i]*m*D[i].z;
 
 
-def ca_smoothing(Mesh mesh, double T, double tmax, double bmin, int n_iters):
+def ca_smoothing(Mesh mesh, double T, double tmax, double bmin, int n_iters, int num_threads=0):
     """
     This is a implementation of the paper "Context-aware mesh smoothing for
     biomedical applications". It can be used to smooth meshes generated by
@@ -458,21 +552,23 @@ def ca_smoothing(Mesh mesh, double T, double tmax, double bmin, int n_iters):
               to considered to calculate the weight
         bmin: The minimum weight
         n_iters: Number of iterations.
+        num_threads: number of threads (0 uses all). The result doesn't
+                     depend on the number of threads.
     """
     cdef double[3] stack_orientation = [0.0, 0.0, 1.0]
 
     t0 = time.time()
-    cdef vector[vertex_id_t]* vertices_staircase =  find_staircase_artifacts(mesh, stack_orientation, T)
+    cdef vector[vertex_id_t]* vertices_staircase =  find_staircase_artifacts(mesh, stack_orientation, T, num_threads)
     print("vertices staircase", time.time() - t0)
 
     t0 = time.time()
-    cdef vector[weight_t]* weights = calc_artifacts_weight(mesh, deref(vertices_staircase), tmax, bmin)
+    cdef vector[weight_t]* weights = calc_artifacts_weight(mesh, deref(vertices_staircase), tmax, bmin, num_threads)
     print("Weights", time.time() - t0)
 
     del vertices_staircase
 
     t0 = time.time()
-    taubin_smooth(mesh, deref(weights), 0.5, -0.53, n_iters)
+    taubin_smooth(mesh, deref(weights), 0.5, -0.53, n_iters, num_threads)
     print("taubin", time.time() - t0)
 
     del weights
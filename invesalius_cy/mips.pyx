@@ -13,6 +13,7 @@ cimport cython
 
 from libc.math cimport floor, ceil, sqrt, fabs
 from cython.parallel cimport prange
+cimport openmp
 
 DTYPE = np.uint8
 ctypedef np.uint8_t DTYPE_t
@@ -23,76 +24,56 @@ ctypedef np.int16_t DTYPE16_t
 DTYPEF32 = np.float32
 ctypedef np.float32_t DTYPEF32_t
 
-def lmip(np.ndarray[DTYPE16_t, ndim=3] image, int axis, DTYPE16_t tmin,
-         DTYPE16_t tmax, np.ndarray[DTYPE16_t, ndim=2] out):
-    cdef DTYPE16_t max
+cdef inline int get_num_threads(int num_threads) noexcept nogil:
+    if num_threads <= 0:
+        return openmp.omp_get_max_threads()
+    return num_threads
+
+
+cdef inline DTYPE16_t lmip_ray(const DTYPE16_t[:, :, :] rays, int i, int j,
+                               DTYPE16_t tmin, DTYPE16_t tmax) noexcept nogil:
+    cdef int sz = rays.shape[0]
+    cdef DTYPE16_t max = rays[0, i, j]
+    cdef DTYPE16_t vl
     cdef int start
-    cdef int sz = image.shape[0]
-    cdef int sy = image.shape[1]
-    cdef int sx = image.shape[2]
+    cdef int z
 
-    # AXIAL
-    if axis == 0:
-        for x in range(sx):
-            for y in range(sy):
-                max = image[0, y, x]
-                if max >= tmin and max <= tmax:
-                    start = 1
-                else:
-                    start = 0
-                for z in range(sz):
-                    if image[z, y, x] > max:
-                        max = image[z, y, x]
-
-                    elif image[z, y, x] < max and start:
-                        break
-                    
-                    if image[z, y, x] >= tmin and image[z, y, x] <= tmax:
-                        start = 1
-
-                out[y, x] = max
-
-    #CORONAL
-    elif axis == 1:
-        for z in range(sz):
-            for x in range(sx):
-                max = image[z, 0, x]
-                if max >= tmin and max <= tmax:
-                    start = 1
-                else:
-                    start = 0
-                for y in range(sy):
-                    if image[z, y, x] > max:
-                        max = image[z, y, x]
-
-                    elif image[z, y, x] < max and start:
-                        break
-                    
-                    if image[z, y, x] >= tmin and image[z, y, x] <= tmax:
-                        start = 1
-
-                out[z, x] = max
-
-    #CORONAL
-    elif axis == 2:
-        for z in range(sz):
-            for y in range(sy):
-                max = image[z, y, 0]
-                if max >= tmin and max <= tmax:
-                    start = 1
-                else:
-                    start = 0
-                for x in range(sx):
-                    if image[z, y, x] > max:
-                        max = image[z, y, x]
-
-                    elif image[z, y, x] < max and start:
-                        break
-                    
-                    if image[z, y, x] >= tmin and image[z, y, x] <= tmax:
-                        start = 1
-
-                out[z, y] = max
+    if max >= tmin and max <= tmax:
+        start = 1
+    else:
+        start = 0
+
+    for z in range(sz):
+        vl = rays[z, i, j]
+        if vl > max:
+            max = vl
+
+        elif vl < max and start:
+            break
+
+        if vl >= tmin and vl <= tmax:
+            start = 1
+
+    return max
+
+
+def lmip(np.ndarray[DTYPE16_t, ndim=3] image, int axis, DTYPE16_t tmin,
+         DTYPE16_t tmax, np.ndarray[DTYPE16_t, ndim=2] out, int num_threads=0):
+    """
+    Local maximum intensity projection of image along axis. The output rows
+    are split among num_threads threads (0 uses all the OpenMP threads).
+    """
+    # The projection axis is moved to the first position so the ray of the
+    # output pixel out[i, j] is rays[:, i, j] for all the orientations.
+    cdef const DTYPE16_t[:, :, :] rays = np.moveaxis(image, axis, 0)
+    cdef DTYPE16_t[:, :] vout = out
+    cdef int si = rays.shape[1]
+    cdef int sj = rays.shape[2]
+    cdef int i, j
+
+    for i in prange(si, nogil=True, num_threads=get_num_threads(num_threads)):
+        for j in range(sj):
+            vout[i, j] = lmip_ray(rays, i, j, tmin, tmax)
 
 
 cdef DTYPE16_t get_colour(DTYPE16_t vl, DTYPE16_t wl, DTYPE16_t ww):
@@ -108,7 +89,7 @@ cdef DTYPE16_t get_colour(DTYPE16_t vl, DTYPE16_t wl, DTYPE16_t ww):
 
     return out_colour
 
-cdef float get_opacity(DTYPE16_t vl, DTYPE16_t wl, DTYPE16_t ww) nogil:
+cdef float get_opacity(DTYPE16_t vl, DTYPE16_t wl, DTYPE16_t ww) noexcept nogil:
     cdef float out_opacity
     cdef DTYPE16_t min_value = wl - (ww // 2)
     cdef DTYPE16_t max_value = wl + (ww // 2)
@@ -121,7 +102,7 @@ cdef float get_opacity(DTYPE16_t vl, DTYPE16_t wl, DTYPE16_t ww) nogil:
 
     return out_opacity
 
-cdef float get_opacity_f32(DTYPEF32_t vl, DTYPE16_t wl, DTYPE16_t ww) nogil:
+cdef float get_opacity_f32(DTYPEF32_t vl, DTYPE16_t wl, DTYPE16_t ww) noexcept nogil:
     cdef float out_opacity
     cdef DTYPE16_t min_value = wl - (ww // 2)
     cdef DTYPE16_t max_value = wl + (ww // 2)
@@ -135,20 +116,13 @@ cdef float get_opacity_f32(DTYPEF32_t vl, DTYPE16_t wl, DTYPE16_t ww) nogil:
     return out_opacity
 
 
-def mida(np.ndarray[DTYPE16_t, ndim=3] image, int axis, DTYPE16_t wl,
-         DTYPE16_t ww, np.ndarray[DTYPE16_t, ndim=2] out):
-    cdef int sz = image.shape[0]
-    cdef int sy = image.shape[1]
-    cdef int sx = image.shape[2]
-
-    cdef DTYPE16_t min = image.min()
-    cdef DTYPE16_t max = image.max()
+cdef inline DTYPE16_t mida_ray(const DTYPE16_t[:, :, :] rays, int i, int j,
+                               DTYPE16_t min, DTYPE16_t max,
+                               DTYPE16_t wl, DTYPE16_t ww) noexcept nogil:
+    cdef int sz = rays.shape[0]
     cdef DTYPE16_t vl
 
-    cdef DTYPE16_t min_value = wl - (ww // 2)
-    cdef DTYPE16_t max_value = wl + (ww // 2)
-
-    cdef float fmax=0.0
+    cdef float fmax = 0.0
     cdef float fpi
     cdef float dl
     cdef float bt
@@ -156,106 +130,56 @@ def mida(np.ndarray[DTYPE16_t, ndim=3] image, int axis, DTYPE16_t wl,
     cdef float alpha
     cdef float alpha_p = 0.0
     cdef float colour
-    cdef float colour_p = 0
+    cdef float colour_p = 0.0
 
-    cdef int x, y, z
+    cdef int z
 
-    # AXIAL
-    if axis == 0:
-        for x in prange(sx, nogil=True):
-            for y in range(sy):
-                fmax = 0.0
-                alpha_p = 0.0
-                colour_p = 0.0
-                for z in range(sz):
-                    vl = image[z, y, x]
-                    fpi = 1.0/(max - min) * (vl - min)
-                    if fpi > fmax:
-                        dl = fpi - fmax
-                        fmax = fpi
-                    else:
-                        dl = 0.0
-
-                    bt = 1.0 - dl
-                    
-                    colour = fpi
-                    alpha = get_opacity(vl, wl, ww)
-                    colour = (bt * colour_p) + (1 - bt * alpha_p) * colour * alpha
-                    alpha = (bt * alpha_p) + (1 - bt * alpha_p) * alpha
-
-                    colour_p = colour
-                    alpha_p = alpha
-
-                    if alpha >= 1.0:
-                        break
-
-
-                #out[y, x] = <DTYPE16_t>((max_value - min_value) * colour + min_value)
-                out[y, x] = <DTYPE16_t>((max - min) * colour + min)
-
-
-    #CORONAL
-    elif axis == 1:
-        for z in prange(sz, nogil=True):
-            for x in range(sx):
-                fmax = 0.0
-                alpha_p = 0.0
-                colour_p = 0.0
-                for y in range(sy):
-                    vl = image[z, y, x]
-                    fpi = 1.0/(max - min) * (vl - min)
-                    if fpi > fmax:
-                        dl = fpi - fmax
-                        fmax = fpi
-                    else:
-                        dl = 0.0
-
-                    bt = 1.0 - dl
-                    
-                    colour = fpi
-                    alpha = get_opacity(vl, wl, ww)
-                    colour = (bt * colour_p) + (1 - bt * alpha_p) * colour * alpha
-                    alpha = (bt * alpha_p) + (1 - bt * alpha_p) * alpha
-
-                    colour_p = colour
-                    alpha_p = alpha
-
-                    if alpha >= 1.0:
-                        break
-
-                out[z, x] = <DTYPE16_t>((max - min) * colour + min)
-
-    #AXIAL
-    elif axis == 2:
-        for z in prange(sz, nogil=True):
-            for y in range(sy):
-                fmax = 0.0
-                alpha_p = 0.0
-                colour_p = 0.0
-                for x in range(sx):
-                    vl = image[z, y, x]
-                    fpi = 1.0/(max - min) * (vl - min)
-                    if fpi > fmax:
-                        dl = fpi - fmax
-                        fmax = fpi
-                    else:
-                        dl = 0.0
+    for z in range(sz):
+        vl = rays[z, i, j]
+        fpi = 1.0/(max - min) * (vl - min)
+        if fpi > fmax:
+            dl = fpi - fmax
+            fmax = fpi
+        else:
+            dl = 0.0
+
+        bt = 1.0 - dl
+
+        colour = fpi
+        alpha = get_opacity(vl, wl, ww)
+        colour = (bt * colour_p) + (1 - bt * alpha_p) * colour * alpha
+        alpha = (bt * alpha_p) + (1 - bt * alpha_p) * alpha
+
+        colour_p = colour
+        alpha_p = alpha
 
-                    bt = 1.0 - dl
-                    
-                    colour = fpi
-                    alpha = get_opacity(vl, wl, ww)
-                    colour = (bt * colour_p) + (1 - bt * alpha_p) * colour * alpha
-                    alpha = (bt * alpha_p) + (1 - bt * alpha_p) * alpha
+        if alpha >= 1.0:
+            break
 
-                    colour_p = colour
-                    alpha_p = alpha
+    #return <DTYPE16_t>((max_value - min_value) * colour_p + min_value)
+    return <DTYPE16_t>((max - min) * colour_p + min)
 
-                    if alpha >= 1.0:
-                        break
 
-                out[z, y] = <DTYPE16_t>((max - min) * colour + min)
+def mida(np.ndarray[DTYPE16_t, ndim=3] image, int axis, DTYPE16_t wl,
+         DTYPE16_t ww, np.ndarray[DTYPE16_t, ndim=2] out, int num_threads=0):
+    """
+    Maximum intensity difference accumulation of image along axis. The
+    output rows are split among num_threads threads (0 uses all the OpenMP
+    threads).
+    """
+    cdef const DTYPE16_t[:, :, :] rays = np.moveaxis(image, axis, 0)
+    cdef DTYPE16_t[:, :] vout = out
+    cdef int si = rays.shape[1]
+    cdef int sj = rays.shape[2]
+
+    cdef DTYPE16_t min = image.min()
+    cdef DTYPE16_t max = image.max()
+
+    cdef int i, j
 
+    for i in prange(si, nogil=True, num_threads=get_num_threads(num_threads)):
+        for j in range(sj):
+            vout[i, j] = mida_ray(rays, i, j, min, max, wl, ww)
 
 
 cdef inline void finite_difference(DTYPE16_t[:, :, :] image,
@@ -324,7 +248,8 @@ def fast_countour_mip(np.ndarray[DTYPE16_t, ndim=3] image,
                       int axis,
                       DTYPE16_t wl, DTYPE16_t ww,
                       int tmip,
-                      np.ndarray[DTYPE16_t, ndim=2] out):
+                      np.ndarray[DTYPE16_t, ndim=2] out,
+                      int num_threads=0):
     cdef int sz = image.shape[0]
     cdef int sy = image.shape[1]
     cdef int sx = image.shape[2]
@@ -355,7 +280,7 @@ def fast_countour_mip(np.ndarray[DTYPE16_t, ndim=3] image,
     elif axis == 2:
         dir[0] = 1.0
 
-    for z in prange(sz, nogil=True):
+    for z in prange(sz, nogil=True, num_threads=get_num_threads(num_threads)):
         for y in range(sy):
             for x in range(sx):
                 vl = calc_fcm_itensity(vimage, x, y, z, n, dir)
@@ -369,6 +294,6 @@ def fast_countour_mip(np.ndarray[DTYPE16_t, ndim=3] image,
     if tmip == 0:
         out[:] = tmp.max(axis)
     elif tmip == 1:
-        lmip(tmp, axis, 700, 3033, out)
+        lmip(tmp, axis, 700, 3033, out, num_threads)
     elif tmip == 2:
-        mida(tmp, axis, wl, ww, out)
+        mida(tmp, axis, wl, ww, out, num_threads)
@@ -0,0 +1,71 @@
+# distutils: define_macros=NPY_NO_DEPRECATED_API=NPY_1_7_API_VERSION
+# cython: boundscheck=False
+# cython: wraparound=False
+# cython: initializedcheck=False
+# cython: cdivision=True
+# cython: nonecheck=False
+# cython: language_level=3
+
+import numpy as np
+cimport numpy as np
+cimport cython
+
+from cython.parallel cimport prange
+cimport openmp
+
+from .cy_my_types cimport image_t, mask_t
+
+
+cdef inline int get_num_threads(int num_threads) noexcept nogil:
+    if num_threads <= 0:
+        return openmp.omp_get_max_threads()
+    return num_threads
+
+
+cdef inline bint is_edited(mask_t value) noexcept nogil:
+    return value == 1 or value == 2 or value == 253 or value == 254
+
+
+def threshold_volume(const image_t[:, :, :] image, mask_t[:, :, :] mask, double thresh_min,
+                     double thresh_max, int num_threads=0):
+    """
+    Thresholds the image into the mask, in place, in the same way of
+    Slice.do_threshold_to_a_slice for all the axial slices at once: the
+    voxels inside [thresh_min, thresh_max] are set to 255 and the others to
+    0, except the voxels marked by the edition (1, 2, 253 and 254).
+
+    mask is the mask matrix with the flag borders, shape (dz + 1, dy + 1, dx +
+    1). The axial slices already generated (mask[n, 0, 0] != 0) are skipped
+    and the thresholded ones are flagged as generated (mask[n, 0, 0] = 1),
+    so only the missing slices are thresholded in the next calls. The slices
+    are processed in parallel using num_threads (0 uses all). Returns the
+    number of slices thresholded.
+    """
+    cdef int dz = image.shape[0]
+    cdef int dy = image.shape[1]
+    cdef int dx = image.shape[2]
+    cdef int z, y, x
+    cdef int n_slices = 0
+    cdef mask_t v
+    cdef image_t value
+
+    if mask.shape[0] != dz + 1 or mask.shape[1] != dy + 1 or mask.shape[2] != dx + 1:
+        raise ValueError("The mask must have the shape of the image plus the flag borders")
+
+    for z in prange(dz, nogil=True, schedule="dynamic", num_threads=get_num_threads(num_threads)):
+        if mask[z + 1, 0, 0] != 0:
+            continue
+        n_slices += 1
+        for y in range(dy):
+            for x in range(dx):
+                v = mask[z + 1, y + 1, x + 1]
+                if is_edited(v):
+                    continue
+                value = image[z, y, x]
+                if value >= thresh_min and value <= thresh_max:
+                    mask[z + 1, y + 1, x + 1] = 255
+                else:
+                    mask[z + 1, y + 1, x + 1] = 0
+        mask[z + 1, 0, 0] = 1
+
+    return n_slices
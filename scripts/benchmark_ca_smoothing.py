@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Benchmark and regression check of the context aware smoothing from
+# invesalius_cy/cy_mesh.pyx on a synthetic staircase surface. The reference
+# is the implementation before it was refactored for thread count control
+# (scripts/cy_mesh_reference.pyx, compiled with pyximport, using the default
+# number of OpenMP threads): the smoothing is run with each given number of
+# threads, the speedup is relative to the reference and the smoothed
+# vertices must be equal to its ones.
+#
+# Example usage (from the root of the repository, after building the Cython
+# extensions with "python setup.py build_ext --inplace"):
+#
+#     python scripts/benchmark_ca_smoothing.py --size 1000 --threads 1 2 4 8
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from invesalius_cy import cy_mesh  # noqa: E402
+
+
+def import_reference():
+    import pyximport
+
+    pyximport.install(language_level=3)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import cy_mesh_reference
+
+    return cy_mesh_reference
+
+
+# Same parameters of the default context aware smoothing
+# (dialogs.SurfaceMethodPanel).
+ANGLE = 0.7
+MAX_DISTANCE = 3.0
+MIN_WEIGHT = 0.5
+STEPS = 10
+
+
+def staircase_surface(size, seed=0):
+    """
+    A height field with the heights rounded, like a surface created from a
+    binary image with thick slices. Returns the vertices, the triangles and
+    their normals.
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[:size, :size].astype(np.float32)
+    z = np.zeros_like(x)
+    for _n in range(8):
+        cy, cx = rng.uniform(0, size, 2)
+        radius = rng.uniform(size / 16, size / 4)
+        height = rng.uniform(5, 20)
+        z += height * np.exp(-((x - cx) ** 2 + (y - cy) ** 2) / (2 * radius**2))
+    z = np.round(z)
+    vertices = np.column_stack((x.ravel(), y.ravel(), z.ravel())).astype(np.float32)
+
+    ids = np.arange(size * size).reshape(size, size)
+    v0 = ids[:-1, :-1].ravel()
+    v1 = ids[:-1, 1:].ravel()
+    v2 = ids[1:, 1:].ravel()
+    v3 = ids[1:, :-1].ravel()
+    triangles = np.concatenate((np.column_stack((v0, v1, v2)), np.column_stack((v0, v2, v3))))
+
+    p0, p1, p2 = (vertices[triangles[:, i]] for i in range(3))
+    normals = np.cross(p1 - p0, p2 - p0)
+    normals /= np.linalg.norm(normals, axis=1)[:, np.newaxis]
+    return vertices, triangles, normals.astype(np.float32)
+
+
+def to_polydata(vertices, triangles, normals):
+    """
+    The vtkPolyData with the surface, the input of the reference Mesh.
+    """
+    from vtkmodules.util import numpy_support
+    from vtkmodules.vtkCommonCore import vtkPoints
+    from vtkmodules.vtkCommonDataModel import vtkCellArray, vtkPolyData
+
+    points = vtkPoints()
+    points.SetData(numpy_support.numpy_to_vtk(vertices, deep=True))
+    cells = np.column_stack((np.full(len(triangles), 3), triangles))
+    polys = vtkCellArray()
+    polys.SetCells(len(triangles), numpy_support.numpy_to_vtkIdTypeArray(cells.ravel(), deep=True))
+    cell_normals = numpy_support.numpy_to_vtk(normals, deep=True)
+    cell_normals.SetName("Normals")
+
+    pd = vtkPolyData()
+    pd.SetPoints(points)
+    pd.SetPolys(polys)
+    pd.GetCellData().SetNormals(cell_normals)
+    return pd
+
+
+def smooth(vertices, triangles, normals, num_threads, repeat):
+    times = []
+    for _n in range(repeat):
+        mesh = cy_mesh.Mesh(vertices=vertices.copy(), faces=triangles, normals=normals)
+        t0 = time.perf_counter()
+        cy_mesh.ca_smoothing(mesh, ANGLE, MAX_DISTANCE, MIN_WEIGHT, STEPS, num_threads)
+        times.append(time.perf_counter() - t0)
+    return min(times), mesh.points.copy()
+
+
+def smooth_reference(reference, vertices, triangles, normals, repeat):
+    from vtkmodules.util import numpy_support
+
+    times = []
+    for _n in range(repeat):
+        mesh = reference.Mesh(to_polydata(vertices, triangles, normals))
+        t0 = time.perf_counter()
+        reference.ca_smoothing(mesh, ANGLE, MAX_DISTANCE, MIN_WEIGHT, STEPS)
+        times.append(time.perf_counter() - t0)
+    points = numpy_support.vtk_to_numpy(mesh.to_vtk().GetPoints().GetData())
+    return min(times), points.reshape(-1, 3).copy()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of cy_mesh.ca_smoothing")
+    parser.add_argument("--size", type=int, default=500, help="The surface has size² vertices")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 0], help="0 uses all")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--tolerance", type=float, default=1e-5)
+    args = parser.parse_args()
+
+    vertices, triangles, normals = staircase_surface(args.size)
+    print(f"Surface with {len(vertices)} vertices and {len(triangles)} triangles")
+
+    reference_time, reference = smooth_reference(
+        import_reference(), vertices, triangles, normals, args.repeat
+    )
+    print(f"{'threads':>9} {'time (s)':>9} {'speedup':>8} {'max diff':>10}")
+    print(f"{'reference':>9} {reference_time:>9.2f} {1.0:>8.2f} {0.0:>10.2e}")
+
+    failed = False
+    for num_threads in args.threads:
+        t, points = smooth(vertices, triangles, normals, num_threads, args.repeat)
+        diff = float(np.abs(points - reference).max())
+        print(f"{num_threads:>9} {t:>9.2f} {reference_time / t:>8.2f} {diff:>10.2e}")
+        if diff > args.tolerance:
+            print(f"Output with {num_threads} threads differs from the reference one")
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Benchmark of the projection kernels from invesalius_cy/mips.pyx (LMIP, MIDA
+# and contour MIP) using 1 thread and using several threads, on a synthetic
+# volume. The reference is the serial version of the kernels before they were
+# parallelized (scripts/mips_reference.pyx, compiled with pyximport): the
+# speedup is relative to it and every output must be equal to its output.
+#
+# Example usage (from the root of the repository, after building the Cython
+# extensions with "python setup.py build_ext --inplace"):
+#
+#     python scripts/benchmark_mips.py --slices 100 --size 1024 --threads 1 2 4 8
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from invesalius_cy import mips  # noqa: E402
+
+
+def import_reference():
+    import pyximport
+
+    pyximport.install(setup_args={"include_dirs": np.get_include()}, language_level=3)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import mips_reference
+
+    return mips_reference
+
+
+WL = 300
+WW = 1000
+
+
+def synthetic_volume(slices, size, seed=0):
+    """
+    Noise plus some spheres with intensities similar to soft tissue and bone.
+    """
+    rng = np.random.default_rng(seed)
+    image = rng.normal(0, 40, (slices, size, size)).astype(np.int16)
+    z, y, x = np.ogrid[:slices, :size, :size]
+    for _n in range(8):
+        cz, cy, cx = rng.integers(0, slices), rng.integers(0, size), rng.integers(0, size)
+        radius = rng.integers(size // 16, size // 4)
+        value = rng.choice((60, 400, 1200))
+        sphere = (z - cz) ** 2 + (y - cy) ** 2 + (x - cx) ** 2 <= radius**2
+        image[sphere] += value
+    return image
+
+
+def run_kernel(name, image, axis, num_threads, reference=None):
+    """
+    Runs the kernel with num_threads, or the serial reference one if given
+    (it has no num_threads parameter).
+    """
+    plane_shape = image.shape[:axis] + image.shape[axis + 1 :]
+    out = np.empty(plane_shape, dtype=np.int16)
+    if reference is None:
+        module, extra = mips, (num_threads,)
+    else:
+        module, extra = reference, ()
+    if name == "lmip":
+        module.lmip(image, axis, WL - WW // 2, WL + WW // 2, out, *extra)
+    elif name == "mida":
+        module.mida(image, axis, WL, WW, out, *extra)
+    elif name == "contour_mip":
+        module.fast_countour_mip(image, 1.0, axis, WL, WW, 0, out, *extra)
+    return out
+
+
+def benchmark(name, image, axis, num_threads, repeat, reference=None):
+    times = []
+    for _n in range(repeat):
+        t0 = time.perf_counter()
+        out = run_kernel(name, image, axis, num_threads, reference)
+        times.append(time.perf_counter() - t0)
+    return min(times), out
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the mips.pyx kernels")
+    parser.add_argument("--slices", type=int, default=100, help="Number of slices of the slab")
+    parser.add_argument("--size", type=int, default=512, help="Size of each slice")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 0], help="0 uses all")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--kernels", nargs="+", default=["lmip", "mida", "contour_mip"], help="Kernels to run"
+    )
+    args = parser.parse_args()
+
+    reference = import_reference()
+    image = synthetic_volume(args.slices, args.size)
+    print(f"Volume {image.shape} {image.dtype}")
+    print(f"{'kernel':<12} {'axis':>4} {'threads':>9} {'time (ms)':>10} {'speedup':>8}")
+    failed = False
+    for name in args.kernels:
+        for axis in (0, 1, 2):
+            reference_time, reference_out = benchmark(name, image, axis, 1, args.repeat, reference)
+            print(
+                f"{name:<12} {axis:>4} {'reference':>9} {reference_time * 1000:>10.1f} {1.0:>8.2f}"
+            )
+            for num_threads in args.threads:
+                t, out = benchmark(name, image, axis, num_threads, args.repeat)
+                print(
+                    f"{name:<12} {axis:>4} {num_threads:>9} {t * 1000:>10.1f} "
+                    f"{reference_time / t:>8.2f}"
+                )
+                if not np.array_equal(out, reference_out):
+                    print(f"{name}: output with {num_threads} threads differs from the reference")
+                    failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Benchmark of the compression used to save projects (.inv3 tar files) and
+# to export them to HDF5. A synthetic CT like volume (int16) and a mask
+# (uint8) are written with the single threaded gzip of the tarfile module
+# (how the projects were saved before), with the parallel stream codecs
+# from invesalius/data/compression.py and to HDF5 with each available codec.
+# The time to write, the size and the time to read back are printed.
+#
+# Example usage (from the root of the repository):
+#
+#     python scripts/benchmark_project_compression.py --size 512 512 400 --threads 8
+
+import argparse
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from invesalius.data import compression  # noqa: E402
+
+
+def synthetic_volume(shape, seed=0):
+    """
+    Air around a body of soft tissue (with noise) and some bone spheres,
+    similar to a CT. Returns the image and the bone mask.
+    """
+    rng = np.random.default_rng(seed)
+    dz, dy, dx = shape
+    z, y, x = np.ogrid[:dz, :dy, :dx]
+    image = np.full(shape, -1000, dtype=np.int16)
+    body = ((y - dy / 2) / (dy * 0.4)) ** 2 + ((x - dx / 2) / (dx * 0.45)) ** 2 <= 1
+    image[:, body] = 40
+    for _n in range(20):
+        cz, cy, cx = (rng.uniform(0.2, 0.8) * i for i in shape)
+        radius = rng.uniform(0.03, 0.1) * min(dy, dx)
+        sphere = (z - cz) ** 2 + (y - cy) ** 2 + (x - cx) ** 2 <= radius**2
+        image[sphere] = 1200
+    image += rng.normal(0, 20, shape).astype(np.int16)
+    mask = np.where(image > 226, 255, 0).astype(np.uint8)
+    return image, mask
+
+
+def write_tar(folder, filename, files, codec, level, n_threads):
+    with open(filename, "wb") as f:
+        if codec == "tarfile-gzip":
+            tar = tarfile.open(fileobj=f, mode="w:gz")
+            writer = None
+        else:
+            writer = compression.stream_writer(f, codec, level, n_threads)
+            tar = tarfile.open(fileobj=writer, mode="w|")
+        for name in files:
+            tar.add(os.path.join(folder, name), arcname=name)
+        tar.close()
+        if writer is not None:
+            writer.close()
+
+
+def read_tar(filename):
+    if compression.is_zstd_stream(filename):
+        fileobj = compression.stream_reader(open(filename, "rb"))
+        tar = tarfile.open(fileobj=fileobj, mode="r|")
+    else:
+        fileobj = None
+        tar = tarfile.open(filename, "r")
+    for member in tar:
+        tar.extractfile(member).read()
+    tar.close()
+    if fileobj is not None:
+        fileobj.close()
+
+
+def write_hdf5(filename, image, mask, codec, level, n_threads):
+    import h5py
+
+    with h5py.File(filename, "w") as f:
+        if codec is None:
+            f["image"] = image
+            f["masks/0/matrix"] = mask
+        else:
+            compression.write_hdf5_dataset(f, "image", image, codec, level, n_threads)
+            compression.write_hdf5_dataset(f, "masks/0/matrix", mask, codec, level, n_threads)
+
+
+def read_hdf5(filename):
+    import h5py
+
+    with h5py.File(filename, "r") as f:
+        f["image"][:]
+        f["masks/0/matrix"][:]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the project compression")
+    parser.add_argument("--size", type=int, nargs=3, default=[256, 512, 512], help="z y x")
+    parser.add_argument("--threads", type=int, default=0, help="0 uses all")
+    parser.add_argument("--level", type=int, default=None)
+    parser.add_argument("--no-hdf5", action="store_true")
+    args = parser.parse_args()
+
+    image, mask = synthetic_volume(tuple(args.size))
+    raw_size = image.nbytes + mask.nbytes
+    print(f"Volume {tuple(args.size)}, {raw_size / 1024**2:.1f} MiB uncompressed")
+
+    folder = tempfile.mkdtemp()
+    try:
+        image.tofile(os.path.join(folder, "matrix.dat"))
+        mask.tofile(os.path.join(folder, "mask_0.dat"))
+        files = ["matrix.dat", "mask_0.dat"]
+
+        print(f"{'format':>18} {'write (s)':>10} {'read (s)':>9} {'MiB':>8} {'ratio':>6}")
+
+        def report(label, filename, t_write, read):
+            t0 = time.perf_counter()
+            read(filename)
+            t_read = time.perf_counter() - t0
+            size = os.path.getsize(filename)
+            print(
+                f"{label:>18} {t_write:>10.2f} {t_read:>9.2f} {size / 1024**2:>8.1f}"
+                f" {raw_size / size:>6.2f}"
+            )
+            os.remove(filename)
+
+        for codec in ["tarfile-gzip"] + compression.stream_codecs():
+            filename = os.path.join(folder, "project.inv3")
+            t0 = time.perf_counter()
+            write_tar(folder, filename, files, codec, args.level, args.threads)
+            report("tar " + codec, filename, time.perf_counter() - t0, read_tar)
+
+        if not args.no_hdf5:
+            codecs = [None] + compression.available_codecs()
+            for codec in codecs:
+                filename = os.path.join(folder, "project.hdf5")
+                t0 = time.perf_counter()
+                try:
+                    write_hdf5(filename, image, mask, codec, args.level, args.threads)
+                except ValueError as e:
+                    print(f"{'hdf5 ' + codec:>18} skipped: {e}")
+                    if os.path.exists(filename):
+                        os.remove(filename)
+                    continue
+                report("hdf5 " + (codec or "raw"), filename, time.perf_counter() - t0, read_hdf5)
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Benchmark of the surface extraction from binary masks: the "Binary" method
+# (vtkImageFlip + vtkContourFilter) against the "flying_edges" method
+# (vtkFlyingEdges3D, flip applied to the points). It runs
+# surface_process.create_surface_piece over the whole synthetic mask and
+# prints the wall time and the number of points and triangles.
+#
+# Example usage (from the root of the repository):
+#
+#     python scripts/benchmark_surface.py --shape 300 512 512
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from invesalius.data import surface_process  # noqa: E402
+
+ALGORITHMS = ("Binary", "flying_edges")
+
+
+def synthetic_mask(shape, filename, seed=0):
+    """
+    InVesalius mask (with the extra first slice, row and column used as
+    flags) with some ellipsoids.
+    """
+    rng = np.random.default_rng(seed)
+    mask_shape = tuple(i + 1 for i in shape)
+    mask = np.memmap(filename, mode="w+", dtype=np.uint8, shape=mask_shape)
+    mask[:] = 0
+    z, y, x = np.ogrid[: shape[0], : shape[1], : shape[2]]
+    for _n in range(12):
+        center = [rng.integers(0, s) for s in shape]
+        radius = [rng.integers(s // 16, s // 4) for s in shape]
+        ellipsoid = (
+            ((z - center[0]) / radius[0]) ** 2
+            + ((y - center[1]) / radius[1]) ** 2
+            + ((x - center[2]) / radius[2]) ** 2
+        ) <= 1
+        mask[1:, 1:, 1:][ellipsoid] = 255
+    mask.flush()
+    return mask
+
+
+def run(algorithm, shape, mask, spacing):
+    return surface_process.create_surface_piece(
+        None,
+        shape,
+        np.int16,
+        mask.filename,
+        mask.shape,
+        mask.dtype,
+        slice(0, shape[0]),
+        spacing,
+        "CONTOUR",
+        0,
+        0,
+        0,
+        0,
+        0,
+        "",
+        True,
+        True,
+        algorithm,
+        0,
+        True,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of surface extraction from masks")
+    parser.add_argument("--shape", type=int, nargs=3, default=[200, 512, 512])
+    parser.add_argument("--spacing", type=float, nargs=3, default=[0.5, 0.5, 1.0])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    shape = tuple(args.shape)
+    fd, filename = tempfile.mkstemp(suffix=".dat")
+    os.close(fd)
+    try:
+        mask = synthetic_mask(shape, filename)
+        print(f"Mask {shape}")
+        print(f"{'algorithm':<14} {'time (s)':>9} {'points':>10} {'triangles':>10}")
+        for algorithm in ALGORITHMS:
+            times = []
+            for _n in range(args.repeat):
+                t0 = time.perf_counter()
+                piece = run(algorithm, shape, mask, tuple(args.spacing))
+                times.append(time.perf_counter() - t0)
+            print(
+                f"{algorithm:<14} {min(times):>9.3f} {len(piece['points']):>10} "
+                f"{piece['number_of_polys']:>10}"
+            )
+        del mask
+    finally:
+        os.remove(filename)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Check of the mask undo history (invesalius/data/mask.py) with the 2D
+# tools that give the edited slice as (1, h, w) and its previous state as
+# (h, w): the automatic fill holes (Mask.fill_holes_auto) and the region
+# growing (do_2d_seg in invesalius/data/styles.py, whose save_history call
+# is reproduced here). For each orientation the edition is saved, undone and
+# redone, and the mask is compared with the expected one after each step.
+#
+# Example usage (from the root of the repository, after building the Cython
+# extensions with "python setup.py build_ext --inplace"):
+#
+#     python scripts/check_mask_history.py --size 512
+
+import argparse
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from invesalius.data.mask import Mask  # noqa: E402
+
+ORIENTATIONS = ("AXIAL", "CORONAL", "SAGITAL")
+
+
+def get_slice(matrix, orientation, index):
+    """
+    The slice index of the mask matrix, without the flag borders.
+    """
+    if orientation == "AXIAL":
+        return matrix[index + 1, 1:, 1:]
+    elif orientation == "CORONAL":
+        return matrix[1:, index + 1, 1:]
+    return matrix[1:, 1:, index + 1]
+
+
+def new_mask(shape):
+    mask = Mask()
+    mask.create_mask(shape)
+    mask.matrix[:] = 0
+    return mask
+
+
+def draw_ring(slice_):
+    """
+    A square ring of 255 with a hole of 0 in the middle.
+    """
+    h, w = slice_.shape
+    slice_[h // 4 : 3 * h // 4, w // 4 : 3 * w // 4] = 255
+    slice_[h // 4 + 2 : 3 * h // 4 - 2, w // 4 + 2 : 3 * w // 4 - 2] = 0
+
+
+def check_undo_redo(mask, before, after):
+    failed = False
+    mask.history.undo(mask.matrix)
+    if not np.array_equal(mask.matrix, before):
+        print("    undo didn't restore the mask")
+        failed = True
+    mask.history.redo(mask.matrix)
+    if not np.array_equal(mask.matrix, after):
+        print("    redo didn't restore the edition")
+        failed = True
+    return failed
+
+
+def check_fill_holes(shape, orientation):
+    mask = new_mask(shape)
+    index = shape[ORIENTATIONS.index(orientation)] // 2
+    slice_ = get_slice(mask.matrix, orientation, index)
+    draw_ring(slice_)
+    before = np.array(mask.matrix)
+
+    # Larger than the hole, smaller than the background around the ring.
+    max_size = (slice_.shape[0] // 2) * (slice_.shape[1] // 2)
+    mask.fill_holes_auto("2D", 4, orientation, index, max_size)
+    after = np.array(mask.matrix)
+    if np.array_equal(before, after):
+        print("    the hole wasn't filled")
+        return True
+    return check_undo_redo(mask, before, after)
+
+
+def check_region_growing(shape, orientation):
+    mask = new_mask(shape)
+    index = shape[ORIENTATIONS.index(orientation)] // 2
+    before = np.array(mask.matrix)
+
+    # As do_2d_seg: the buffer mask slice is (h, w) and the edited one is
+    # reshaped to (1, h, w).
+    b_mask = np.array(get_slice(mask.matrix, orientation, index))
+    dy, dx = b_mask.shape
+    edited = b_mask.copy().reshape((1, dy, dx))
+    edited[0, dy // 3 : dy // 2, dx // 3 : dx // 2] = 254
+    get_slice(mask.matrix, orientation, index)[:] = edited[0]
+    after = np.array(mask.matrix)
+
+    mask.save_history(index, orientation, edited, b_mask)
+    return check_undo_redo(mask, before, after)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check of the mask undo history")
+    parser.add_argument("--size", type=int, default=512, help="Size of each slice")
+    parser.add_argument("--slices", type=int, default=16)
+    args = parser.parse_args()
+
+    shape = (args.slices, args.size, args.size)
+    failed = False
+    for check in (check_fill_holes, check_region_growing):
+        for orientation in ORIENTATIONS:
+            print(f"{check.__name__} {orientation}")
+            try:
+                failed |= check(shape, orientation)
+            except Exception as err:
+                print(f"    {type(err).__name__}: {err}")
+                failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
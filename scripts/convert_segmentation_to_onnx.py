@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Converts the weights of the Unet3D segmenters (brain and trachea) from
+# PyTorch to ONNX, used by the ONNX Runtime backend of the deep learning
+# segmentation, and compares both: the maximum difference between the
+# probabilities and the time to run the same patches with PyTorch and with
+# each available ONNX Runtime execution provider (CPU, OpenVINO, ...).
+#
+# Example usage (from the root of the repository):
+#
+#     python scripts/convert_segmentation_to_onnx.py brain_mri_t1.pt --compare --threads 8
+#
+# Without an output file the ONNX file is written next to the weights file,
+# the segmenters look for it in the user weights folder
+# (~/.invesalius/deep_learning/weights/).
+
+import argparse
+import os
+import pathlib
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from invesalius.segmentation.deep_learning import segment  # noqa: E402
+from invesalius.segmentation.deep_learning.model import (  # noqa: E402
+    SIZE,
+    export_onnx,
+    load_unet3d,
+)
+
+
+def sample_patches(n, patch_size, seed=0):
+    """
+    Smooth random patches normalized to [0, 1], similar to the input of the
+    segmenters.
+    """
+    from scipy import ndimage
+
+    rng = np.random.default_rng(seed)
+    patches = rng.random((n, patch_size, patch_size, patch_size), dtype=np.float32)
+    patches = ndimage.gaussian_filter(patches, (0, 2, 2, 2))
+    patches -= patches.min()
+    patches /= patches.max()
+    return patches
+
+
+def run_torch(model, patches, batch_size, num_threads):
+    import torch
+
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    predictor = segment.TorchBatchPredictor(model, torch.device("cpu"), SIZE, batch_size)
+    return run(predictor, patches, batch_size)
+
+
+def run_onnx(onnx_file, provider, patches, batch_size, num_threads):
+    predictor = segment.OnnxBatchPredictor(onnx_file, provider, SIZE, batch_size, num_threads)
+    return run(predictor, patches, batch_size)
+
+
+def run(predictor, patches, batch_size):
+    outputs = []
+    t0 = time.perf_counter()
+    for start in range(0, len(patches), batch_size):
+        batch = patches[start : start + batch_size]
+        predictor.buffer[: len(batch)] = batch
+        outputs.append(predictor(predictor.buffer[: len(batch)]).copy())
+    return time.perf_counter() - t0, np.concatenate(outputs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert the Unet3D segmenters to ONNX")
+    parser.add_argument("weights", type=pathlib.Path, help="PyTorch weights file (.pt)")
+    parser.add_argument("output", type=pathlib.Path, nargs="?", help="ONNX file")
+    parser.add_argument("--compare", action="store_true", help="compare PyTorch and ONNX")
+    parser.add_argument("--patches", type=int, default=64)
+    parser.add_argument("--batch-size", type=int, default=segment.BATCH_SIZE)
+    parser.add_argument("--threads", type=int, default=0, help="0 uses all")
+    parser.add_argument("--tolerance", type=float, default=1e-4)
+    args = parser.parse_args()
+
+    output = args.output or args.weights.with_suffix(".onnx")
+    model = load_unet3d(args.weights)
+    export_onnx(model, output, SIZE)
+    print(f"Written {output}")
+
+    if not args.compare:
+        return
+
+    import onnxruntime
+
+    patches = sample_patches(args.patches, SIZE)
+    reference_time, reference = run_torch(model, patches, args.batch_size, args.threads)
+    print(f"{'runtime':>28} {'time (s)':>9} {'speedup':>8} {'max diff':>10}")
+    print(f"{'PyTorch CPU':>28} {reference_time:>9.2f} {1.0:>8.2f} {0.0:>10.2e}")
+
+    failed = False
+    for provider in onnxruntime.get_available_providers():
+        if provider not in ("CPUExecutionProvider", "OpenVINOExecutionProvider"):
+            continue
+        t, probabilities = run_onnx(output, provider, patches, args.batch_size, args.threads)
+        diff = float(np.abs(probabilities - reference).max())
+        print(f"{provider:>28} {t:>9.2f} {reference_time / t:>8.2f} {diff:>10.2e}")
+        if diff > args.tolerance:
+            print(f"The probabilities of {provider} differ from the PyTorch ones")
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Creates the int8 or float16 version of the ONNX model of a Unet3D
+# segmenter (brain and trachea) and checks its accuracy. The sample volumes
+# are prepared as the segmenters do in InVesalius (SegmentProcess): the
+# region of the foreground, the window (--window, as "Apply WW&WL") and the
+# normalization to [0, 1], and the background patches (skip_threshold of the
+# segmenter) are left out. The int8 model is calibrated with patches of these
+# inputs. Then each volume is segmented with the float32 and the reduced
+# precision models (segment_onnx, on the CPU) and the time, speedup and the
+# Dice coefficient of the thresholded masks are printed.
+#
+# Example usage (from the root of the repository):
+#
+#     python scripts/quantize_segmentation.py brain_mri_t1.onnx t1_a.nii.gz t1_b.nii.gz \
+#         --precision int8 --threads 8
+#
+# The model can also be the PyTorch weights (.pt), converted to ONNX first.
+# Without an output file the model is written next to the input one as
+# <name>.<precision>.onnx, the name the segmenters look for in the user
+# weights folder (~/.invesalius/deep_learning/weights/), where the
+# segmentation dialog offers int8 when the file exists. The volumes are
+# .npy files or any format read by nibabel.
+
+import argparse
+import os
+import pathlib
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+from invesalius.data import imagedata_utils  # noqa: E402
+from invesalius.segmentation.deep_learning import quantization, segment  # noqa: E402
+
+SEGMENTERS = {
+    segmenter.model_name: segmenter
+    for segmenter in (segment.BrainSegmentProcess, segment.TracheaSegmentProcess)
+}
+
+
+def load_volume(filename):
+    """
+    Reads the volume as it's in the project (z, y, x).
+    """
+    if filename.suffix == ".npy":
+        return np.load(filename)
+    import nibabel as nb
+
+    # nibabel arrays are x, y, z.
+    return np.asarray(nb.load(str(filename)).dataobj).swapaxes(0, 2)
+
+
+def prepare_volume(volume, args):
+    """
+    Returns the region segmented and its image as given to segment_onnx (see
+    segment.prepare_image).
+    """
+    apply_wwwl = args.window is not None
+    window_width, window_level = args.window if apply_wwwl else (255, 127)
+    return segment.prepare_image(
+        volume, segment.SIZE, not args.no_crop, apply_wwwl, window_width, window_level
+    )
+
+
+def segment_volume(onnx_file, volume, region, image, skip_threshold, args):
+    probability_array = np.zeros(volume.shape, dtype=np.float32)
+    comm_array = np.zeros(1, dtype=np.float32)
+    t0 = time.perf_counter()
+    if region is not None:
+        segment.segment_onnx(
+            image,
+            onnx_file,
+            args.overlap,
+            segment.ONNX_CPU_PROVIDER,
+            probability_array[region],
+            comm_array,
+            segment.SIZE,
+            batch_size=args.batch_size,
+            skip_threshold=skip_threshold,
+            num_threads=args.threads,
+        )
+    return time.perf_counter() - t0, probability_array
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantize the Unet3D segmenters")
+    parser.add_argument("model", type=pathlib.Path, help="ONNX (.onnx) or PyTorch (.pt) model")
+    parser.add_argument("volumes", type=pathlib.Path, nargs="+", help="sample volumes")
+    parser.add_argument(
+        "--precision",
+        choices=[segment.PRECISION_INT8, segment.PRECISION_FLOAT16],
+        default=segment.PRECISION_INT8,
+    )
+    parser.add_argument("--output", type=pathlib.Path, help="reduced precision ONNX file")
+    parser.add_argument("--patches", type=int, default=quantization.CALIBRATION_PATCHES)
+    parser.add_argument("--overlap", type=int, default=50, help="overlap of the patches (%%)")
+    parser.add_argument("--threshold", type=float, default=0.75, help="level of certainty")
+    parser.add_argument(
+        "--window",
+        type=float,
+        nargs=2,
+        metavar=("WW", "WL"),
+        help="apply this window to the volumes, as the Apply WW&WL option",
+    )
+    parser.add_argument(
+        "--no-crop", action="store_true", help="segment all the volume, not only the foreground"
+    )
+    parser.add_argument("--batch-size", type=int, default=segment.BATCH_SIZE)
+    parser.add_argument("--threads", type=int, default=0, help="0 uses all")
+    parser.add_argument("--min-dice", type=float, default=0.98)
+    args = parser.parse_args()
+
+    if args.model.suffix == ".onnx":
+        onnx_file = args.model
+    else:
+        from invesalius.segmentation.deep_learning.model import export_onnx, load_unet3d
+
+        onnx_file = args.model.with_suffix(".onnx")
+        export_onnx(load_unet3d(args.model), onnx_file, segment.SIZE)
+        print(f"Written {onnx_file}")
+
+    name = onnx_file.name.split(".")[0]
+    if name not in SEGMENTERS:
+        parser.error(f"{name} is not a segmenter model ({', '.join(SEGMENTERS)})")
+    skip_threshold = SEGMENTERS[name].skip_threshold
+    output = args.output or onnx_file.with_name(f"{name}.{args.precision}.onnx")
+    volumes = [load_volume(filename) for filename in args.volumes]
+    prepared = [prepare_volume(volume, args) for volume in volumes]
+
+    if args.precision == segment.PRECISION_INT8:
+        # segment_onnx normalizes its input to [0, 1].
+        inputs = [
+            imagedata_utils.image_normalize(image, 0.0, 1.0, output_dtype=np.float32)
+            for region, image in prepared
+            if region is not None
+        ]
+        patches = quantization.calibration_patches(
+            inputs, segment.SIZE, args.patches, skip_threshold=skip_threshold
+        )
+        del inputs
+        print(f"Calibrating with {len(patches)} patches")
+        quantization.quantize_int8(onnx_file, output, patches)
+        del patches
+    else:
+        quantization.convert_float16(onnx_file, output)
+    print(f"Written {output}")
+
+    label = args.precision + " (s)"
+    print(f"{'volume':>24} {'float32 (s)':>12} {label:>12} {'speedup':>8} {'dice':>7}")
+    failed = False
+    for filename, volume, (region, image) in zip(args.volumes, volumes, prepared):
+        reference_time, reference = segment_volume(
+            onnx_file, volume, region, image, skip_threshold, args
+        )
+        t, probabilities = segment_volume(output, volume, region, image, skip_threshold, args)
+        dice = quantization.dice(reference >= args.threshold, probabilities >= args.threshold)
+        print(
+            f"{filename.name[-24:]:>24} {reference_time:>12.2f} {t:>12.2f}"
+            f" {reference_time / t:>8.2f} {dice:>7.4f}"
+        )
+        if dice < args.min_dice:
+            print(f"The {args.precision} segmentation of {filename.name} differs from float32")
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
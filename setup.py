@@ -92,6 +92,10 @@ setuptools.setup(
                 ["invesalius_cy/floodfill.pyx"],
                 language="c++",
             ),
+            setuptools.Extension(
+                "invesalius_cy.threshold",
+                ["invesalius_cy/threshold.pyx"],
+            ),
             setuptools.Extension(
                 "invesalius_cy.cy_mesh",
                 ["invesalius_cy/cy_mesh.pyx"],
@@ -1,7 +1,20 @@
+import numpy as np
 from vtk import vtkPolyData
 
 class Mesh:
-    def __init__(self, pd: vtkPolyData | None = None, other: Mesh | None = None) -> None: ...
+    def __init__(
+        self,
+        pd: vtkPolyData | None = None,
+        other: Mesh | None = None,
+        vertices: np.ndarray | None = None,
+        faces: np.ndarray | None = None,
+        normals: np.ndarray | None = None,
+    ) -> None: ...
+    @property
+    def points(self) -> np.ndarray:
+        """
+        The vertices of the mesh as a numpy array (shares the memory).
+        """
     def copy_to(self, other: Mesh) -> None:
         """
         Copies self content to other.
@@ -11,7 +24,9 @@ class Mesh:
         Converts Mesh to vtkPolyData.
         """
 
-def ca_smoothing(mesh: Mesh, T: float, tmax: float, bmin: float, n_iters: int) -> None:
+def ca_smoothing(
+    mesh: Mesh, T: float, tmax: float, bmin: float, n_iters: int, num_threads: int = 0
+) -> None:
     """
     This is a implementation of the paper "Context-aware mesh smoothing for
     biomedical applications". It can be used to smooth meshes generated by
@@ -25,4 +40,6 @@ def ca_smoothing(mesh: Mesh, T: float, tmax: float, bmin: float, n_iters: int) -
               to considered to calculate the weight
         bmin: The minimum weight
         n_iters: Number of iterations.
+        num_threads: number of threads (0 uses all). The result doesn't
+                     depend on the number of threads.
     """
@@ -6,9 +6,28 @@ DTYPEF32 = np.float32
 DTYPE16_t = int
 
 def lmip(
-    image: np.ndarray, axis: int, tmin: DTYPE16_t, tmax: DTYPE16_t, out: np.ndarray
+    image: np.ndarray,
+    axis: int,
+    tmin: DTYPE16_t,
+    tmax: DTYPE16_t,
+    out: np.ndarray,
+    num_threads: int = 0,
+) -> None: ...
+def mida(
+    image: np.ndarray,
+    axis: int,
+    wl: DTYPE16_t,
+    ww: DTYPE16_t,
+    out: np.ndarray,
+    num_threads: int = 0,
 ) -> None: ...
-def mida(image: np.ndarray, axis: int, wl: DTYPE16_t, ww: DTYPE16_t, out: np.ndarray) -> None: ...
 def fast_countour_mip(
-    image: np.ndarray, n: float, axis: int, wl: DTYPE16_t, ww: DTYPE16_t, tmip: int, out: np.ndarray
+    image: np.ndarray,
+    n: float,
+    axis: int,
+    wl: DTYPE16_t,
+    ww: DTYPE16_t,
+    tmip: int,
+    out: np.ndarray,
+    num_threads: int = 0,
 ) -> None: ...
@@ -0,0 +1,22 @@
+import numpy as np
+
+def threshold_volume(
+    image: np.ndarray,
+    mask: np.ndarray,
+    thresh_min: float,
+    thresh_max: float,
+    num_threads: int = 0,
+) -> int:
+    """
+    Thresholds the image into the mask, in place, in the same way of
+    Slice.do_threshold_to_a_slice for all the axial slices at once: the
+    voxels inside [thresh_min, thresh_max] are set to 255 and the others to
+    0, except the voxels marked by the edition (1, 2, 253 and 254).
+
+    mask is the mask matrix with the flag borders, shape (dz + 1, dy + 1, dx +
+    1). The axial slices already generated (mask[n, 0, 0] != 0) are skipped
+    and the thresholded ones are flagged as generated (mask[n, 0, 0] = 1),
+    so only the missing slices are thresholded in the next calls. The slices
+    are processed in parallel using num_threads (0 uses all). Returns the
+    number of slices thresholded.
+    """